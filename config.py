@@ -7,25 +7,86 @@
 # Telegram
 token = '8358243654:AAGVh802-P823WU3CKd-ZiCcubHzt4f40Nc'  # More: https://core.telegram.org/bots#3-how-do-i-create-a-bot
 
+# Update delivery
+run_mode        = 'polling'                         # 'polling' or 'webhook'
+webhook_url     = 'https://example.com/telegram'    # Public HTTPS URL Telegram posts to (TLS terminated by your proxy / LB)
+webhook_host    = '0.0.0.0'                         # Address the built-in HTTP server binds to
+webhook_port    = 8080                              # Port the built-in HTTP server listens on
+webhook_path    = 'telegram'                        # Path part of webhook_url
+webhook_secret  = ''                                # Secret token checked on every request (recommended)
+webhook_max_connections = 40                        # Max. parallel connections Telegram opens to us
+update_workers  = 8                                 # Threads handling updates (one user's updates always run in order)
+update_max_pending = 1000                           # Polling pauses while this many updates are still waiting
+
+# Runtime state (pending choices, banned id set)
+state_backend    = 'memory'                     # 'memory' (one process) or 'redis' (shared by several bot processes)
+state_redis_url  = 'redis://localhost:6379/0'   # Any Redis-protocol server; needs `pip install redis`
+state_key_prefix = 'supportbot:'                # Prepended to every key in the shared store
+issue_choice_ttl = 3600                         # Forget a "new / related issue" answer after X SECONDS
+onboarding_ttl   = 86400                        # Abandon a half-finished /become_agent after X SECONDS (kept in the DB)
+onboarding_retries = 3                          # ...or after X invalid answers in a row (/cancel stops it any time)
+conversation_purge_interval = 600               # How often (SECONDS) expired conversations are deleted
+
+# Outbound rate limits (Telegram: ~30 msg/s overall, ~1 msg/s per private chat, 20 msg/min per group)
+outbound_global_rate  = 30      # Messages per second across all chats
+outbound_private_rate = 1       # Messages per second to one private chat
+outbound_group_rate   = 20 / 60 # Messages per second to one group
+outbound_burst        = 3       # Short bursts allowed per chat
+outbound_workers      = 4       # Parallel API calls
+
 # MySQL Database
 mysql_host = 'localhost'
 mysql_db   = 'TelegramSupportBot'
 mysql_user = 'SupportBotUser'
 mysql_pw = 'supportpass123'
+mysql_pool_size      = 10       # Max. open connections shared by all handlers
+mysql_pool_timeout   = 10       # Seconds to wait for a free connection before failing
+mysql_pool_recycle   = 3600     # Reconnect connections older than X seconds
+mysql_pool_ping_idle = 30       # Ping connections idle for X seconds before reuse (0 = always)
 
 # Support Chat (Chat ID)
 support_chat = -1002759088455
 
 admin_ids = [744260641]          # your Telegram ID(s)
 ticket_commission_base = 1.0     # base amount per resolved ticket
+earnings_rollup_interval = 60    # How often (SECONDS) the earnings ledger is rolled up into agent totals
+earnings_rollup_lag      = 5     # Ledger rows younger than X SECONDS wait for the next rollup
+stats_counter_slots      = 8     # Rows per /report_summary counter (spreads concurrent writers)
+stats_reconcile_interval = 3600  # How often (SECONDS) the counters are re-derived from the tables
+membership_reconcile_interval = 900  # How often (SECONDS) the in-memory banned id set is re-read
+
+# Ticket routing (new tickets go straight to an agent who speaks the user's language)
+route_tickets         = True    # Auto-assign new tickets; the claim button stays as the fallback
+route_max_active      = 1       # Open tickets an agent may hold before routing skips them
+route_off_shift       = False   # Also route to agents off shift, after all on-shift ones
+route_attempts        = 3       # Agents tried per ticket when claims fail (agent at the cap elsewhere)
+route_resync_interval = 300     # How often (SECONDS) agent loads and shifts are re-read from the DB
+shift_check_interval  = 60      # How often (SECONDS) agents going on / off shift (by their hours) are picked up
+agents_reload_interval = 60     # How often (SECONDS) the agent registry and /shift overrides are re-read (other processes' changes)
+claim_on_shift_only   = True    # Agents with hours set can't claim tickets outside them (unless /shift on)
 
 
 # Misc
-time_zone           = 'GMT+2'   # Supports time zone
+time_zone           = 'GMT+2'   # Supports time zone (also for agent hours given without one)
 bad_words_toggle    = True      # Enable / disable bad words filter
 spam_toggle         = True      # Enable / disable spam filter
 spam_protection     = 5         # How many consecutive messages can be sent without a reply from the team
+spam_window         = 0         # SECONDS of silence that refill all spam_protection messages (0 = only a team reply does)
+spam_flush_interval = 10        # How often (SECONDS) spam counters are written to the DB
+spam_idle_evict     = 3600      # Drop a user's in-memory counter after X SECONDS without messages
+spam_max_users      = 100000    # Counters kept in memory at most (least recently used are dropped)
+transcript_flush_ms   = 200     # Ticket transcript rows are written at least every X MILLISECONDS...
+transcript_batch_rows = 200     # ...or as soon as X rows are waiting
+transcript_max_buffer = 50000   # Rows kept in memory while the DB is unreachable (oldest dropped first)
+search_backend      = 'mysql'   # /search via MySQL FULLTEXT ('mysql') or an index kept in memory ('local')
+search_page_size    = 10        # Tickets per /search page
+search_refresh_interval = 5     # Seconds between loads of new transcript rows into the 'local' search index
+media_group_wait    = 1.0       # Seconds to collect the parts of an album before relaying it as one
 open_ticket_emoji   = 24        # After X amount of HOURS an emoji will pop up at /tickets
+profile_cache_size  = 10000     # How many user profiles (names) are kept in memory
+profile_max_age     = 7         # Re-fetch a stored profile from Telegram after X DAYS without activity
+profile_touch_interval = 86400  # Mark an active user's profile as fresh at most every X SECONDS
+profile_refresh_interval = 300  # How often (SECONDS) the background refresher runs
 
 # Messages
 text_messages = {
@@ -34,9 +95,12 @@ text_messages = {
     'support_response': 'From: {}'                  # Support response is being added automatically. {} = refers to the staffs first name.
 }
 
-# Regex (https://regex101.com/)
-regex_filter = {
-    'bad_words': r'(?i)^(.*?(\b\w*fuck|shut up|dick|bitch|bastart|cunt|bollocks|bugger|rubbish|wanker|twat|suck|ass|pussy|arsch\w*\b)[^$]*)$'
+# Bad words filter, per language code ('*' = every language). Matches whole words, case/accents/leetspeak
+# insensitive. Prefix with * to also catch longer words ending in it, suffix with * for words starting with it.
+bad_words = {
+    '*': ['*fuck*', 'shut up', 'dick', 'dicks', 'bitch*', 'bastard*', 'bastart', 'cunt*', 'bollocks',
+          'bugger*', 'rubbish', 'wanker*', 'twat*', 'suck', 'sucks', 'ass', 'asshole*', 'pussy'],
+    'de': ['arsch*'],
 }
 
 # Which languages you want to support for routing
@@ -3,35 +3,90 @@
 # Author Name           : fabston               #
 # File Name             : main.py               #
 # --------------------------------------------- #
-import time
+import secrets
 import config
 from resources import mysql_handler as mysql
 from resources import markups_handler as markup
 from resources import msg_handler as msg
+from resources import profile_store as profiles
+from resources import outbound
+from resources import spam_guard
+from resources import jobs
+from resources import migrations
+from resources import state
+from resources import conversation
+from resources import webhook_server
+from resources import updates
+from resources import transcript
+from resources import search
+from resources import media_groups
+from resources import routing
+from resources import availability
 from resources.utils import normalize_language_input
 
 import telebot
+from enum import IntEnum
 from datetime import datetime, timedelta
 import arrow
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-bot = telebot.TeleBot(config.token)
+telebot.apihelper.ENABLE_MIDDLEWARE = True
+# Updates are dispatched on resources/updates.py's keyed worker pool, not telebot's
+bot = telebot.TeleBot(config.token, threaded=False)
+
+migrations.run()
+
+profiles.start_refresher(bot)
+spam_guard.start_flusher(mysql.save_spam_counters)
+transcript.start_writer(mysql.save_ticket_messages)
+jobs.every(getattr(config, 'earnings_rollup_interval', 60), mysql.rollup_earnings, 'earnings-rollup')
+jobs.every(getattr(config, 'stats_reconcile_interval', 3600), mysql.reconcile_stats_counters, 'stats-reconcile')
+jobs.every(getattr(config, 'membership_reconcile_interval', 900), mysql.reconcile_membership, 'membership-reconcile')
+jobs.every(getattr(config, 'conversation_purge_interval', 600), mysql.purge_conversations, 'conversation-purge')
+if getattr(config, 'search_backend', 'mysql') == 'local':
+    search.start_indexer()
+
+def sync_routing():
+    """Re-read agents' hours and loads; also after changes to an agent's hours."""
+    availability.load(mysql.get_agent_availability())
+    routing.router().load(mysql.get_routing_agents(), on_shift=availability.on_shift_now())
+
+def sync_shifts():
+    routing.router().set_shifts(availability.on_shift_now())
+
+def sync_agents():
+    """Pick up approvals, /setlang, commission and /shift changes made by other processes."""
+    mysql.reload_agents()
+    availability.load(mysql.get_agent_availability())
+    sync_shifts()
 
-mysql.run_migrations()
-mysql.createTables()
-# Safe “ensure”
 try:
-    mysql.ensure_claimed_by_column()
+    sync_routing()
 except Exception as e:
-    print("⚠️ ensure_claimed_by_column:", e)
-
-# Runtime memory
-pending_issue_choice = {}      # {user_id: {"relate_ticket_id": int}}
-user_registration_state = {}   # legacy variable—still harmless
+    print("⚠️ Failed to load agents for routing:", e)
+jobs.every(getattr(config, 'route_resync_interval', 300), sync_routing, 'routing-resync')
+jobs.every(getattr(config, 'shift_check_interval', 60), sync_shifts, 'shift-check')
+jobs.every(getattr(config, 'agents_reload_interval', 60), sync_agents, 'agents-reload')
+
+# Runtime memory (in the state backend, shared when several processes run)
+store = state.backend()
+ISSUE_CHOICE_TTL = getattr(config, 'issue_choice_ttl', 3600)
+
+def issue_choice_key(uid):
+    return f"issue_choice:{uid}"    # {"relate_ticket_id": int or None}
+
+# -------------------- Middleware -------------------- #
+@bot.middleware_handler(update_types=['message', 'callback_query'])
+def remember_sender(bot_instance, update):
+    """Keep the profile store fed from every incoming update's sender."""
+    try:
+        profiles.remember(update.from_user)
+    except Exception as e:
+        print("⚠️ Failed to store profile:", e)
 
 # -------------------- Helpers -------------------- #
 def is_agent(uid):
-    return mysql.get_agent_languages(uid) is not None
+    return mysql.is_agent(uid)
 
 def is_admin(uid):
     return uid in getattr(config, 'admin_ids', [])
@@ -45,14 +100,16 @@ def send_agent_welcome(bot_obj, user_id, invite_link):
         "📍 *Run these commands in DM with the bot*\n"
         "  `/mytickets` – your active tickets\n"
         "  `/whoami` – profile & stats\n"
-        "  `/setlang en,es` – update your languages\n\n"
+        "  `/setlang en,es` – update your languages\n"
+        "  `/availability` – your working hours\n"
+        "  `/shift on` / `/shift off` – override them (`/shift auto` to follow them again)\n\n"
         "📍 *Run these in the support group*\n"
         "  `/resolve <user_id>` – mark a ticket resolved\n"
         "  `/close <user_id>` – close a *resolved* ticket (admin can force-close)\n"
         "  `/claim_ticket` – manual claim if button fails\n\n"
         f"✅ Join support group:\n{invite_link}"
     )
-    bot_obj.send_message(user_id, text, parse_mode="Markdown", disable_web_page_preview=True)
+    outbound.send(bot_obj.send_message, user_id, text, parse_mode="Markdown", disable_web_page_preview=True)
 
 # ---------- Language helpers (Milestone 5) ----------
 def build_lang_kb():
@@ -67,10 +124,11 @@ def build_lang_kb():
         kb.row(*row)
     return kb
 
-def ensure_user_language(message):
+def ensure_user_language(message, saved=None):
     """Ensure user has a language in DB; if not, try TG code or prompt."""
     uid = message.from_user.id
-    saved = mysql.get_user_language(uid)
+    if saved is None:
+        saved = mysql.get_user_language(uid)
     if saved:
         return True
 
@@ -79,7 +137,8 @@ def ensure_user_language(message):
         mysql.save_user_language(uid, tg_code)
         return True
 
-    bot.send_message(
+    outbound.send(
+        bot.send_message,
         uid,
         "🌐 Please choose your language:",
         reply_markup=build_lang_kb()
@@ -87,42 +146,94 @@ def ensure_user_language(message):
     return False
 
 # -------------------- Agent Onboarding -------------------- #
+class Onboarding(IntEnum):
+    NAME = 1
+    LANGUAGES = 2
+    AVAILABILITY = 3
+
+def onboarding_gave_up(message):
+    outbound.send(bot.send_message, message.from_user.id,
+                  "ℹ️ Agent sign-up stopped after several invalid answers. Send /become_agent to start again.")
+
+onboarding = conversation.Flow(1, ttl=getattr(config, 'onboarding_ttl', 86400),
+                               max_retries=getattr(config, 'onboarding_retries', 3), gave_up=onboarding_gave_up)
+
+ONBOARDING_QUESTIONS = {
+    Onboarding.NAME:         "📝 Please enter your *full name* (/cancel to stop):",
+    Onboarding.LANGUAGES:    "🌍 What languages do you speak?",
+    Onboarding.AVAILABILITY: "⏰ When are you available? (e.g. `Mon-Fri 9:00-17:00 Europe/Berlin`; "
+                             f"without a time zone it's `{config.time_zone}`)",
+}
+
+def ask(user_id, state, answers=None):
+    """Send the question for `state`; returns the (state, answers) a step handler hands back."""
+    outbound.send(bot.send_message, user_id, ONBOARDING_QUESTIONS[state], parse_mode="Markdown")
+    return state, answers
+
 @bot.message_handler(commands=['become_agent'])
 def handle_agent_request(message):
     if dm_only(message):
         return
     user_id = message.from_user.id
-    bot.send_message(user_id, "📝 Please enter your *full name*:", parse_mode="Markdown")
-    bot.register_next_step_handler(message, collect_name)
-
-def collect_name(message):
-    full_name = message.text.strip()
-    bot.send_message(message.from_user.id, "🌍 What languages do you speak?")
-    bot.register_next_step_handler(message, lambda m: collect_languages(m, full_name))
-
-def collect_languages(message, full_name):
-    languages = message.text.strip()
-    bot.send_message(message.from_user.id, "⏰ When are you mostly available (e.g., 9AM–5PM)?")
-    bot.register_next_step_handler(message, lambda m: finalize_request(m, full_name, languages))
+    if is_agent(user_id):
+        outbound.reply_to(bot, message, "ℹ️ You're already an agent.")
+        return
+    if mysql.get_current_ticket(user_id):
+        outbound.reply_to(bot, message, "ℹ️ Please wait until your open support ticket is closed.")
+        return
+    onboarding.start(user_id, Onboarding.NAME)
+    ask(user_id, Onboarding.NAME)
 
-def finalize_request(message, full_name, languages):
-    availability = message.text.strip()
+@bot.message_handler(commands=['cancel'])
+def cmd_cancel(message):
+    if dm_only(message):
+        return
+    if conversation.cancel(message.from_user.id):
+        outbound.reply_to(bot, message, "❌ Cancelled.")
+    else:
+        outbound.reply_to(bot, message, "ℹ️ Nothing to cancel.")
+
+@onboarding.step(Onboarding.NAME)
+def collect_name(message, answers):
+    if not message.text:
+        return ask(message.from_user.id, Onboarding.NAME, answers)
+    answers['full_name'] = message.text.strip()[:100]
+    return ask(message.from_user.id, Onboarding.LANGUAGES, answers)
+
+@onboarding.step(Onboarding.LANGUAGES)
+def collect_languages(message, answers):
+    languages = (message.text or '').strip()[:255]
+    try:
+        normalize_language_input(languages)
+    except ValueError as e:
+        outbound.send(bot.send_message, message.from_user.id,
+                      f"❌ {e}\n\nPlease enter valid languages (e.g. English, German).")
+        return Onboarding.LANGUAGES, answers
+    answers['languages'] = languages
+    return ask(message.from_user.id, Onboarding.AVAILABILITY, answers)
+
+@onboarding.step(Onboarding.AVAILABILITY)
+def finalize_request(message, answers):
+    if not message.text:
+        return ask(message.from_user.id, Onboarding.AVAILABILITY, answers)
     user_id = message.from_user.id
     try:
-        normalized_languages = normalize_language_input(languages)
+        hours = availability.describe(*availability.parse(message.text[:255]))
     except ValueError as e:
-        bot.send_message(user_id, f"❌ {e}\n\nPlease enter valid languages (e.g. English, German).")
-        return
+        outbound.send(bot.send_message, user_id, f"❌ {e}\n\nPlease enter your hours again (e.g. Mon-Fri 9:00-17:00).")
+        return Onboarding.AVAILABILITY, answers
+    full_name, languages = answers['full_name'], answers['languages']
+    normalized_languages = normalize_language_input(languages)
 
-    mysql.save_pending_agent(user_id, full_name, normalized_languages, availability)
-    bot.send_message(user_id, "✅ Your request has been submitted for review. Please wait for admin approval.")
+    mysql.save_pending_agent(user_id, full_name, normalized_languages, hours)
+    outbound.send(bot.send_message, user_id, "✅ Your request has been submitted for review. Please wait for admin approval.")
 
     text = (
         f"📥 *New Agent Request*\n\n"
         f"👤 Name: `{full_name}`\n"
         f"🆔 User ID: `{user_id}`\n"
         f"🌍 Languages: `{languages}`\n"
-        f"⏰ Availability: `{availability}`\n\n"
+        f"⏰ Availability: `{hours}`\n\n"
         f"Use `/approve {user_id}` or `/reject {user_id}`"
     )
     approval_markup = InlineKeyboardMarkup()
@@ -130,7 +241,7 @@ def finalize_request(message, full_name, languages):
         InlineKeyboardButton("✅ Approve", callback_data=f"approve_agent_{user_id}"),
         InlineKeyboardButton("❌ Reject",  callback_data=f"reject_agent_{user_id}")
     )
-    bot.send_message(config.support_chat, text, parse_mode='Markdown', reply_markup=approval_markup)
+    outbound.send_later(bot.send_message, config.support_chat, text, parse_mode='Markdown', reply_markup=approval_markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith(('approve_agent_', 'reject_agent_')))
 def handle_agent_approval(call):
@@ -139,6 +250,7 @@ def handle_agent_approval(call):
 
         if call.data.startswith('approve_agent_'):
             mysql.approve_agent(user_id)
+            sync_routing()
             bot.answer_callback_query(call.id, "✅ Agent Approved!")
             bot.edit_message_text("✅ This agent has been approved.",
                                   chat_id=call.message.chat.id, message_id=call.message.message_id)
@@ -150,7 +262,7 @@ def handle_agent_approval(call):
             bot.answer_callback_query(call.id, "❌ Agent Rejected")
             bot.edit_message_text("❌ This agent request was rejected.",
                                   chat_id=call.message.chat.id, message_id=call.message.message_id)
-            bot.send_message(user_id, "❌ Your request to become an agent was rejected.")
+            outbound.send(bot.send_message, user_id, "❌ Your request to become an agent was rejected.")
     except Exception as e:
         print("⚠️ Error in agent approval callback:", e)
         bot.answer_callback_query(call.id, "❌ Error processing this action.")
@@ -159,7 +271,8 @@ def handle_agent_approval(call):
 @bot.message_handler(commands=['start'])
 def cmd_start(message):
     if message.chat.type == 'private':
-        bot.send_message(
+        outbound.send(
+            bot.send_message,
             message.chat.id,
             config.text_messages['start'].format(message.from_user.first_name) + msg.repo(),
             parse_mode='Markdown',
@@ -168,19 +281,20 @@ def cmd_start(message):
         )
         mysql.start_bot(message.chat.id)
     else:
-        bot.reply_to(message, "Please send me a PM if you'd like to talk to the Support Team.")
+        outbound.reply_to(bot, message, "Please send me a PM if you'd like to talk to the Support Team.")
 
 @bot.message_handler(commands=['faq'])
 def cmd_faq(message):
     if message.chat.type == 'private':
-        bot.reply_to(message, config.text_messages['faqs'], parse_mode='Markdown', disable_web_page_preview=True)
+        outbound.reply_to(bot, message, config.text_messages['faqs'], parse_mode='Markdown', disable_web_page_preview=True)
 
 @bot.message_handler(commands=['set_language', 'setlang_user'])
 def cmd_set_language(message):
     if message.chat.type != 'private':
-        bot.reply_to(message, "📬 Please DM me for this command.")
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
         return
-    bot.send_message(
+    outbound.send(
+        bot.send_message,
         message.chat.id,
         "🌐 Select your language:",
         reply_markup=build_lang_kb()
@@ -192,17 +306,25 @@ def cmd_tickets(message):
     if message.chat.id != config.support_chat:
         return
 
-    if not mysql.open_tickets:
-        bot.reply_to(message, "ℹ️ Great job, you answered all your tickets!")
+    rows = mysql.list_open_tickets()
+    coverage = {}   # {language: agents on shift speaking it}
+    for r in rows:
+        lang = r['language'] or config.DEFAULT_LANG
+        if lang not in coverage:
+            coverage[lang] = len(availability.on_shift_now(lang))
+    uncovered = message.text.split()[1:2] == ['uncovered']
+    if uncovered:
+        rows = [r for r in rows if not coverage[r['language'] or config.DEFAULT_LANG]]
+    if not rows:
+        outbound.reply_to(bot, message, "ℹ️ No open tickets without an agent on shift." if uncovered else
+                                        "ℹ️ Great job, you answered all your tickets!")
         return
 
-    ot_msg = '📨 *Open tickets:*\n\n'
     now = arrow.now()
-    for user in mysql.open_tickets:
-        bot.send_chat_action(message.chat.id, 'typing')
-        data = mysql.user_tables(int(user))
-        ot_link = data['open_ticket_link']
-        ot_time = data['open_ticket_time']
+    lines = []
+    for r in rows:
+        lang = r['language'] or config.DEFAULT_LANG
+        ot_time = r['open_ticket_time']
         if ot_time:
             diff = datetime.now() - ot_time
             time_since_secs = diff.total_seconds()
@@ -211,13 +333,63 @@ def cmd_tickets(message):
             time_since = "just now"
 
         alert = ' ↳ ⚠️ ' if ot_time and (datetime.now() - ot_time) > timedelta(hours=config.open_ticket_emoji) else ' ↳ '
-        chat = bot.get_chat(int(user))
-        ot_msg += "• [{0}{1}](tg://user?id={2}) (`{2}`)\n{5}_{3}_ [➜ Go to msg]({4})\n".format(
-            chat.first_name,
-            f' {chat.last_name}' if chat.last_name else '',
-            int(user), time_since, ot_link, alert
-        )
-    bot.send_message(message.chat.id, ot_msg, parse_mode='Markdown')
+        shift = f"🟢 {coverage[lang]} on shift" if coverage[lang] else "🔴 nobody on shift"
+        lines.append("• [{0}](tg://user?id={1}) (`{1}`)\n{4}_{2}_ · `{5}` {6} [➜ Go to msg]({3})\n".format(
+            msg.display_name(r['first_name'], r['last_name']),
+            r['userid'], time_since, r['open_ticket_link'], alert, lang, shift
+        ))
+    title = '📨 *Open tickets without an agent on shift:*\n\n' if uncovered else '📨 *Open tickets:*\n\n'
+    msg.send_chunked(bot, message.chat.id, title, lines, parse_mode='Markdown')
+
+# -------------------- Search -------------------- #
+def search_page(query, token, page):
+    """Text and pager keyboard for one page of /search results."""
+    size = getattr(config, 'search_page_size', 10)
+    try:
+        rows = search.search(query, size + 1, page * size)
+    except search.IndexBuilding:
+        return "🔎 The search index is still being built, please try again in a few minutes.", None
+    more, rows = len(rows) > size, rows[:size]
+    if not rows:
+        return f"🔎 No tickets found for `{query}`.", None
+    text = f"🔎 *Tickets for* `{query}` (page {page + 1})\n\n"
+    for i, r in enumerate(rows, page * size + 1):
+        link = r['last_message_link'] or r['first_message_link']
+        text += f"{i}. #{r['ticket_id']} · user `{r['user_id']}` · {'closed' if r['closed_at'] else 'open'} · [➜ msg]({link})\n"
+    kb = InlineKeyboardMarkup()
+    nav = []
+    if page:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"search_{token}_{page - 1}"))
+    if more:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"search_{token}_{page + 1}"))
+    if nav:
+        kb.row(*nav)
+    return text, kb if nav else None
+
+@bot.message_handler(commands=['search'])
+def cmd_search(message):
+    if message.chat.id != config.support_chat:
+        return
+    query = message.text.partition(' ')[2].replace('`', '').strip()
+    if not query:
+        outbound.reply_to(bot, message, "Usage: /search <words>")
+        return
+    token = secrets.token_hex(4)
+    store.set(f"search:{token}", query, ttl=3600)   # pager buttons only carry the token
+    text, kb = search_page(query, token, 0)
+    outbound.reply_to(bot, message, text, parse_mode='Markdown', disable_web_page_preview=True, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('search_'))
+def search_pager(call):
+    _, token, page = call.data.split('_')
+    query = store.get(f"search:{token}")
+    if query is None:
+        bot.answer_callback_query(call.id, "Search expired, please run /search again.")
+        return
+    text, kb = search_page(query, token, int(page))
+    bot.answer_callback_query(call.id)
+    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id,
+                          parse_mode='Markdown', disable_web_page_preview=True, reply_markup=kb)
 
 # ------------- Milestone 4: Resolve & Close control ------------- #
 @bot.message_handler(commands=['resolve'])
@@ -237,21 +409,21 @@ def cmd_resolve(message):
             pass
 
     if not user_id:
-        bot.reply_to(message, "Reply to the ticket or `/resolve <user_id>`.", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "Reply to the ticket or `/resolve <user_id>`.", parse_mode='Markdown')
         return
 
     ticket = mysql.get_current_ticket(user_id)
     if not ticket:
-        bot.reply_to(message, "❌ No open ticket for that user.")
+        outbound.reply_to(bot, message, "❌ No open ticket for that user.")
         return
 
     claimer = ticket['claimed_by']
     if claimer and claimer != message.from_user.id and not is_admin(message.from_user.id):
-        bot.reply_to(message, "❌ Only the claiming agent (or an admin) can resolve this ticket.")
+        outbound.reply_to(bot, message, "❌ Only the claiming agent (or an admin) can resolve this ticket.")
         return
 
     mysql.mark_ticket_resolved(ticket['id'])
-    bot.reply_to(message, f"✅ Ticket `{ticket['id']}` for `{user_id}` marked *resolved*.", parse_mode='Markdown')
+    outbound.reply_to(bot, message, f"✅ Ticket `{ticket['id']}` for `{user_id}` marked *resolved*.", parse_mode='Markdown')
 
 @bot.message_handler(commands=['close', 'c'])
 def cmd_close(message):
@@ -268,46 +440,42 @@ def cmd_close(message):
             pass
 
     if not user_id:
-        bot.reply_to(message, "ℹ️ Reply to the ticket message or use `/close <user_id>`.",
+        outbound.reply_to(bot, message, "ℹ️ Reply to the ticket message or use `/close <user_id>`.",
                      parse_mode='Markdown')
         return
 
     ticket = mysql.get_current_ticket(user_id)
     if not ticket:
-        bot.reply_to(message, '❌ That user has no open ticket...')
+        outbound.reply_to(bot, message, '❌ That user has no open ticket...')
         return
 
     if not is_admin(message.from_user.id) and ticket['resolved'] == 0:
-        bot.reply_to(message, "❌ Mark it resolved first with `/resolve <user_id>`.", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "❌ Mark it resolved first with `/resolve <user_id>`.", parse_mode='Markdown')
         return
 
-    current_claimer = ticket['claimed_by']
-    if current_claimer:
-        mysql.increment_resolved_and_pay(current_claimer)
-
-    mysql.close_ticket(ticket['id'])
-    mysql.reset_user_ticket_state(user_id)
-    bot.reply_to(message, f'✅ Ticket `{ticket["id"]}` closed for `{user_id}`.', parse_mode='Markdown')
+    if not mysql.close_ticket_atomic(ticket['id'], user_id):
+        outbound.reply_to(bot, message, 'ℹ️ That ticket was already closed.')
+        return
+    if ticket['claimed_by']:
+        routing.router().release(ticket['claimed_by'])
+    outbound.reply_to(bot, message, f'✅ Ticket `{ticket["id"]}` closed for `{user_id}`.', parse_mode='Markdown')
 
 @bot.message_handler(commands=['banned'])
 def cmd_banned(message):
     if message.chat.id != config.support_chat:
         return
-    if not mysql.banned:
-        bot.reply_to(message, "ℹ️ Great news, nobody got banned... Yet.")
+    rows = mysql.list_banned_users()
+    if not rows:
+        outbound.reply_to(bot, message, "ℹ️ Great news, nobody got banned... Yet.")
         return
 
-    ot_msg = '⛔️ *Banned users:*\n\n'
-    for user in mysql.banned:
-        bot.send_chat_action(message.chat.id, 'typing')
-        ot_link = mysql.user_tables(int(user))['open_ticket_link']
-        chat = bot.get_chat(int(user))
-        ot_msg += "• [{0}{1}](tg://user?id={2}) (`{2}`)\n[➜ Go to last msg]({3})\n".format(
-            chat.first_name,
-            f' {chat.last_name}' if chat.last_name else '',
-            int(user), ot_link
+    lines = [
+        "• [{0}](tg://user?id={1}) (`{1}`)\n[➜ Go to last msg]({2})\n".format(
+            msg.display_name(r['first_name'], r['last_name']), r['userid'], r['open_ticket_link']
         )
-    bot.send_message(message.chat.id, ot_msg, parse_mode='Markdown')
+        for r in rows
+    ]
+    msg.send_chunked(bot, message.chat.id, '⛔️ *Banned users:*\n\n', lines, parse_mode='Markdown')
 
 @bot.message_handler(commands=['ban'])
 def cmd_ban(message):
@@ -320,21 +488,21 @@ def cmd_ban(message):
         elif msg.getReferrer(message.text):
             target_id = int(msg.getReferrer(message.text))
         if not target_id:
-            bot.reply_to(message, 'ℹ️ Reply to a message or mention a `User ID`.', parse_mode='Markdown')
+            outbound.reply_to(bot, message, 'ℹ️ Reply to a message or mention a `User ID`.', parse_mode='Markdown')
             return
 
         banned_status = mysql.user_tables(target_id)['banned']
         if banned_status == 1:
-            bot.reply_to(message, '❌ That user is already banned...')
+            outbound.reply_to(bot, message, '❌ That user is already banned...')
         else:
             mysql.ban_user(target_id)
             try:
                 mysql.reset_user_ticket_state(target_id)
             except Exception:
                 pass
-            bot.reply_to(message, '✅ Ok, banned that user!')
+            outbound.reply_to(bot, message, '✅ Ok, banned that user!')
     except TypeError:
-        bot.reply_to(message, '❌ Are you sure I interacted with that user before...?')
+        outbound.reply_to(bot, message, '❌ Are you sure I interacted with that user before...?')
 
 @bot.message_handler(commands=['unban'])
 def cmd_unban(message):
@@ -347,62 +515,89 @@ def cmd_unban(message):
         elif msg.getReferrer(message.text):
             target_id = int(msg.getReferrer(message.text))
         if not target_id:
-            bot.reply_to(message, 'ℹ️ Reply to a message or mention a `User ID`.', parse_mode='Markdown')
+            outbound.reply_to(bot, message, 'ℹ️ Reply to a message or mention a `User ID`.', parse_mode='Markdown')
             return
 
         banned_status = mysql.user_tables(target_id)['banned']
         if banned_status == 0:
-            bot.reply_to(message, '❌ That user is already un-banned...')
+            outbound.reply_to(bot, message, '❌ That user is already un-banned...')
         else:
             mysql.unban_user(target_id)
-            bot.reply_to(message, '✅ Ok, un-banned that user!')
+            outbound.reply_to(bot, message, '✅ Ok, un-banned that user!')
     except TypeError:
-        bot.reply_to(message, '❌ Are you sure I interacted with that user before...?')
+        outbound.reply_to(bot, message, '❌ Are you sure I interacted with that user before...?')
 
 # -------------------- Private Messages (Users & Agents) -------------------- #
+def in_order(message):
+    """run= for media_groups.hold: handle a finished album on the sender's update queue."""
+    return lambda fn: updates.executor().submit(message.from_user.id, fn)
+
 @bot.message_handler(
     func=lambda m: m.chat.type == 'private' and not (getattr(m, 'text', '') or '').startswith('/'),
-    content_types=['text', 'photo', 'document']
+    content_types=msg.RELAY_TYPES
 )
 def echo_all(message):
-    mysql.start_bot(message.chat.id)
+    if media_groups.hold(message, handle_private, run=in_order(message)):
+        return
+    # An album still waiting goes first; each batch starts once the previous one's
+    # ticket updates are written, so the two can't both open a ticket
+    batches = media_groups.take_chat(message.chat.id) + [[message]]
+    handle_private(batches[0])
+    for parts in batches[1:]:
+        updates.then(handle_private, parts)
+
+def handle_private(parts):
+    """A private message, or all parts of an album, from a user or an agent."""
+    message = parts[0]
     sender_id = message.chat.id
+    ctx = mysql.load_message_context(sender_id)
+    user = ctx['user']
+
+    # ---- IN THE MIDDLE OF /become_agent (or another conversation) ----
+    if not is_agent(sender_id) and conversation.dispatch(message, ctx['conversation']):
+        return
 
     # ---- AGENT DM FLOW ----
     if is_agent(sender_id):
+        if user is None:
+            mysql.start_bot(sender_id)
         target_user = mysql.get_claimed_ticket_by_agent(sender_id)
         if target_user:
-            msg.snd_handler(target_user, bot, message, message.text)
+            msg.snd_handler(target_user, bot, parts)
         else:
-            bot.reply_to(message, "You haven't claimed any ticket. Claim one in the group first.")
+            outbound.reply_to(bot, message, "You haven't claimed any ticket. Claim one in the group first.")
         return
 
     # ---- USER FLOW ----
     # ensure language ONLY for users
-    if not ensure_user_language(message):
+    if not ensure_user_language(message, saved=(user or {}).get('language') or 'en'):
+        return
+
+    # Nothing with a filtered word is relayed, to the group or to an agent
+    if any(msg.bad_words_handler(bot, part) for part in parts):
         return
 
     # If user’s ticket is claimed -> send to that agent
-    claimed_by_agent = mysql.get_ticket_claim(sender_id)
+    claimed_by_agent = (user or {}).get('claimed_by')
     if claimed_by_agent:
-        msg.snd_to_agent(claimed_by_agent, bot, message)
+        msg.snd_to_agent(claimed_by_agent, bot, parts)
         return
 
     # Normal (unclaimed) user flow
-    data = mysql.user_tables(sender_id) or {}
-    if data.get('banned', 0) == 1:
+    if (user or {}).get('banned', 0) == 1:
         return
 
-    current_ticket = mysql.get_current_ticket(sender_id)
+    current_ticket = ctx['current_ticket']
     if not current_ticket:
-        last_unresolved = mysql.get_last_unresolved_ticket(sender_id)
-        if last_unresolved and sender_id not in pending_issue_choice:
+        last_unresolved = ctx['last_unresolved']
+        if last_unresolved and store.get(issue_choice_key(sender_id)) is None:
             kb = InlineKeyboardMarkup()
             kb.row(
                 InlineKeyboardButton("🆕 New issue", callback_data=f"new_issue_{sender_id}"),
                 InlineKeyboardButton("🔁 Related to past ticket", callback_data=f"relate_issue_{sender_id}_{last_unresolved['id']}")
             )
-            bot.send_message(
+            outbound.send(
+                bot.send_message,
                 sender_id,
                 "Is this a *new issue* or related to a *past ticket*?",
                 parse_mode="Markdown",
@@ -410,26 +605,49 @@ def echo_all(message):
             )
             return
 
-    # Forward user message to support group
-    msg.fwd_handler(sender_id, bot, message)
+    # Past spam_protection messages without a reply from the team, stop forwarding
+    ticket_spam = spam_guard.count(sender_id, lambda _: (user or {}).get('open_ticket_spam'))
+    if msg.spam_handler_warning(bot, message, ticket_spam):
+        return
 
-    # Save / update ticket links
-    row = mysql.user_tables(sender_id)
-    msg_link = row.get('open_ticket_link')
-    if not current_ticket:
-        ticket_id = mysql.create_ticket(sender_id, msg_link)
-    else:
-        ticket_id = current_ticket['id']
-    mysql.mark_ticket_last_link(ticket_id, msg_link)
+    # Forward user message to support group; the rest runs once it's posted, without
+    # holding this worker while the post waits for the group's rate limit
+    updates.after(msg.relay_to_support(sender_id, bot, parts), ticket_posted, parts, ctx)
+
+def ticket_posted(link, parts, ctx):
+    """Second half of handle_private, once the user's message is in the support group."""
+    msg_link = link.result()
+    if not msg_link:
+        return
+    message = parts[0]
+    sender_id = message.chat.id
+    user = ctx['user']
+    current_ticket = ctx['current_ticket']
+
+    # Save language, ticket links (one transaction); the spam counter stays in memory
+    ticket_spam = spam_guard.hit(sender_id, seed=(user or {}).get('open_ticket_spam'))
+    ticket_id = mysql.apply_message_updates(
+        sender_id,
+        message.from_user.language_code,
+        msg_link,
+        ticket_id=current_ticket['id'] if current_ticket else None
+    )
+    for part in parts:
+        transcript.record(sender_id, transcript.IN, part, ticket_id=ticket_id)
+    msg.notify_submitted(bot, sender_id)
+    msg.spam_handler_blocked(bot, message, ticket_spam)
+    if not current_ticket and routing.enabled():
+        route_ticket(sender_id, message.from_user.language_code, msg_link)
 
     # If user said it's related to old ticket, post context
-    choice = pending_issue_choice.pop(sender_id, None)
+    choice = store.pop(issue_choice_key(sender_id))
     if choice:
         old_tid = choice.get("relate_ticket_id")
         if old_tid:
             old = mysql.get_ticket_by_id(old_tid)
             ctx_link = old.get('last_message_link') or old.get('first_message_link')
-            bot.send_message(
+            outbound.send_later(
+                bot.send_message,
                 config.support_chat,
                 f"🧷 *Context:* User `{sender_id}` says this is related to ticket `#{old_tid}`\nLast link: {ctx_link}",
                 parse_mode="Markdown",
@@ -438,38 +656,98 @@ def echo_all(message):
 
 # -------------------- Group Replies -------------------- #
 @bot.message_handler(func=lambda m: m.chat.id == config.support_chat,
-                     content_types=['text', 'photo', 'document'])
+                     content_types=msg.RELAY_TYPES)
 def group_reply_handler(message):
+    if media_groups.hold(message, group_reply, run=in_order(message)):
+        return
+    group_reply([message])
+
+def group_reply(parts):
+    """An agent's reply in the group (a message or an album) to a user's relayed message."""
+    message = next((m for m in parts if m.reply_to_message), parts[0])
     try:
         if not message.reply_to_message or '(#id' not in msg.msgCheck(message):
             return
 
         user_id = msg.getUserID(message)
         claimed_by = mysql.get_ticket_claim(user_id)
-        banned_status = mysql.user_tables(user_id)['banned']
 
         if claimed_by:
             if claimed_by != message.from_user.id:
-                bot.reply_to(message, "❌ This ticket is already claimed by another agent.")
+                outbound.reply_to(bot, message, "❌ This ticket is already claimed by another agent.")
             else:
-                bot.reply_to(message, "❌ You claimed this ticket. Continue in private chat with the bot.")
+                outbound.reply_to(bot, message, "❌ You claimed this ticket. Continue in private chat with the bot.")
             return
 
-        if banned_status == 1:
+        if mysql.is_banned(user_id):
             mysql.unban_user(user_id)
-            bot.reply_to(message,
+            outbound.reply_to(bot, message,
                          'ℹ️ *FYI: That user was banned.*\n_Un-banned and sent message!_',
                          parse_mode='Markdown')
 
-        msg.snd_handler(user_id, bot, message, message.text)
+        msg.snd_handler(user_id, bot, parts)
 
     except telebot.apihelper.ApiException:
-        bot.reply_to(message, '❌ Could not send the message to the user (maybe blocked the bot).')
+        outbound.reply_to(bot, message, '❌ Could not send the message to the user (maybe blocked the bot).')
     except Exception as e:
-        bot.reply_to(message, '❌ Invalid command or reply format.')
+        outbound.reply_to(bot, message, '❌ Invalid command or reply format.')
         print("⚠️ Error in group_reply_handler:", e)
 
 # -------------------- Claim Ticket & Close Button -------------------- #
+def off_shift(agent_id):
+    """Outside the agent's hours (agents without hours can always claim)."""
+    return getattr(config, 'claim_on_shift_only', True) and availability.status(agent_id) is False
+
+def announce_claim(chat_id, user_id, agent_id, agent_name, auto=False, reply_to=None):
+    """Post a claimed (or auto-assigned) ticket to the group with its buttons and DM the agent."""
+    bot_username = bot.get_me().username
+    kb = InlineKeyboardMarkup()
+    kb.row(
+        InlineKeyboardButton("➡️ Continue Ticket in Private", url=f"https://t.me/{bot_username}"),
+        InlineKeyboardButton("✅ Close Ticket", callback_data=f"close_ticket_{user_id}")
+    )
+
+    outbound.send_later(
+        bot.send_message,
+        chat_id,
+        text=(
+            f"🎯 *Ticket {'Assigned' if auto else 'Claimed'}!*\n\n"
+            f"👤 User ID: `{user_id}`\n"
+            f"🧑‍💼 {'Assigned to' if auto else 'Claimed by'}: {agent_name}\n\n"
+            f"_Choose an action below._"
+        ),
+        parse_mode="Markdown",
+        reply_markup=kb,
+        reply_to_message_id=reply_to
+    )
+
+    try:
+        outbound.send(
+            bot.send_message,
+            agent_id,
+            text=(
+                f"✅ You’ve {'been *assigned* the' if auto else '*claimed*'} ticket for user `{user_id}`.\n"
+                f"Send your replies *here* to reach the user privately.\n\n"
+                f"_You’ll also receive their replies here._"
+            ),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        print(f"⚠️ Could not DM agent: {e}")
+
+def route_ticket(user_id, language, msg_link):
+    """Hand a new ticket to the best available agent; without one it keeps its claim button."""
+    try:
+        agent_id = routing.route(user_id, language, mysql.claim_ticket_atomic)
+    except Exception as e:
+        print("⚠️ Ticket routing failed:", e)
+        return
+    if agent_id is None:
+        return
+    agent_name = f"[{profiles.first_name(agent_id, 'Agent')}](tg://user?id={agent_id})"
+    announce_claim(config.support_chat, user_id, agent_id, agent_name, auto=True,
+                   reply_to=int(msg_link.rsplit('/', 1)[1]))
+
 @bot.message_handler(commands=['claim_ticket'])
 def claim_ticket_handler(message):
     if message.chat.id != config.support_chat:
@@ -478,23 +756,22 @@ def claim_ticket_handler(message):
     if message.reply_to_message and '(#id' in msg.msgCheck(message):
         user_id = msg.getUserID(message)
         claimer_id = message.from_user.id
-        existing_claim = mysql.get_ticket_claim(user_id)
-
-        if existing_claim and existing_claim != claimer_id:
-            bot.reply_to(message, "❌ Ticket already claimed by another agent.")
-        elif existing_claim == claimer_id:
-            bot.reply_to(message, "ℹ️ You already claimed this ticket.")
+        if off_shift(claimer_id):
+            outbound.reply_to(bot, message, "⏰ You're off shift. Use /shift on in DM to take tickets now.")
+            return
+        owner, won = mysql.claim_ticket_atomic(user_id, claimer_id)
+
+        if won:
+            routing.router().claimed(claimer_id)
+            outbound.reply_to(bot, message, f"✅ You have claimed the ticket for user {user_id}.")
+        elif owner == claimer_id:
+            outbound.reply_to(bot, message, "ℹ️ You already claimed this ticket.")
+        elif owner:
+            outbound.reply_to(bot, message, "❌ Ticket already claimed by another agent.")
         else:
-            mysql.claim_ticket(user_id, claimer_id)
-            mysql.increment_claim(claimer_id)
-
-            ticket = mysql.get_current_ticket(user_id)
-            if ticket:
-                mysql.set_ticket_claim(ticket['id'], claimer_id)
-
-            bot.reply_to(message, f"✅ You have claimed the ticket for user {user_id}.")
+            outbound.reply_to(bot, message, "❌ No such user.")
     else:
-        bot.reply_to(message, "ℹ️ Please reply to the ticket message to claim it.")
+        outbound.reply_to(bot, message, "ℹ️ Please reply to the ticket message to claim it.")
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
@@ -537,11 +814,11 @@ def callback_handler(call):
         parts = data.split('_')
         uid = int(parts[2])
         if data.startswith("new_issue_"):
-            pending_issue_choice.pop(uid, None)
+            store.set(issue_choice_key(uid), {"relate_ticket_id": None}, ttl=ISSUE_CHOICE_TTL)
             bot.answer_callback_query(call.id, "New issue noted.")
         else:
             tid = int(parts[3])
-            pending_issue_choice[uid] = {"relate_ticket_id": tid}
+            store.set(issue_choice_key(uid), {"relate_ticket_id": tid}, ttl=ISSUE_CHOICE_TTL)
             bot.answer_callback_query(call.id, "Linked to past ticket.")
         return
 
@@ -552,67 +829,36 @@ def callback_handler(call):
             claimer_id = call.from_user.id
             claimer_name = f"[{call.from_user.first_name}](tg://user?id={claimer_id})"
 
-            existing_claim = mysql.get_ticket_claim(user_id)
             user_lang = mysql.get_user_language(user_id)
-            agent_langs = mysql.get_agent_languages(claimer_id)
+            agent = mysql.get_agent(claimer_id)
 
-            if agent_langs is None:
+            if agent is None:
                 bot.answer_callback_query(call.id, "❌ You are not a registered agent.", show_alert=True)
                 return
-            if not agent_langs:
+            if not agent['languages']:
                 bot.answer_callback_query(call.id, "❌ You have no languages listed. Contact admin.", show_alert=True)
                 return
-            if user_lang not in agent_langs:
+            if user_lang not in agent['languages']:
                 bot.answer_callback_query(call.id,
                                           f"❌ You cannot claim. Requires '{user_lang}'.",
                                           show_alert=True)
                 return
-            if existing_claim and existing_claim != claimer_id:
-                bot.answer_callback_query(call.id, "❌ Already claimed by another agent.", show_alert=True)
-                return
-            if existing_claim == claimer_id:
-                bot.answer_callback_query(call.id, "ℹ️ You already claimed this ticket.")
+            if off_shift(claimer_id):
+                bot.answer_callback_query(call.id, "⏰ You're off shift. Use /shift on in DM to take tickets now.",
+                                          show_alert=True)
                 return
 
-            mysql.claim_ticket(user_id, claimer_id)
-            mysql.increment_claim(claimer_id)
-            ticket = mysql.get_current_ticket(user_id)
-            if ticket:
-                mysql.set_ticket_claim(ticket['id'], claimer_id)
+            owner, won = mysql.claim_ticket_atomic(user_id, claimer_id)
+            if not won:
+                if owner == claimer_id:
+                    bot.answer_callback_query(call.id, "ℹ️ You already claimed this ticket.")
+                else:
+                    bot.answer_callback_query(call.id, "❌ Already claimed by another agent.", show_alert=True)
+                return
 
+            routing.router().claimed(claimer_id)
             bot.answer_callback_query(call.id, "✅ Ticket claimed!")
-
-            bot_username = bot.get_me().username
-            kb = InlineKeyboardMarkup()
-            kb.row(
-                InlineKeyboardButton("➡️ Continue Ticket in Private", url=f"https://t.me/{bot_username}"),
-                InlineKeyboardButton("✅ Close Ticket", callback_data=f"close_ticket_{user_id}")
-            )
-
-            bot.send_message(
-                chat_id=call.message.chat.id,
-                text=(
-                    f"🎯 *Ticket Claimed!*\n\n"
-                    f"👤 User ID: `{user_id}`\n"
-                    f"🧑‍💼 Claimed by: {claimer_name}\n\n"
-                    f"_Choose an action below._"
-                ),
-                parse_mode="Markdown",
-                reply_markup=kb
-            )
-
-            try:
-                bot.send_message(
-                    chat_id=claimer_id,
-                    text=(
-                        f"✅ You’ve *claimed* ticket for user `{user_id}`.\n"
-                        f"Send your replies *here* to reach the user privately.\n\n"
-                        f"_You’ll also receive their replies here._"
-                    ),
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                print(f"⚠️ Could not DM agent: {e}")
+            announce_claim(call.message.chat.id, user_id, claimer_id, claimer_name)
 
         except Exception as e:
             print(f"❌ claim_ticket callback error: {e} | data={data}")
@@ -639,19 +885,19 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Only claiming agent or admin can close.", show_alert=True)
                 return
 
+            if not mysql.close_ticket_atomic(ticket['id'], user_id):
+                bot.answer_callback_query(call.id, "ℹ️ Ticket already closed.")
+                return
             if current_claimer:
-                mysql.increment_resolved_and_pay(current_claimer)
-
-            mysql.close_ticket(ticket['id'])
-            mysql.reset_user_ticket_state(user_id)
+                routing.router().release(current_claimer)
 
             bot.answer_callback_query(call.id, "✅ Ticket closed.")
-            bot.send_message(call.message.chat.id,
-                             f"✅ Ticket `{ticket['id']}` for `{user_id}` has been closed.",
-                             parse_mode="Markdown")
+            outbound.send_later(bot.send_message, call.message.chat.id,
+                                f"✅ Ticket `{ticket['id']}` for `{user_id}` has been closed.",
+                                parse_mode="Markdown")
 
             try:
-                bot.send_message(user_id, "✅ Your ticket has been closed. If you need more help, just message me again.")
+                outbound.send(bot.send_message, user_id, "✅ Your ticket has been closed. If you need more help, just message me again.")
             except Exception as e:
                 print("⚠️ Could not notify user:", e)
 
@@ -663,26 +909,90 @@ def callback_handler(call):
 @bot.message_handler(commands=['mytickets'])
 def cmd_mytickets(message):
     if dm_only(message):
-        bot.reply_to(message, "📬 Please DM me for this command.")
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
         return
     if not is_agent(message.from_user.id):
         return
-    with mysql.getConnection().cursor() as c:
-        c.execute("SELECT userid, open_ticket_link FROM users WHERE claimed_by=%s AND open_ticket=1",
-                  (message.from_user.id,))
-        rows = c.fetchall()
+    rows = mysql.get_agent_active_tickets(message.from_user.id)
     if not rows:
-        bot.reply_to(message, "ℹ️ You have no active tickets.")
+        outbound.reply_to(bot, message, "ℹ️ You have no active tickets.")
         return
     text = "🎟️ *Your active tickets:*\n\n"
     for r in rows:
         text += f"• `{r['userid']}` — [link]({r['open_ticket_link']})\n"
-    bot.reply_to(message, text, parse_mode="Markdown", disable_web_page_preview=True)
+    outbound.reply_to(bot, message, text, parse_mode="Markdown", disable_web_page_preview=True)
+
+@bot.message_handler(commands=['shift'])
+def cmd_shift(message):
+    if dm_only(message):
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    parts = message.text.split()
+    modes = {'on': True, 'off': False, 'auto': None}
+    if len(parts) != 2 or parts[1].lower() not in modes:
+        outbound.reply_to(bot, message, "Usage: `/shift on`, `/shift off` or `/shift auto` (follow your hours)",
+                          parse_mode="Markdown")
+        return
+    on_shift = modes[parts[1].lower()]
+    mysql.set_agent_shift(message.from_user.id, on_shift)
+    availability.set_override(message.from_user.id, on_shift)
+    sync_shifts()
+    outbound.reply_to(bot, message, shift_status(message.from_user.id))
+
+def shift_status(agent_id):
+    status = availability.status(agent_id)
+    if status is None:
+        return "⚪️ No hours set: you only get tickets you claim. Set them with /availability or use /shift on."
+    return ("🟢 You're on shift: new tickets in your languages will be assigned to you." if status else
+            "⚪️ You're off shift: no tickets will be assigned to you.")
+
+@bot.message_handler(commands=['availability'])
+def cmd_availability(message):
+    if dm_only(message):
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    parts = message.text.split(' ', 1)
+    if len(parts) < 2:
+        hours = (mysql.get_agent_profile(message.from_user.id) or {}).get('availability') or '—'
+        outbound.reply_to(bot, message,
+                          f"⏰ Your hours: `{hours}`\n{shift_status(message.from_user.id)}\n\n"
+                          f"Change them with e.g. `/availability Mon-Fri 9:00-17:00 Europe/Berlin`",
+                          parse_mode="Markdown")
+        return
+    try:
+        tz, intervals = availability.parse(parts[1][:255])
+    except ValueError as e:
+        outbound.reply_to(bot, message, f"❌ {e}")
+        return
+    mysql.set_agent_availability(message.from_user.id, tz, intervals)
+    sync_routing()
+    outbound.reply_to(bot, message, f"✅ Hours set to `{availability.describe(tz, intervals)}`\n"
+                                    f"{shift_status(message.from_user.id)}", parse_mode="Markdown")
+
+@bot.message_handler(commands=['transcript'])
+def cmd_transcript(message):
+    uid = message.from_user.id
+    if not (is_agent(uid) or is_admin(uid)):
+        return
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].lstrip('#').isdigit():
+        outbound.reply_to(bot, message, "Usage: /transcript <ticket_id>")
+        return
+    ticket_id = int(parts[1].lstrip('#'))
+    rows = mysql.get_ticket_transcript(ticket_id)
+    if not rows:
+        outbound.reply_to(bot, message, f"ℹ️ No messages recorded for ticket #{ticket_id}.")
+        return
+    msg.send_chunked(bot, message.chat.id, f"🗂 Ticket #{ticket_id}\n\n", [msg.transcript_line(r) for r in rows])
 
 @bot.message_handler(commands=['whoami'])
 def cmd_whoami(message):
     if dm_only(message):
-        bot.reply_to(message, "📬 Please DM me for this command.")
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
         return
     if not is_agent(message.from_user.id):
         return
@@ -690,49 +1000,47 @@ def cmd_whoami(message):
     profile = mysql.get_agent_profile(message.from_user.id) or {}
     full_name    = profile.get('full_name') or f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip()
     languages    = (profile.get('languages') or '').split(',') if profile.get('languages') else []
-    availability = profile.get('availability') or '—'
+    hours        = profile.get('availability') or '—'
     rate         = profile.get('commission_rate') or 0
     earnings     = profile.get('total_earnings') or 0
     claimed      = profile.get('tickets_claimed') or 0
     resolved     = profile.get('tickets_resolved') or 0
 
-    with mysql.getConnection().cursor() as c:
-        c.execute("SELECT COUNT(*) AS cnt FROM users WHERE claimed_by=%s AND open_ticket=1",
-                  (message.from_user.id,))
-        active = c.fetchone()['cnt']
+    active = mysql.count_agent_active_tickets(message.from_user.id)
 
     text = (
         f"🧑‍💼 *Agent Profile*\n"
         f"Name: `{full_name}`\n"
         f"ID: `{message.from_user.id}`\n"
         f"Languages: `{', '.join([l.strip() for l in languages]) or 'none'}`\n"
-        f"Availability: `{availability}`\n"
+        f"Availability: `{hours}`\n"
+        f"Shift: {shift_status(message.from_user.id)}\n"
         f"Commission rate: `{rate}`\n"
         f"Total earnings: `{earnings}`\n"
         f"Tickets claimed: `{claimed}` | resolved: `{resolved}` | active: `{active}`"
     )
-    bot.reply_to(message, text, parse_mode="Markdown")
+    outbound.reply_to(bot, message, text, parse_mode="Markdown")
 
 @bot.message_handler(commands=['setlang'])
 def cmd_setlang(message):
     if dm_only(message):
-        bot.reply_to(message, "📬 Please DM me for this command.")
+        outbound.reply_to(bot, message, "📬 Please DM me for this command.")
         return
     if not is_agent(message.from_user.id):
         return
     parts = message.text.split(' ', 1)
     if len(parts) < 2:
-        bot.reply_to(message, "Usage: `/setlang en,es`", parse_mode="Markdown")
+        outbound.reply_to(bot, message, "Usage: `/setlang en,es`", parse_mode="Markdown")
         return
     raw = parts[1]
     try:
         normalized = normalize_language_input(raw)
     except ValueError as e:
-        bot.reply_to(message, f"❌ {e}", parse_mode="Markdown")
+        outbound.reply_to(bot, message, f"❌ {e}", parse_mode="Markdown")
         return
-    with mysql.getConnection().cursor() as c:
-        c.execute("UPDATE agents SET languages=%s WHERE user_id=%s", (normalized, message.from_user.id))
-    bot.reply_to(message, f"✅ Languages updated to `{normalized}`", parse_mode="Markdown")
+    mysql.set_agent_languages(message.from_user.id, normalized)
+    routing.router().update(message.from_user.id, languages=mysql.get_agent(message.from_user.id)['languages'])
+    outbound.reply_to(bot, message, f"✅ Languages updated to `{normalized}`", parse_mode="Markdown")
 
 # -------------------- ADMIN COMMANDS -------------------- #
 @bot.message_handler(commands=['set_commission'])
@@ -741,16 +1049,16 @@ def cmd_set_commission(message):
         return
     parts = message.text.split()
     if len(parts) != 3:
-        bot.reply_to(message, "Usage: `/set_commission <agent_id> <rate>`", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "Usage: `/set_commission <agent_id> <rate>`", parse_mode='Markdown')
         return
     try:
         agent_id = int(parts[1])
         rate = float(parts[2])
     except ValueError:
-        bot.reply_to(message, "❌ Invalid args. Example: `/set_commission 123456789 0.15`", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "❌ Invalid args. Example: `/set_commission 123456789 0.15`", parse_mode='Markdown')
         return
     mysql.set_commission(agent_id, rate)
-    bot.reply_to(message, f"✅ Commission rate for `{agent_id}` set to `{rate}`")
+    outbound.reply_to(bot, message, f"✅ Commission rate for `{agent_id}` set to `{rate}`")
 
 @bot.message_handler(commands=['agent_stat'])
 def cmd_agent_stat(message):
@@ -758,16 +1066,16 @@ def cmd_agent_stat(message):
         return
     parts = message.text.split()
     if len(parts) != 2:
-        bot.reply_to(message, "Usage: `/agent_stat <agent_id>`", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "Usage: `/agent_stat <agent_id>`", parse_mode='Markdown')
         return
     try:
         agent_id = int(parts[1])
     except ValueError:
-        bot.reply_to(message, "❌ Invalid agent_id.", parse_mode='Markdown')
+        outbound.reply_to(bot, message, "❌ Invalid agent_id.", parse_mode='Markdown')
         return
     stat = mysql.get_agent_stats(agent_id)
     if not stat:
-        bot.reply_to(message, "❌ Agent not found.")
+        outbound.reply_to(bot, message, "❌ Agent not found.")
         return
     text = (
         f"📊 *Agent Stats*\n"
@@ -776,9 +1084,10 @@ def cmd_agent_stat(message):
         f"Commission: `{stat['commission_rate']}`\n"
         f"Tickets claimed: `{stat['tickets_claimed']}`\n"
         f"Tickets resolved: `{stat['tickets_resolved']}`\n"
-        f"Total earnings: `{stat['total_earnings']}`"
+        f"Total earnings: `{stat['total_earnings']}`\n"
+        f"Last 7 days: `{stat['week_resolved']}` resolved, `{stat['week_earnings']}` earned"
     )
-    bot.reply_to(message, text, parse_mode='Markdown')
+    outbound.reply_to(bot, message, text, parse_mode='Markdown')
 
 @bot.message_handler(commands=['report_summary'])
 def cmd_report_summary(message):
@@ -798,13 +1107,56 @@ def cmd_report_summary(message):
         "*Top agents by resolved:*\n"
         f"{top_lines}"
     )
-    bot.reply_to(message, text, parse_mode='Markdown', disable_web_page_preview=True)
+    outbound.reply_to(bot, message, text, parse_mode='Markdown', disable_web_page_preview=True)
+
+@bot.message_handler(commands=['dbstats', 'stats'])
+def cmd_dbstats(message):
+    if not is_admin(message.from_user.id):
+        return
+    s = mysql.pool_stats()
+    text = (
+        "🗄 *DB Pool*\n"
+        f"Open: `{s['open']}/{s['size']}` | in use: `{s['in_use']}` | idle: `{s['idle']}`\n"
+        f"Checkouts: `{s['checkouts']}` | waits: `{s['waits']}` | timeouts: `{s['timeouts']}`\n"
+        f"Checkout avg: `{s['checkout_avg_ms']} ms` | max: `{s['checkout_max_ms']} ms`\n"
+        f"Recycled: `{s['recycled']}` | discarded: `{s['discarded']}`"
+    )
+    o = outbound.stats()
+    text += (
+        "\n\n📤 *Outbound queue*\n"
+        f"Sent: `{o['sent']}` | queued: `{o['queued']}` | avg wait: `{o['wait_avg_ms']} ms`\n"
+        f"429 retries: `{o['retried_429']}` | failed: `{o['failed']}` | typing dropped: `{o['actions_dropped']}`"
+    )
+    u = updates.stats()
+    busiest = ', '.join(f"{k}×{n}" for k, n in u['busiest']) or '-'
+    text += (
+        "\n\n📥 *Incoming updates*\n"
+        f"Done: `{u['done']}` | failed: `{u['failed']}` | queued: `{u['queued']}` (max `{u['max_queued']}`)\n"
+        f"Users queued: `{u['keys']}` on `{u['workers']}` workers | deepest user queue: `{u['max_key_depth']}`\n"
+        f"Wait avg: `{u['wait_avg_ms']} ms` | max: `{u['wait_max_ms']} ms` | run avg: `{u['run_avg_ms']} ms`\n"
+        f"Backlogged: `{busiest}`"
+    )
+    t = transcript.stats()
+    text += (
+        "\n\n🗂 *Transcripts*\n"
+        f"Recorded: `{t['recorded']}` | written: `{t['written']}` | buffered: `{t['buffered']}` | dropped: `{t['dropped']}`"
+    )
+    r = routing.stats()
+    text += (
+        "\n\n🧭 *Routing*\n"
+        f"Assigned: `{r['assigned']}` | to claim button: `{r['fallback']}`\n"
+        f"Agents: `{r['agents']}` | on shift: `{r['on_shift']}` | free: `{r['eligible']}` | open tickets: `{r['active']}`"
+    )
+    for backend, q in search.stats().items():
+        text += (f"\n🔎 Search ({backend}): `{q['n']}` recent | avg `{q['avg_ms']} ms` | "
+                 f"p95 `{q['p95_ms']} ms` | max `{q['max_ms']} ms`")
+    outbound.reply_to(bot, message, text, parse_mode='Markdown')
 
 # -------------------- Utility Debug -------------------- #
 @bot.message_handler(commands=['groupid'])
 def get_group_id(message):
     print(f"Received /groupid from chat: {message.chat.id} | Type: {message.chat.type}")
-    bot.reply_to(message, f"👥 Group ID: `{message.chat.id}`", parse_mode='Markdown')
+    outbound.reply_to(bot, message, f"👥 Group ID: `{message.chat.id}`", parse_mode='Markdown')
 
 @bot.message_handler(func=lambda m: True)
 def log_chat_id(message):
@@ -812,9 +1164,11 @@ def log_chat_id(message):
 
 # -------------------- Run Bot -------------------- #
 print("Telegram Support Bot started...")
-while True:
-    try:
-        bot.polling(none_stop=True)
-    except Exception as e:
-        print(f"⚠️ Bot crashed with error: {e}")
-        time.sleep(15)
+try:
+    if getattr(config, 'run_mode', 'polling') == 'webhook':
+        webhook_server.serve(bot)
+    else:
+        bot.remove_webhook()
+        updates.poll(bot)
+finally:
+    transcript.flush()      # rows still buffered when the bot stops
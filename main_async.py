@@ -0,0 +1,1018 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : main_async.py         #
+# --------------------------------------------- #
+# asyncio runtime: same commands and ticket flow as main.py, served by
+# AsyncTeleBot on one event loop with an aiomysql pool. Run either this
+# or main.py, not both. Not ported: /search and /dbstats (they report on
+# main.py's thread pools and its local search index).
+import asyncio
+import config
+from contextlib import asynccontextmanager
+from resources import migrations
+from resources import state
+from resources import async_mysql_handler as amysql
+from resources import async_msg_handler as amsg
+from resources import async_outbound as aout
+from resources import async_conversation as aconv
+from resources import markups_handler as markup
+from resources import transcript
+from resources import media_groups
+from resources import routing
+from resources import availability
+from resources import spam_guard
+from resources import msg_handler as msg
+from resources.utils import normalize_language_input
+
+from enum import IntEnum
+from datetime import datetime, timedelta
+import arrow
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+bot = AsyncTeleBot(config.token)
+
+# Runtime memory (in the state backend, shared when several processes run)
+store = state.backend()
+ISSUE_CHOICE_TTL = getattr(config, 'issue_choice_ttl', 3600)
+
+def issue_choice_key(uid):
+    return f"issue_choice:{uid}"    # {"relate_ticket_id": int or None}
+
+user_locks = {}     # {user_id: [asyncio.Lock, handlers holding or waiting for it]}
+
+# -------------------- Middleware -------------------- #
+class ProfileMiddleware(BaseMiddleware):
+    """Keep the profile store fed from every incoming update's sender."""
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, update, data):
+        try:
+            await amsg.remember(update.from_user)
+        except Exception as e:
+            print("⚠️ Failed to store profile:", e)
+
+    async def post_process(self, update, data, exception):
+        pass
+
+bot.setup_middleware(ProfileMiddleware())
+
+# -------------------- Helpers -------------------- #
+def is_agent(uid):
+    return amysql.is_agent(uid)
+
+def is_admin(uid):
+    return uid in getattr(config, 'admin_ids', [])
+
+def dm_only(message):
+    return message.chat.type != 'private'
+
+def target_from(message):
+    """User id from a replied-to ticket message or the command argument."""
+    if message.reply_to_message and '(#id' in msg.msgCheck(message):
+        return msg.getUserID(message)
+    ref = msg.getReferrer(message.text)
+    if ref:
+        try:
+            return int(ref)
+        except ValueError:
+            return None
+    return None
+
+def build_lang_kb():
+    kb = InlineKeyboardMarkup()
+    row = []
+    for code, label in config.LANG_OPTIONS.items():
+        row.append(InlineKeyboardButton(label, callback_data=f"user_set_lang_{code}"))
+        if len(row) == 2:
+            kb.row(*row)
+            row = []
+    if row:
+        kb.row(*row)
+    return kb
+
+async def ensure_user_language(message, saved=None):
+    """Ensure user has a language in DB; if not, try TG code or prompt."""
+    uid = message.from_user.id
+    if saved is None:
+        saved = await amysql.get_user_language(uid)
+    if saved:
+        return True
+
+    tg_code = getattr(message.from_user, 'language_code', None)
+    if tg_code and tg_code in config.LANG_OPTIONS:
+        await amysql.save_user_language(uid, tg_code)
+        return True
+
+    await aout.send(bot.send_message, uid, "🌐 Please choose your language:", reply_markup=build_lang_kb())
+    return False
+
+async def send_chunked(chat_id, header, lines, limit=4000, **kwargs):
+    text = header
+    for line in lines:
+        if len(text) + len(line) > limit and text != header:
+            await aout.send(bot.send_message, chat_id, text, **kwargs)
+            text = header
+        text += line
+    await aout.send(bot.send_message, chat_id, text, **kwargs)
+
+# -------------------- Agent Onboarding -------------------- #
+class Onboarding(IntEnum):
+    NAME = 1
+    LANGUAGES = 2
+    AVAILABILITY = 3
+
+async def onboarding_gave_up(message):
+    await aout.send(bot.send_message, message.from_user.id,
+                    "ℹ️ Agent sign-up stopped after several invalid answers. Send /become_agent to start again.")
+
+# Same flow id as main.py's, so a sign-up carries over between the two runtimes
+onboarding = aconv.Flow(1, ttl=getattr(config, 'onboarding_ttl', 86400),
+                        max_retries=getattr(config, 'onboarding_retries', 3), gave_up=onboarding_gave_up)
+
+ONBOARDING_QUESTIONS = {
+    Onboarding.NAME:         "📝 Please enter your *full name* (/cancel to stop):",
+    Onboarding.LANGUAGES:    "🌍 What languages do you speak?",
+    Onboarding.AVAILABILITY: "⏰ When are you available? (e.g. `Mon-Fri 9:00-17:00 Europe/Berlin`; "
+                             f"without a time zone it's `{config.time_zone}`)",
+}
+
+async def ask(user_id, state, answers=None):
+    """Send the question for `state`; returns the (state, answers) a step handler hands back."""
+    await aout.send(bot.send_message, user_id, ONBOARDING_QUESTIONS[state], parse_mode="Markdown")
+    return state, answers
+
+@bot.message_handler(commands=['become_agent'])
+async def handle_agent_request(message):
+    if dm_only(message):
+        return
+    user_id = message.from_user.id
+    if is_agent(user_id):
+        await aout.reply_to(bot, message, "ℹ️ You're already an agent.")
+        return
+    if await amysql.get_current_ticket(user_id):
+        await aout.reply_to(bot, message, "ℹ️ Please wait until your open support ticket is closed.")
+        return
+    await onboarding.start(user_id, Onboarding.NAME)
+    await ask(user_id, Onboarding.NAME)
+
+@bot.message_handler(commands=['cancel'])
+async def cmd_cancel(message):
+    if dm_only(message):
+        return
+    if await aconv.cancel(message.from_user.id):
+        await aout.reply_to(bot, message, "❌ Cancelled.")
+    else:
+        await aout.reply_to(bot, message, "ℹ️ Nothing to cancel.")
+
+@onboarding.step(Onboarding.NAME)
+async def collect_name(message, answers):
+    if not message.text:
+        return await ask(message.from_user.id, Onboarding.NAME, answers)
+    answers['full_name'] = message.text.strip()[:100]
+    return await ask(message.from_user.id, Onboarding.LANGUAGES, answers)
+
+@onboarding.step(Onboarding.LANGUAGES)
+async def collect_languages(message, answers):
+    languages = (message.text or '').strip()[:255]
+    try:
+        normalize_language_input(languages)
+    except ValueError as e:
+        await aout.send(bot.send_message, message.from_user.id,
+                        f"❌ {e}\n\nPlease enter valid languages (e.g. English, German).")
+        return Onboarding.LANGUAGES, answers
+    answers['languages'] = languages
+    return await ask(message.from_user.id, Onboarding.AVAILABILITY, answers)
+
+@onboarding.step(Onboarding.AVAILABILITY)
+async def finalize_request(message, answers):
+    if not message.text:
+        return await ask(message.from_user.id, Onboarding.AVAILABILITY, answers)
+    user_id = message.from_user.id
+    try:
+        hours = availability.describe(*availability.parse(message.text[:255]))
+    except ValueError as e:
+        await aout.send(bot.send_message, user_id,
+                        f"❌ {e}\n\nPlease enter your hours again (e.g. Mon-Fri 9:00-17:00).")
+        return Onboarding.AVAILABILITY, answers
+    full_name, languages = answers['full_name'], answers['languages']
+
+    await amysql.save_pending_agent(user_id, full_name, normalize_language_input(languages), hours)
+    await aout.send(bot.send_message, user_id,
+                    "✅ Your request has been submitted for review. Please wait for admin approval.")
+
+    text = (
+        f"📥 *New Agent Request*\n\n"
+        f"👤 Name: `{full_name}`\n"
+        f"🆔 User ID: `{user_id}`\n"
+        f"🌍 Languages: `{languages}`\n"
+        f"⏰ Availability: `{hours}`"
+    )
+    approval_markup = InlineKeyboardMarkup()
+    approval_markup.add(
+        InlineKeyboardButton("✅ Approve", callback_data=f"approve_agent_{user_id}"),
+        InlineKeyboardButton("❌ Reject",  callback_data=f"reject_agent_{user_id}")
+    )
+    await aout.send(bot.send_message, config.support_chat, text, parse_mode='Markdown', reply_markup=approval_markup)
+
+# -------------------- User Commands -------------------- #
+@bot.message_handler(commands=['start'])
+async def cmd_start(message):
+    if message.chat.type == 'private':
+        await aout.send(
+            bot.send_message,
+            message.chat.id,
+            config.text_messages['start'].format(message.from_user.first_name) + msg.repo(),
+            parse_mode='Markdown',
+            disable_web_page_preview=True,
+            reply_markup=markup.faqButton()
+        )
+        await amysql.start_bot(message.chat.id)
+    else:
+        await aout.reply_to(bot, message, "Please send me a PM if you'd like to talk to the Support Team.")
+
+@bot.message_handler(commands=['faq'])
+async def cmd_faq(message):
+    if message.chat.type == 'private':
+        await aout.reply_to(bot, message, config.text_messages['faqs'], parse_mode='Markdown',
+                            disable_web_page_preview=True)
+
+@bot.message_handler(commands=['set_language', 'setlang_user'])
+async def cmd_set_language(message):
+    if message.chat.type != 'private':
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    await aout.send(bot.send_message, message.chat.id, "🌐 Select your language:", reply_markup=build_lang_kb())
+
+# -------------------- Ticket Lists & Admin Actions -------------------- #
+@bot.message_handler(commands=['tickets', 't'])
+async def cmd_tickets(message):
+    if message.chat.id != config.support_chat:
+        return
+    rows = await amysql.list_open_tickets()
+    coverage = {}   # {language: agents on shift speaking it}
+    for r in rows:
+        lang = r['language'] or config.DEFAULT_LANG
+        if lang not in coverage:
+            coverage[lang] = len(availability.on_shift_now(lang))
+    uncovered = message.text.split()[1:2] == ['uncovered']
+    if uncovered:
+        rows = [r for r in rows if not coverage[r['language'] or config.DEFAULT_LANG]]
+    if not rows:
+        await aout.reply_to(bot, message, "ℹ️ No open tickets without an agent on shift." if uncovered else
+                                          "ℹ️ Great job, you answered all your tickets!")
+        return
+
+    now = arrow.now()
+    lines = []
+    for r in rows:
+        lang = r['language'] or config.DEFAULT_LANG
+        ot_time = r['open_ticket_time']
+        if ot_time:
+            time_since = now.shift(seconds=-(datetime.now() - ot_time).total_seconds()).humanize()
+        else:
+            time_since = "just now"
+        alert = ' ↳ ⚠️ ' if ot_time and (datetime.now() - ot_time) > timedelta(hours=config.open_ticket_emoji) else ' ↳ '
+        shift = f"🟢 {coverage[lang]} on shift" if coverage[lang] else "🔴 nobody on shift"
+        lines.append("• [{0}](tg://user?id={1}) (`{1}`)\n{4}_{2}_ · `{5}` {6} [➜ Go to msg]({3})\n".format(
+            msg.display_name(r['first_name'], r['last_name']),
+            r['userid'], time_since, r['open_ticket_link'], alert, lang, shift
+        ))
+    title = '📨 *Open tickets without an agent on shift:*\n\n' if uncovered else '📨 *Open tickets:*\n\n'
+    await send_chunked(message.chat.id, title, lines, parse_mode='Markdown')
+
+@bot.message_handler(commands=['resolve'])
+async def cmd_resolve(message):
+    if message.chat.id != config.support_chat or not is_agent(message.from_user.id):
+        return
+    user_id = target_from(message)
+    if not user_id:
+        await aout.reply_to(bot, message, "Reply to the ticket or `/resolve <user_id>`.", parse_mode='Markdown')
+        return
+
+    ticket = await amysql.get_current_ticket(user_id)
+    if not ticket:
+        await aout.reply_to(bot, message, "❌ No open ticket for that user.")
+        return
+    claimer = ticket['claimed_by']
+    if claimer and claimer != message.from_user.id and not is_admin(message.from_user.id):
+        await aout.reply_to(bot, message, "❌ Only the claiming agent (or an admin) can resolve this ticket.")
+        return
+
+    await amysql.mark_ticket_resolved(ticket['id'])
+    await aout.reply_to(bot, message, f"✅ Ticket `{ticket['id']}` for `{user_id}` marked *resolved*.",
+                        parse_mode='Markdown')
+
+@bot.message_handler(commands=['close', 'c'])
+async def cmd_close(message):
+    if message.chat.id != config.support_chat:
+        return
+    user_id = target_from(message)
+    if not user_id:
+        await aout.reply_to(bot, message, "ℹ️ Reply to the ticket message or use `/close <user_id>`.",
+                            parse_mode='Markdown')
+        return
+
+    ticket = await amysql.get_current_ticket(user_id)
+    if not ticket:
+        await aout.reply_to(bot, message, '❌ That user has no open ticket...')
+        return
+    if not is_admin(message.from_user.id) and ticket['resolved'] == 0:
+        await aout.reply_to(bot, message, "❌ Mark it resolved first with `/resolve <user_id>`.", parse_mode='Markdown')
+        return
+
+    if not await amysql.close_ticket_atomic(ticket['id'], user_id):
+        await aout.reply_to(bot, message, 'ℹ️ That ticket was already closed.')
+        return
+    if ticket['claimed_by']:
+        routing.router().release(ticket['claimed_by'])
+    await aout.reply_to(bot, message, f'✅ Ticket `{ticket["id"]}` closed for `{user_id}`.', parse_mode='Markdown')
+
+@bot.message_handler(commands=['banned'])
+async def cmd_banned(message):
+    if message.chat.id != config.support_chat:
+        return
+    rows = await amysql.list_banned_users()
+    if not rows:
+        await aout.reply_to(bot, message, "ℹ️ Great news, nobody got banned... Yet.")
+        return
+    lines = [
+        "• [{0}](tg://user?id={1}) (`{1}`)\n[➜ Go to last msg]({2})\n".format(
+            msg.display_name(r['first_name'], r['last_name']), r['userid'], r['open_ticket_link']
+        )
+        for r in rows
+    ]
+    await send_chunked(message.chat.id, '⛔️ *Banned users:*\n\n', lines, parse_mode='Markdown')
+
+@bot.message_handler(commands=['ban', 'unban'])
+async def cmd_ban(message):
+    if message.chat.id != config.support_chat:
+        return
+    banning = message.text.split()[0].lstrip('/').split('@')[0] == 'ban'
+    target_id = target_from(message)
+    if not target_id:
+        await aout.reply_to(bot, message, 'ℹ️ Reply to a message or mention a `User ID`.', parse_mode='Markdown')
+        return
+
+    data = await amysql.user_tables(target_id)
+    if data is None:
+        await aout.reply_to(bot, message, '❌ Are you sure I interacted with that user before...?')
+        return
+    if banning:
+        if data['banned'] == 1:
+            await aout.reply_to(bot, message, '❌ That user is already banned...')
+            return
+        await amysql.ban_user(target_id)
+        await amysql.reset_user_ticket_state(target_id)
+        await aout.reply_to(bot, message, '✅ Ok, banned that user!')
+    else:
+        if data['banned'] == 0:
+            await aout.reply_to(bot, message, '❌ That user is already un-banned...')
+            return
+        await amysql.unban_user(target_id)
+        await aout.reply_to(bot, message, '✅ Ok, un-banned that user!')
+
+# -------------------- Private Messages (Users & Agents) -------------------- #
+async def after_album(media_group_id, handler):
+    """Handle an album once its parts had media_group_wait seconds to arrive."""
+    await asyncio.sleep(media_groups.wait())
+    album = media_groups.take(media_group_id)
+    if album:
+        try:
+            await handler(album)
+        except Exception as e:
+            print("⚠️ Failed to handle album:", e)
+
+def hold_album(message, handler):
+    if not message.media_group_id:
+        return False
+    if media_groups.add(message):
+        asyncio.create_task(after_album(message.media_group_id, handler))
+    return True
+
+@bot.message_handler(
+    func=lambda m: m.chat.type == 'private' and not (getattr(m, 'text', '') or '').startswith('/'),
+    content_types=msg.RELAY_TYPES
+)
+async def echo_all(message):
+    if hold_album(message, handle_private):
+        return
+    for album in media_groups.take_chat(message.chat.id):    # an album still waiting goes first
+        await handle_private(album)
+    await handle_private([message])
+
+@asynccontextmanager
+async def user_lock(user_id):
+    """Held while one message (or album) of the user is handled; the next one waits its turn."""
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user_id]
+
+async def handle_private(parts):
+    """
+    A private message, or all parts of an album, from a user or an agent. Each
+    update runs in its own task, so a user's messages are handled one at a time:
+    otherwise two could read the same context and both open a ticket.
+    """
+    async with user_lock(parts[0].chat.id):
+        await _handle_private(parts)
+
+async def _handle_private(parts):
+    message = parts[0]
+    sender_id = message.chat.id
+    ctx = await amysql.load_message_context(sender_id)
+    user = ctx['user'] or {}
+
+    # ---- IN THE MIDDLE OF /become_agent (or another conversation) ----
+    if not is_agent(sender_id) and await aconv.dispatch(message, ctx['conversation']):
+        return
+
+    # ---- AGENT DM FLOW ----
+    if is_agent(sender_id):
+        target_user = await amysql.get_claimed_ticket_by_agent(sender_id)
+        if target_user:
+            await amsg.snd_handler(target_user, bot, parts)
+        else:
+            await aout.reply_to(bot, message, "You haven't claimed any ticket. Claim one in the group first.")
+        return
+
+    # ---- USER FLOW ----
+    # ensure language ONLY for users
+    if not await ensure_user_language(message, saved=user.get('language') or 'en'):
+        return
+
+    claimed_by_agent = user.get('claimed_by')
+    if claimed_by_agent:
+        await amsg.snd_to_agent(claimed_by_agent, bot, parts)
+        return
+    if user.get('banned', 0) == 1:
+        return
+
+    current_ticket = ctx['current_ticket']
+    last_unresolved = ctx['last_unresolved']
+    if not current_ticket and last_unresolved and store.get(issue_choice_key(sender_id)) is None:
+        kb = InlineKeyboardMarkup()
+        kb.row(
+            InlineKeyboardButton("🆕 New issue", callback_data=f"new_issue_{sender_id}"),
+            InlineKeyboardButton("🔁 Related to past ticket", callback_data=f"relate_issue_{sender_id}_{last_unresolved['id']}")
+        )
+        await aout.send(bot.send_message, sender_id, "Is this a *new issue* or related to a *past ticket*?",
+                        parse_mode="Markdown", reply_markup=kb)
+        return
+
+    msg_link = await amsg.relay_to_support(sender_id, bot, parts)
+    if not msg_link:
+        return
+    spam_guard.hit(sender_id, seed=user.get('open_ticket_spam'))
+    ticket_id = await amysql.apply_message_updates(sender_id, message.from_user.language_code, msg_link,
+                                                   ticket_id=current_ticket['id'] if current_ticket else None)
+    for part in parts:
+        transcript.record(sender_id, transcript.IN, part, ticket_id=ticket_id)
+    await amsg.notify_submitted(bot, sender_id)
+    if not current_ticket and routing.enabled():
+        await route_ticket(sender_id, message.from_user.language_code, msg_link)
+
+    choice = store.pop(issue_choice_key(sender_id))
+    if choice and choice.get("relate_ticket_id"):
+        old_tid = choice["relate_ticket_id"]
+        old = await amysql.get_ticket_by_id(old_tid)
+        ctx_link = old.get('last_message_link') or old.get('first_message_link')
+        aout.send_later(
+            bot.send_message,
+            config.support_chat,
+            f"🧷 *Context:* User `{sender_id}` says this is related to ticket `#{old_tid}`\nLast link: {ctx_link}",
+            parse_mode="Markdown",
+            disable_web_page_preview=True
+        )
+
+# -------------------- Group Replies -------------------- #
+@bot.message_handler(func=lambda m: m.chat.id == config.support_chat,
+                     content_types=msg.RELAY_TYPES)
+async def group_reply_handler(message):
+    if hold_album(message, group_reply):
+        return
+    await group_reply([message])
+
+async def group_reply(parts):
+    message = next((m for m in parts if m.reply_to_message), parts[0])
+    try:
+        if not message.reply_to_message or '(#id' not in msg.msgCheck(message):
+            return
+        user_id = msg.getUserID(message)
+        claimed_by = await amysql.get_ticket_claim(user_id)
+        if claimed_by:
+            if claimed_by != message.from_user.id:
+                await aout.reply_to(bot, message, "❌ This ticket is already claimed by another agent.")
+            else:
+                await aout.reply_to(bot, message, "❌ You claimed this ticket. Continue in private chat with the bot.")
+            return
+
+        if (await amysql.user_tables(user_id))['banned'] == 1:
+            await amysql.unban_user(user_id)
+            await aout.reply_to(bot, message, 'ℹ️ *FYI: That user was banned.*\n_Un-banned and sent message!_',
+                                parse_mode='Markdown')
+        await amsg.snd_handler(user_id, bot, parts)
+
+    except asyncio_helper.ApiException:
+        await aout.reply_to(bot, message, '❌ Could not send the message to the user (maybe blocked the bot).')
+    except Exception as e:
+        await aout.reply_to(bot, message, '❌ Invalid command or reply format.')
+        print("⚠️ Error in group_reply_handler:", e)
+
+# -------------------- Claim Ticket & Close Button -------------------- #
+async def announce_claim(chat_id, user_id, agent_id, agent_name, auto=False, reply_to=None):
+    """Post a claimed (or auto-assigned) ticket to the group with its buttons and DM the agent."""
+    me = await bot.get_me()
+    kb = InlineKeyboardMarkup()
+    kb.row(
+        InlineKeyboardButton("➡️ Continue Ticket in Private", url=f"https://t.me/{me.username}"),
+        InlineKeyboardButton("✅ Close Ticket", callback_data=f"close_ticket_{user_id}")
+    )
+    await aout.send(
+        bot.send_message,
+        chat_id=chat_id,
+        text=(
+            f"🎯 *Ticket {'Assigned' if auto else 'Claimed'}!*\n\n"
+            f"👤 User ID: `{user_id}`\n"
+            f"🧑‍💼 {'Assigned to' if auto else 'Claimed by'}: {agent_name}\n\n"
+            f"_Choose an action below._"
+        ),
+        parse_mode="Markdown",
+        reply_markup=kb,
+        reply_to_message_id=reply_to
+    )
+    try:
+        await aout.send(
+            bot.send_message,
+            chat_id=agent_id,
+            text=(
+                f"✅ You’ve {'been *assigned* the' if auto else '*claimed*'} ticket for user `{user_id}`.\n"
+                f"Send your replies *here* to reach the user privately.\n\n"
+                f"_You’ll also receive their replies here._"
+            ),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        print(f"⚠️ Could not DM agent: {e}")
+
+async def route_ticket(user_id, language, msg_link):
+    """Hand a new ticket to the best available agent; without one it keeps its claim button."""
+    try:
+        agent_id = await routing.route_async(user_id, language, amysql.claim_ticket_atomic)
+    except Exception as e:
+        print("⚠️ Ticket routing failed:", e)
+        return
+    if agent_id is None:
+        return
+    agent_name = f"[{await amsg.first_name(agent_id, 'Agent')}](tg://user?id={agent_id})"
+    await announce_claim(config.support_chat, user_id, agent_id, agent_name, auto=True,
+                         reply_to=int(msg_link.rsplit('/', 1)[1]))
+
+def off_shift(agent_id):
+    """Outside the agent's hours (agents without hours can always claim)."""
+    return getattr(config, 'claim_on_shift_only', True) and availability.status(agent_id) is False
+
+@bot.message_handler(commands=['claim_ticket'])
+async def claim_ticket_handler(message):
+    if message.chat.id != config.support_chat:
+        return
+    if not (message.reply_to_message and '(#id' in msg.msgCheck(message)):
+        await aout.reply_to(bot, message, "ℹ️ Please reply to the ticket message to claim it.")
+        return
+
+    user_id = msg.getUserID(message)
+    claimer_id = message.from_user.id
+    if off_shift(claimer_id):
+        await aout.reply_to(bot, message, "⏰ You're off shift. Use /shift on in DM to take tickets now.")
+        return
+    owner, won = await amysql.claim_ticket_atomic(user_id, claimer_id)
+    if won:
+        routing.router().claimed(claimer_id)
+        await aout.reply_to(bot, message, f"✅ You have claimed the ticket for user {user_id}.")
+    elif owner == claimer_id:
+        await aout.reply_to(bot, message, "ℹ️ You already claimed this ticket.")
+    elif owner:
+        await aout.reply_to(bot, message, "❌ Ticket already claimed by another agent.")
+    else:
+        await aout.reply_to(bot, message, "❌ No such user.")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(('approve_agent_', 'reject_agent_')))
+async def handle_agent_approval(call):
+    try:
+        user_id = int(call.data.split('_')[-1])
+        if call.data.startswith('approve_agent_'):
+            await amysql.approve_agent(user_id)
+            await sync_routing()
+            await bot.answer_callback_query(call.id, "✅ Agent Approved!")
+            await bot.edit_message_text("✅ This agent has been approved.",
+                                        chat_id=call.message.chat.id, message_id=call.message.message_id)
+            invite = await bot.create_chat_invite_link(chat_id=config.support_chat, member_limit=1)
+            await aout.send(bot.send_message, user_id, f"🎉 *Welcome aboard, Agent!*\n\n✅ Join support group:\n{invite.invite_link}",
+                            parse_mode="Markdown", disable_web_page_preview=True)
+        else:
+            await amysql.reject_agent(user_id)
+            await bot.answer_callback_query(call.id, "❌ Agent Rejected")
+            await bot.edit_message_text("❌ This agent request was rejected.",
+                                        chat_id=call.message.chat.id, message_id=call.message.message_id)
+            await aout.send(bot.send_message, user_id, "❌ Your request to become an agent was rejected.")
+    except Exception as e:
+        print("⚠️ Error in agent approval callback:", e)
+        await bot.answer_callback_query(call.id, "❌ Error processing this action.")
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    if not call.message:
+        return
+    data = call.data
+
+    if data == "faqCallbackdata":
+        await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
+                                    text=config.text_messages['faqs'], parse_mode='Markdown',
+                                    disable_web_page_preview=True)
+        return
+
+    if data.startswith("user_set_lang_"):
+        code = data.split("_")[-1]
+        if code not in config.LANG_OPTIONS:
+            await bot.answer_callback_query(call.id, "❌ Unsupported language.")
+            return
+        await amysql.save_user_language(call.from_user.id, code)
+        await bot.answer_callback_query(call.id, "✅ Language saved!")
+        await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
+                                    text=f"✅ Language set to *{config.LANG_OPTIONS[code]}*.", parse_mode="Markdown")
+        return
+
+    if data.startswith("new_issue_") or data.startswith("relate_issue_"):
+        parts = data.split('_')
+        uid = int(parts[2])
+        if data.startswith("new_issue_"):
+            store.set(issue_choice_key(uid), {"relate_ticket_id": None}, ttl=ISSUE_CHOICE_TTL)
+            await bot.answer_callback_query(call.id, "New issue noted.")
+        else:
+            store.set(issue_choice_key(uid), {"relate_ticket_id": int(parts[3])}, ttl=ISSUE_CHOICE_TTL)
+            await bot.answer_callback_query(call.id, "Linked to past ticket.")
+        return
+
+    if data.startswith("claim_ticket_"):
+        try:
+            user_id = int(data.split("_")[-1])
+            claimer_id = call.from_user.id
+            claimer_name = f"[{call.from_user.first_name}](tg://user?id={claimer_id})"
+
+            agent = amysql.get_agent(claimer_id)
+            if agent is None:
+                await bot.answer_callback_query(call.id, "❌ You are not a registered agent.", show_alert=True)
+                return
+            if not agent['languages']:
+                await bot.answer_callback_query(call.id, "❌ You have no languages listed. Contact admin.", show_alert=True)
+                return
+            user_lang = await amysql.get_user_language(user_id)
+            if user_lang not in agent['languages']:
+                await bot.answer_callback_query(call.id, f"❌ You cannot claim. Requires '{user_lang}'.", show_alert=True)
+                return
+            if off_shift(claimer_id):
+                await bot.answer_callback_query(call.id, "⏰ You're off shift. Use /shift on in DM to take tickets now.",
+                                                show_alert=True)
+                return
+
+            owner, won = await amysql.claim_ticket_atomic(user_id, claimer_id)
+            if not won:
+                if owner == claimer_id:
+                    await bot.answer_callback_query(call.id, "ℹ️ You already claimed this ticket.")
+                else:
+                    await bot.answer_callback_query(call.id, "❌ Already claimed by another agent.", show_alert=True)
+                return
+            routing.router().claimed(claimer_id)
+            await bot.answer_callback_query(call.id, "✅ Ticket claimed!")
+            await announce_claim(call.message.chat.id, user_id, claimer_id, claimer_name)
+        except Exception as e:
+            print(f"❌ claim_ticket callback error: {e} | data={data}")
+            await bot.answer_callback_query(call.id, "❌ Invalid/expired claim button.")
+        return
+
+    if data.startswith("close_ticket_"):
+        try:
+            user_id = int(data.split("_")[-1])
+            caller_id = call.from_user.id
+            ticket = await amysql.get_current_ticket(user_id)
+            if not ticket:
+                await bot.answer_callback_query(call.id, "❌ No open ticket.", show_alert=True)
+                return
+            if not is_admin(caller_id) and ticket['resolved'] == 0:
+                await bot.answer_callback_query(call.id, "❌ Resolve first with /resolve.", show_alert=True)
+                return
+            current_claimer = ticket['claimed_by']
+            if current_claimer and current_claimer != caller_id and not is_admin(caller_id):
+                await bot.answer_callback_query(call.id, "❌ Only claiming agent or admin can close.", show_alert=True)
+                return
+
+            if not await amysql.close_ticket_atomic(ticket['id'], user_id):
+                await bot.answer_callback_query(call.id, "ℹ️ Ticket already closed.")
+                return
+            if current_claimer:
+                routing.router().release(current_claimer)
+
+            await bot.answer_callback_query(call.id, "✅ Ticket closed.")
+            await aout.send(bot.send_message, call.message.chat.id, f"✅ Ticket `{ticket['id']}` for `{user_id}` has been closed.",
+                            parse_mode="Markdown")
+            try:
+                await aout.send(bot.send_message, user_id, "✅ Your ticket has been closed. If you need more help, just message me again.")
+            except Exception as e:
+                print("⚠️ Could not notify user:", e)
+        except Exception as e:
+            print("❌ close_ticket callback error:", e)
+            await bot.answer_callback_query(call.id, "❌ Failed to close ticket.", show_alert=True)
+
+# -------------------- Agent Utility Commands -------------------- #
+@bot.message_handler(commands=['mytickets'])
+async def cmd_mytickets(message):
+    if dm_only(message):
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    rows = await amysql.get_agent_active_tickets(message.from_user.id)
+    if not rows:
+        await aout.reply_to(bot, message, "ℹ️ You have no active tickets.")
+        return
+    text = "🎟️ *Your active tickets:*\n\n" + "".join(
+        f"• `{r['userid']}` — [link]({r['open_ticket_link']})\n" for r in rows)
+    await aout.reply_to(bot, message, text, parse_mode="Markdown", disable_web_page_preview=True)
+
+@bot.message_handler(commands=['shift'])
+async def cmd_shift(message):
+    if dm_only(message):
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    parts = message.text.split()
+    modes = {'on': True, 'off': False, 'auto': None}
+    if len(parts) != 2 or parts[1].lower() not in modes:
+        await aout.reply_to(bot, message, "Usage: `/shift on`, `/shift off` or `/shift auto` (follow your hours)",
+                            parse_mode="Markdown")
+        return
+    on_shift = modes[parts[1].lower()]
+    await amysql.set_agent_shift(message.from_user.id, on_shift)
+    availability.set_override(message.from_user.id, on_shift)
+    await sync_shifts()
+    await aout.reply_to(bot, message, shift_status(message.from_user.id))
+
+def shift_status(agent_id):
+    status = availability.status(agent_id)
+    if status is None:
+        return "⚪️ No hours set: you only get tickets you claim. Set them with /availability or use /shift on."
+    return ("🟢 You're on shift: new tickets in your languages will be assigned to you." if status else
+            "⚪️ You're off shift: no tickets will be assigned to you.")
+
+@bot.message_handler(commands=['availability'])
+async def cmd_availability(message):
+    if dm_only(message):
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    parts = message.text.split(' ', 1)
+    if len(parts) < 2:
+        hours = ((await amysql.get_agent_profile(message.from_user.id)) or {}).get('availability') or '—'
+        await bot.reply_to(message,
+                           f"⏰ Your hours: `{hours}`\n{shift_status(message.from_user.id)}\n\n"
+                           f"Change them with e.g. `/availability Mon-Fri 9:00-17:00 Europe/Berlin`",
+                           parse_mode="Markdown")
+        return
+    try:
+        tz, intervals = availability.parse(parts[1][:255])
+    except ValueError as e:
+        await aout.reply_to(bot, message, f"❌ {e}")
+        return
+    await amysql.set_agent_availability(message.from_user.id, tz, intervals)
+    await sync_routing()
+    await aout.reply_to(bot, message, f"✅ Hours set to `{availability.describe(tz, intervals)}`\n"
+                                      f"{shift_status(message.from_user.id)}", parse_mode="Markdown")
+
+@bot.message_handler(commands=['transcript'])
+async def cmd_transcript(message):
+    uid = message.from_user.id
+    if not (is_agent(uid) or is_admin(uid)):
+        return
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].lstrip('#').isdigit():
+        await aout.reply_to(bot, message, "Usage: /transcript <ticket_id>")
+        return
+    ticket_id = int(parts[1].lstrip('#'))
+    rows = await amysql.get_ticket_transcript(ticket_id)
+    if not rows:
+        await aout.reply_to(bot, message, f"ℹ️ No messages recorded for ticket #{ticket_id}.")
+        return
+    await send_chunked(message.chat.id, f"🗂 Ticket #{ticket_id}\n\n", [msg.transcript_line(r) for r in rows])
+
+@bot.message_handler(commands=['whoami'])
+async def cmd_whoami(message):
+    if dm_only(message):
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    profile, active = await asyncio.gather(
+        amysql.get_agent_profile(message.from_user.id),
+        amysql.count_agent_active_tickets(message.from_user.id))
+    profile = profile or {}
+    full_name = profile.get('full_name') or f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip()
+    languages = (profile.get('languages') or '').split(',') if profile.get('languages') else []
+    text = (
+        f"🧑‍💼 *Agent Profile*\n"
+        f"Name: `{full_name}`\n"
+        f"ID: `{message.from_user.id}`\n"
+        f"Languages: `{', '.join([l.strip() for l in languages]) or 'none'}`\n"
+        f"Availability: `{profile.get('availability') or '—'}`\n"
+        f"Shift: {shift_status(message.from_user.id)}\n"
+        f"Commission rate: `{profile.get('commission_rate') or 0}`\n"
+        f"Total earnings: `{profile.get('total_earnings') or 0}`\n"
+        f"Tickets claimed: `{profile.get('tickets_claimed') or 0}` | resolved: `{profile.get('tickets_resolved') or 0}` | active: `{active}`"
+    )
+    await aout.reply_to(bot, message, text, parse_mode="Markdown")
+
+@bot.message_handler(commands=['setlang'])
+async def cmd_setlang(message):
+    if dm_only(message):
+        await aout.reply_to(bot, message, "📬 Please DM me for this command.")
+        return
+    if not is_agent(message.from_user.id):
+        return
+    parts = message.text.split(' ', 1)
+    if len(parts) < 2:
+        await aout.reply_to(bot, message, "Usage: `/setlang en,es`", parse_mode="Markdown")
+        return
+    try:
+        normalized = normalize_language_input(parts[1])
+    except ValueError as e:
+        await aout.reply_to(bot, message, f"❌ {e}", parse_mode="Markdown")
+        return
+    await amysql.set_agent_languages(message.from_user.id, normalized)
+    routing.router().update(message.from_user.id, languages=amysql.get_agent(message.from_user.id)['languages'])
+    await aout.reply_to(bot, message, f"✅ Languages updated to `{normalized}`", parse_mode="Markdown")
+
+# -------------------- ADMIN COMMANDS -------------------- #
+@bot.message_handler(commands=['set_commission'])
+async def cmd_set_commission(message):
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) != 3:
+        await aout.reply_to(bot, message, "Usage: `/set_commission <agent_id> <rate>`", parse_mode='Markdown')
+        return
+    try:
+        agent_id, rate = int(parts[1]), float(parts[2])
+    except ValueError:
+        await aout.reply_to(bot, message, "❌ Invalid args. Example: `/set_commission 123456789 0.15`", parse_mode='Markdown')
+        return
+    await amysql.set_commission(agent_id, rate)
+    await aout.reply_to(bot, message, f"✅ Commission rate for `{agent_id}` set to `{rate}`")
+
+@bot.message_handler(commands=['agent_stat'])
+async def cmd_agent_stat(message):
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].lstrip('-').isdigit():
+        await aout.reply_to(bot, message, "Usage: `/agent_stat <agent_id>`", parse_mode='Markdown')
+        return
+    agent_id = int(parts[1])
+    stat = await amysql.get_agent_stats(agent_id)
+    if not stat:
+        await aout.reply_to(bot, message, "❌ Agent not found.")
+        return
+    await aout.reply_to(bot, message, (
+       f"📊 *Agent Stats*\n"
+       f"ID: `{agent_id}`\n"
+       f"Name: `{stat['full_name'] or '—'}`\n"
+       f"Commission: `{stat['commission_rate']}`\n"
+       f"Tickets claimed: `{stat['tickets_claimed']}`\n"
+       f"Tickets resolved: `{stat['tickets_resolved']}`\n"
+       f"Total earnings: `{stat['total_earnings']}`\n"
+       f"Last 7 days: `{stat['week_resolved']}` resolved, `{stat['week_earnings']}` earned"
+    ), parse_mode='Markdown')
+
+@bot.message_handler(commands=['report_summary'])
+async def cmd_report_summary(message):
+    if not is_admin(message.from_user.id):
+        return
+    r = await amysql.get_report_summary()
+    top_lines = "".join(
+        f"• `{t['user_id']}` {t['full_name'] or ''} — {t['tickets_resolved']} resolved\n" for t in r['top']
+    ) or '—'
+    await aout.reply_to(bot, message, (
+       "📈 *Support Performance Summary*\n\n"
+       f"Total users/tickets: `{r['total_tickets']}`\n"
+       f"Open tickets now: `{r['open_now']}`\n"
+       f"Banned users: `{r['banned_cnt']}`\n"
+       f"Resolved tickets (all agents): `{r['resolved']}`\n"
+       f"Total earnings paid: `{r['earned']}`\n\n"
+       "*Top agents by resolved:*\n"
+       f"{top_lines}"
+    ), parse_mode='Markdown', disable_web_page_preview=True)
+
+@bot.message_handler(commands=['groupid'])
+async def get_group_id(message):
+    await aout.reply_to(bot, message, f"👥 Group ID: `{message.chat.id}`", parse_mode='Markdown')
+
+# -------------------- Run Bot -------------------- #
+async def every(interval, job, name):
+    """Await `job()` every `interval` seconds; errors are logged, not raised."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except Exception as e:
+            print(f"⚠️ Background job '{name}' failed:", e)
+
+async def flush_transcript():
+    rows = transcript.drain()
+    if not rows:
+        return
+    try:
+        await amysql.save_ticket_messages(rows)
+    except Exception:
+        transcript.requeue(rows)
+        raise
+    transcript.written(len(rows))
+
+async def flush_spam_counters():
+    spam_guard.evict_idle()
+    rows = spam_guard.drain_dirty()
+    try:
+        await amysql.save_spam_counters(rows)
+    except Exception:
+        spam_guard.requeue(rows)
+        raise
+
+async def sync_routing():
+    """Re-read agents' hours and loads; also after changes to an agent's hours."""
+    availability.load(await amysql.get_agent_availability())
+    routing.router().load(await amysql.get_routing_agents(), on_shift=availability.on_shift_now())
+
+async def sync_shifts():
+    routing.router().set_shifts(availability.on_shift_now())
+
+async def sync_agents():
+    """Pick up approvals, /setlang, commission and /shift changes made by other processes."""
+    await amysql.reload_agents()
+    availability.load(await amysql.get_agent_availability())
+    await sync_shifts()
+
+async def main():
+    await amysql.init()
+    try:
+        await sync_routing()
+    except Exception as e:
+        print("⚠️ Failed to load agents for routing:", e)
+    background = [
+        asyncio.create_task(every(getattr(config, 'earnings_rollup_interval', 60), amysql.rollup_earnings,
+                                  'earnings-rollup')),
+        asyncio.create_task(every(getattr(config, 'stats_reconcile_interval', 3600), amysql.reconcile_stats_counters,
+                                  'stats-reconcile')),
+        asyncio.create_task(every(getattr(config, 'transcript_flush_ms', 200) / 1000, flush_transcript,
+                                  'transcript-writer')),
+        asyncio.create_task(every(getattr(config, 'spam_flush_interval', 10), flush_spam_counters,
+                                  'spam-flusher')),
+        asyncio.create_task(every(getattr(config, 'conversation_purge_interval', 600), amysql.purge_conversations,
+                                  'conversation-purge')),
+        asyncio.create_task(every(getattr(config, 'route_resync_interval', 300), sync_routing,
+                                  'routing-resync')),
+        asyncio.create_task(every(getattr(config, 'shift_check_interval', 60), sync_shifts,
+                                  'shift-check')),
+        asyncio.create_task(every(getattr(config, 'agents_reload_interval', 60), sync_agents,
+                                  'agents-reload')),
+    ]
+    print("Telegram Support Bot (asyncio) started...")
+    try:
+        await bot.infinity_polling(timeout=30, request_timeout=60)
+    finally:
+        for task in background:
+            task.cancel()
+        try:
+            await flush_transcript()
+        except Exception as e:
+            print("⚠️ Failed to write transcript rows:", e)
+        try:
+            await flush_spam_counters()
+        except Exception as e:
+            print("⚠️ Failed to persist spam counters:", e)
+        await amysql.close()
+
+if __name__ == '__main__':
+    migrations.run()
+    asyncio.run(main())
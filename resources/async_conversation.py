@@ -0,0 +1,51 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : async_conversation.py #
+# --------------------------------------------- #
+# asyncio counterpart of conversation.py (main_async.py): the same rows and
+# retry rules, with async step handlers. A flow keeps its id in both runtimes,
+# so a conversation started under one continues under the other.
+
+from resources import async_mysql_handler as amysql
+from resources import conversation
+from resources.conversation import END, SAVE, GIVE_UP, _encode, _decode
+
+
+class Flow(conversation.Flow):
+    """conversation.Flow whose step handlers and gave_up are coroutines."""
+
+    async def start(self, user_id, state, payload=None):
+        await amysql.save_conversation(user_id, self.flow_id, int(state), _encode(payload or {}), self.ttl)
+
+    async def _advance(self, message, state, payload):
+        user_id = message.from_user.id
+        handler = self._steps.get(state)
+        if handler is None:
+            await amysql.end_conversation(user_id)
+            return False
+        outcome, next_state, payload = self._outcome(state, await handler(message, payload))
+        if outcome == SAVE:
+            await amysql.save_conversation(user_id, self.flow_id, next_state, _encode(payload), self.ttl)
+            return True
+        await amysql.end_conversation(user_id)
+        if outcome == GIVE_UP:
+            if self.gave_up:
+                await self.gave_up(message)
+            return False
+        return True
+
+
+async def dispatch(message, conversation_row):
+    """Async twin of conversation.dispatch()."""
+    if not conversation_row:
+        return False
+    flow = conversation._flows.get(conversation_row['flow'])
+    if not isinstance(flow, Flow):
+        await amysql.end_conversation(message.from_user.id)
+        return False
+    return await flow._advance(message, conversation_row['state'], _decode(conversation_row['payload']))
+
+
+async def cancel(user_id):
+    return await amysql.end_conversation(user_id) > 0
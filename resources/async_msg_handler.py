@@ -0,0 +1,170 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : async_msg_handler.py  #
+# --------------------------------------------- #
+# asyncio counterparts of msg_handler's send/forward helpers (main_async.py).
+
+import re
+import traceback
+
+import config
+from resources import async_mysql_handler as amysql
+from resources import async_outbound as aout
+from resources import lang_emojis as emoji
+from resources import profile_store as profiles
+from resources import spam_guard
+from resources import transcript
+from resources.msg_handler import CAPTIONED, as_album, msgCaption
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+_PROFILE_FIELDS = ('first_name', 'last_name', 'username', 'language_code')
+
+
+async def remember(user):
+    """Async twin of profile_store.remember()."""
+    if user is None or getattr(user, 'is_bot', False):
+        return
+    profile = {f: getattr(user, f, None) for f in _PROFILE_FIELDS}
+    if profiles.peek(user.id) == profile:
+        if not profiles.touch_due(user.id):
+            return
+        await amysql.touch_user_profile(user.id)
+    else:
+        await amysql.save_user_profile(user.id, **profile)
+    profiles.store(user.id, profile, written=True)
+
+
+async def first_name(user_id, default=''):
+    profile = profiles.peek(user_id)
+    if profile is None:
+        profile = await amysql.get_user_profile(user_id)
+        if profile:
+            profiles.store(user_id, profile)
+    return (profile or {}).get('first_name') or default
+
+
+# (Support -> User Handler)
+async def snd_handler(user_id, bot, message, txt=None):
+    parts = as_album(message)
+    first = parts[0]
+    try:
+        sign = config.text_messages['support_response'].format(await first_name(user_id))
+        if len(parts) > 1:
+            await aout.send(bot.send_message, user_id, sign, parse_mode='Markdown')
+            await aout.send(bot.copy_messages, user_id, first.chat.id, [m.message_id for m in parts])
+        elif first.content_type == 'text':
+            await aout.send(
+                bot.send_message,
+                user_id,
+                sign + f'\n\n{first.text}',
+                parse_mode='Markdown',
+                disable_web_page_preview=True
+            )
+        elif first.content_type in CAPTIONED:
+            await aout.send(bot.copy_message, user_id, first.chat.id, first.message_id,
+                            caption=sign + f'\n\n{msgCaption(first)}', parse_mode='Markdown')
+        else:
+            await aout.send(bot.copy_message, user_id, first.chat.id, first.message_id)
+        for m in parts:
+            transcript.record(user_id, transcript.OUT, m)
+        # The team answered: the user may write freely again
+        spam_guard.reset(user_id)
+    except Exception as e:
+        print("❌ Failed to send message to user:", e)
+        traceback.print_exc()
+        try:
+            await aout.reply_to(bot, first, '❌ That format is not supported.')
+        except Exception:
+            pass
+
+
+async def snd_to_agent(agent_id, bot, message):
+    """
+    Copy the user's private message (or album) to the claiming agent's DM.
+    """
+    parts = as_album(message)
+    first = parts[0]
+    try:
+        if len(parts) > 1:
+            await aout.send(bot.copy_messages, agent_id, first.chat.id, [m.message_id for m in parts])
+        else:
+            await aout.send(bot.copy_message, agent_id, first.chat.id, first.message_id)
+        for m in parts:
+            transcript.record(first.from_user.id, transcript.IN, m)
+    except Exception as e:
+        print("❌ Failed to DM agent:", e)
+
+
+async def relay_to_support(user_id, bot, message):
+    """
+    Post the user's message (or album) to the support group (with a claim button).
+    Returns the link to the posted message, or None if Telegram refused to copy it.
+    """
+    parts = as_album(message)
+    first = parts[0]
+    lang_code = first.from_user.language_code or config.DEFAULT_LANG
+    header = "[{0}{1}](tg://user?id={2}) (#id{2}) | {3}".format(
+        first.from_user.first_name,
+        f" {first.from_user.last_name}" if first.from_user.last_name else '',
+        first.from_user.id,
+        emoji.lang_emoji(lang_code)
+    )
+
+    claim_markup = InlineKeyboardMarkup()
+    claim_markup.add(
+        InlineKeyboardButton(
+            f"🎯 Claim Ticket ({lang_code.upper()})",
+            callback_data=f"claim_ticket_{first.from_user.id}"
+        )
+    )
+
+    try:
+        if len(parts) == 1 and first.content_type == 'text':
+            msg = await aout.send(bot.send_message, config.support_chat, f"{header}\n\n{first.text}",
+                                  parse_mode='Markdown', disable_web_page_preview=True, reply_markup=claim_markup)
+        elif len(parts) == 1 and first.content_type in CAPTIONED:
+            msg = await aout.send(bot.copy_message, config.support_chat, first.chat.id, first.message_id,
+                                  caption=f"{header}\n\n{msgCaption(first)}", parse_mode='Markdown',
+                                  reply_markup=claim_markup)
+        else:
+            msg = await aout.send(bot.send_message, config.support_chat, header, parse_mode='Markdown',
+                                  reply_markup=claim_markup)
+            if len(parts) > 1:
+                await aout.send(bot.copy_messages, config.support_chat, first.chat.id, [m.message_id for m in parts])
+            else:
+                await aout.send(bot.copy_message, config.support_chat, first.chat.id, first.message_id,
+                                reply_to_message_id=msg.message_id)
+    except Exception as e:
+        print("❌ Failed to relay message to support:", e)
+        await aout.reply_to(bot, first, "❌ That message could not be forwarded, please try again.")
+        return None
+
+    channel_id = re.sub(r"-100(\S+)", r"\1", str(config.support_chat))
+    return f'https://t.me/c/{channel_id}/{msg.message_id}'
+
+
+async def notify_submitted(bot, user_id):
+    try:
+        await aout.send(
+            bot.send_message,
+            user_id,
+            "✅ Your message has been submitted.\nOur support team will respond shortly.",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        print("⚠️ Failed to send confirmation:", e)
+
+
+async def fwd_handler(user_id, bot, message):
+    """Relay a user message and record it (ticket and language in one transaction, spam counter in memory)."""
+    ctx = await amysql.load_message_context(user_id)
+    link = await relay_to_support(user_id, bot, message)
+    if not link:
+        return False
+    current = ctx['current_ticket']
+    spam_guard.hit(user_id, seed=(ctx['user'] or {}).get('open_ticket_spam'))
+    await amysql.apply_message_updates(user_id, message.from_user.language_code, link,
+                                       ticket_id=current['id'] if current else None)
+    await notify_submitted(bot, user_id)
+    return True
@@ -0,0 +1,474 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name         : async_mysql_handler.py  #
+# --------------------------------------------- #
+# asyncio mirror of mysql_handler for main_async.py. Same tables, same
+# semantics: the statements are mysql_handler's *_SQL constants, only their
+# execution is async here. Schema migrations live in resources/migrations.py.
+
+import aiomysql
+import config
+import random
+from contextlib import asynccontextmanager
+from resources import availability
+from resources import mysql_handler as mysql
+from resources import spam_guard
+from datetime import datetime
+
+_pool = None
+
+# ------------- Connection ------------- #
+async def init():
+    """Create the pool and load the agent registry. Call once inside the event loop."""
+    global _pool, agents
+    _pool = await aiomysql.create_pool(
+        host=config.mysql_host,
+        user=config.mysql_user,
+        password=config.mysql_pw,
+        db=config.mysql_db,
+        charset='utf8mb4',
+        cursorclass=aiomysql.DictCursor,
+        autocommit=True,
+        minsize=1,
+        maxsize=getattr(config, 'mysql_pool_size', 10),
+        pool_recycle=getattr(config, 'mysql_pool_recycle', 3600)
+    )
+    try:
+        agents = await getAgents()
+    except Exception as e:
+        print("⚠️ Failed to load agents (the agents-reload job retries):", e)
+
+async def close():
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed()
+
+@asynccontextmanager
+async def db_cursor():
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as c:
+            yield c
+
+@asynccontextmanager
+async def db_transaction():
+    async with _pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as c:
+                yield c
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+@asynccontextmanager
+async def db_snapshot():
+    """Cursor whose reads all see one consistent snapshot; takes no locks."""
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as c:
+            await c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            await c.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+            try:
+                yield c
+            finally:
+                await conn.rollback()
+
+async def _fetchone(sql, args=None):
+    async with db_cursor() as c:
+        await c.execute(sql, args)
+        return await c.fetchone()
+
+async def _fetchall(sql, args=None):
+    async with db_cursor() as c:
+        await c.execute(sql, args)
+        return await c.fetchall()
+
+async def _execute(sql, args=None):
+    async with db_cursor() as c:
+        await c.execute(sql, args)
+        return c.lastrowid
+
+# ------------- Agent registry ------------- #
+agents = {}     # {user_id: {"languages": frozenset, "commission_rate": float, "availability": str}}
+
+def _split_languages(raw):
+    return frozenset(l.strip() for l in raw.split(',') if l.strip()) if raw else frozenset()
+
+def _agent_entry(row):
+    return {
+        "languages": _split_languages(row['languages']),
+        "commission_rate": float(row['commission_rate'] or 0),
+        "availability": row['availability']
+    }
+
+async def getAgents():
+    rows = await _fetchall(mysql.AGENTS_SQL)
+    return {r['user_id']: _agent_entry(r) for r in rows}
+
+async def refresh_agent(user_id):
+    row = await _fetchone(mysql.AGENT_SQL, (user_id,))
+    if row:
+        agents[user_id] = _agent_entry(row)
+    else:
+        agents.pop(user_id, None)
+
+async def reload_agents():
+    global agents
+    agents = await getAgents()
+
+async def get_routing_agents():
+    rows = await _fetchall(mysql.ROUTING_AGENTS_SQL)
+    return [dict(r, languages=_split_languages(r['languages'])) for r in rows]
+
+async def set_agent_shift(agent_id, on_shift):
+    await _execute(mysql.SET_AGENT_SHIFT_SQL, (None if on_shift is None else int(bool(on_shift)), agent_id))
+
+async def _write_agent_shifts(c, agent_id, tz, intervals):
+    await c.execute(mysql.DELETE_AGENT_SHIFTS_SQL, (agent_id,))
+    if intervals:
+        await c.execute(mysql.INSERT_AGENT_SHIFTS_SQL.format(rows=", ".join(["(%s, %s, %s)"] * len(intervals))),
+                        [v for start, end in intervals for v in (agent_id, start, end)])
+    await c.execute(mysql.SET_AGENT_TIMEZONE_SQL, (tz, agent_id))
+
+async def set_agent_availability(agent_id, tz, intervals):
+    async with db_transaction() as c:
+        await c.execute(mysql.SET_AGENT_AVAILABILITY_SQL, (availability.describe(tz, intervals), agent_id))
+        await _write_agent_shifts(c, agent_id, tz, intervals)
+
+async def get_agent_availability():
+    rows = {r['user_id']: dict(r, languages=_split_languages(r['languages']), shifts=[])
+            for r in await _fetchall(mysql.AGENT_AVAILABILITY_SQL)}
+    for r in await _fetchall(mysql.AGENT_SHIFTS_SQL):
+        if r['agent_id'] in rows:
+            rows[r['agent_id']]['shifts'].append((r['start_min'], r['end_min']))
+    return list(rows.values())
+
+def is_agent(user_id):
+    return user_id in agents
+
+def get_agent(user_id):
+    return agents.get(user_id)
+
+async def save_pending_agent(user_id, full_name, languages, availability):
+    await _execute(mysql.SAVE_PENDING_AGENT_SQL, (user_id, full_name, languages, availability))
+
+async def approve_agent(user_id):
+    async with db_transaction() as c:
+        await c.execute(mysql.PENDING_AGENT_SQL, (user_id,))
+        row = await c.fetchone()
+        if not row:
+            return
+        await c.execute(mysql.APPROVE_AGENT_SQL, (user_id, row['full_name'], row['languages'], row['availability']))
+        try:
+            tz, intervals = availability.parse(row['availability'])
+            await _write_agent_shifts(c, user_id, tz, intervals)
+        except ValueError:
+            pass
+        await c.execute(mysql.DELETE_PENDING_AGENT_SQL, (user_id,))
+    await refresh_agent(user_id)
+
+async def reject_agent(user_id):
+    await _execute(mysql.DELETE_PENDING_AGENT_SQL, (user_id,))
+    await refresh_agent(user_id)
+
+async def set_commission(agent_id, rate):
+    await _execute(mysql.SET_COMMISSION_SQL, (rate, agent_id))
+    if agent_id in agents:
+        agents[agent_id] = dict(agents[agent_id], commission_rate=float(rate))
+
+async def set_agent_languages(agent_id, languages):
+    await _execute(mysql.SET_AGENT_LANGUAGES_SQL, (languages, agent_id))
+    if agent_id in agents:
+        agents[agent_id] = dict(agents[agent_id], languages=_split_languages(languages))
+
+# ------------- Agents ------------- #
+async def get_claimed_ticket_by_agent(agent_id):
+    r = await _fetchone(mysql.CLAIMED_BY_AGENT_USERS_SQL, (agent_id,))
+    if r:
+        return r['userid']
+    r = await _fetchone(mysql.CLAIMED_BY_AGENT_TICKETS_SQL, (agent_id,))
+    return r['user_id'] if r else None
+
+async def _add_unrolled(c, row, agent_id):
+    await c.execute(mysql.LEDGER_TAIL_SQL, (agent_id,))
+    tail = await c.fetchone()
+    row['tickets_resolved'] += tail['n']
+    row['total_earnings'] += tail['amount']
+    return row
+
+async def get_agent_profile(user_id):
+    async with db_snapshot() as c:
+        await c.execute(mysql.AGENT_PROFILE_SQL, (user_id,))
+        row = await c.fetchone()
+        return await _add_unrolled(c, row, user_id) if row else None
+
+async def get_agent_stats(agent_id):
+    async with db_snapshot() as c:
+        await c.execute(mysql.AGENT_TOTALS_SQL, (agent_id,))
+        row = await c.fetchone()
+        if not row:
+            return None
+        before = (row['tickets_resolved'], row['total_earnings'])
+        await _add_unrolled(c, row, agent_id)
+        await c.execute(mysql.AGENT_WEEK_SQL, (agent_id,))
+        week = await c.fetchone()
+    row['week_resolved'] = week['n'] + row['tickets_resolved'] - before[0]
+    row['week_earnings'] = week['amount'] + row['total_earnings'] - before[1]
+    return row
+
+async def increment_claim(agent_id):
+    await _execute(mysql.INCREMENT_CLAIM_SQL, (agent_id,))
+
+async def get_agent_active_tickets(agent_id):
+    return await _fetchall(mysql.AGENT_ACTIVE_TICKETS_SQL, (agent_id,))
+
+async def count_agent_active_tickets(agent_id):
+    r = await _fetchone(mysql.COUNT_AGENT_ACTIVE_TICKETS_SQL, (agent_id,))
+    return r['cnt']
+
+# ------------- Stats counters (see mysql_handler) ------------- #
+async def _bump(c, name, delta):
+    if delta:
+        await c.execute(mysql.BUMP_SQL, (name, random.randrange(mysql._stats_slots()), delta))
+
+async def _set_flag(c, user_id, column, value):
+    await c.execute(mysql.SET_FLAG_SQL.format(column=column), (value, user_id, value))
+    if c.rowcount:
+        await _bump(c, mysql._FLAG_COUNTERS[column], 1 if value else -1)
+    return bool(c.rowcount)
+
+async def get_stats_counters():
+    rows = await _fetchall(mysql.STATS_COUNTERS_SQL)
+    return {r['name']: r['value'] for r in rows}
+
+async def reconcile_stats_counters():
+    """Async twin of mysql_handler.reconcile_stats_counters(); returns {name: drift}."""
+    async with db_snapshot() as c:
+        await c.execute(mysql.STATS_COUNTERS_SQL)
+        stored = {r['name']: r['value'] for r in await c.fetchall()}
+        await c.execute(mysql.USER_COUNTS_SQL)
+        actual = dict(await c.fetchone())
+        await c.execute(mysql.ROLLED_TOTALS_SQL)
+        rolled = await c.fetchone()
+        await c.execute(mysql.LEDGER_TAIL_ALL_SQL)
+        tail = await c.fetchone()
+        actual['tickets_resolved'] = rolled['resolved'] + tail['n']
+        actual['earnings'] = rolled['earned'] + tail['amount']
+    drift = {name: actual[name] - stored.get(name, 0) for name in mysql.STATS_COUNTERS}
+    drift = {k: v for k, v in drift.items() if v}
+    if drift:
+        async with db_transaction() as c:
+            for name, delta in drift.items():
+                await _bump(c, name, delta)
+        print("ℹ️ Stats counters corrected:", drift)
+    return drift
+
+async def get_report_summary():
+    counters = await get_stats_counters()
+    top = await _fetchall(mysql.TOP_AGENTS_SQL)
+    return {
+        "total_tickets": int(counters.get('users_total', 0)),
+        "open_now": int(counters.get('open_tickets', 0)),
+        "banned_cnt": int(counters.get('banned_users', 0)),
+        "resolved": int(counters.get('tickets_resolved', 0)),
+        "earned": float(counters.get('earnings', 0)),
+        "top": top
+    }
+
+# ------------- Users ------------- #
+async def start_bot(user_id):
+    async with db_transaction() as c:
+        await c.execute(mysql.START_BOT_SQL, (user_id,))
+        await _bump(c, 'users_total', c.rowcount)
+
+async def save_user_language(user_id, lang_code):
+    await _execute(mysql.SAVE_USER_LANGUAGE_SQL, (lang_code, user_id))
+
+async def save_spam_counters(rows):
+    """Async twin of mysql_handler.save_spam_counters()."""
+    if not rows:
+        return
+    await _execute(mysql.SAVE_SPAM_COUNTERS_SQL.format(rows=", ".join(["(%s, %s)"] * len(rows))),
+                   [v for row in rows for v in row])
+
+async def get_user_language(user_id):
+    row = await _fetchone(mysql.USER_LANGUAGE_SQL, (user_id,))
+    return row['language'] if row and row['language'] else 'en'
+
+async def user_tables(user_id):
+    return await _fetchone(mysql.USER_TABLES_SQL, (user_id,))
+
+async def ban_user(user_id):
+    async with db_transaction() as c:
+        await _set_flag(c, user_id, 'banned', 1)
+
+async def unban_user(user_id):
+    async with db_transaction() as c:
+        await _set_flag(c, user_id, 'banned', 0)
+
+async def claim_ticket(user_id, agent_id):
+    await _execute(mysql.SET_USER_CLAIM_SQL, (agent_id, datetime.now(), user_id))
+
+async def get_ticket_claim(user_id):
+    row = await _fetchone(mysql.TICKET_CLAIM_SQL, (user_id,))
+    return row['claimed_by'] if row else None
+
+async def claim_ticket_atomic(user_id, agent_id, cap=None):
+    """Async twin of mysql_handler.claim_ticket_atomic(); returns (claimer_id, won)."""
+    async with db_transaction() as c:
+        await c.execute(mysql.LOCK_AGENT_SQL, (agent_id,))
+        if cap is not None:
+            await c.execute(mysql.CLAIM_CAP_SQL, (agent_id,))
+            if (await c.fetchone())['n'] >= cap:
+                return None, False
+        await c.execute(mysql.CLAIM_SQL, (agent_id, user_id))
+        if c.rowcount != 1:
+            await c.execute(mysql.TICKET_CLAIM_SQL, (user_id,))
+            row = await c.fetchone()
+            return (row['claimed_by'] if row else None), False
+        await c.execute(mysql.CLAIM_OPEN_TICKET_SQL, (agent_id, user_id))
+        await c.execute(mysql.INCREMENT_CLAIM_SQL, (agent_id,))
+    return agent_id, True
+
+async def get_user_profile(user_id):
+    return await _fetchone(mysql.USER_PROFILE_SQL, (user_id,))
+
+async def save_user_profile(user_id, first_name, last_name, username=None, language_code=None):
+    await _execute(mysql.SAVE_USER_PROFILE_SQL, (user_id, first_name, last_name, username, language_code))
+
+async def touch_user_profile(user_id):
+    await _execute(mysql.TOUCH_USER_PROFILE_SQL, (user_id,))
+
+async def list_open_tickets():
+    return await _fetchall(mysql.OPEN_TICKETS_SQL)
+
+async def list_banned_users():
+    return await _fetchall(mysql.BANNED_USERS_SQL)
+
+# ------------- Ticket lifecycle ------------- #
+async def load_message_context(user_id):
+    row = await _fetchone(mysql.MESSAGE_CONTEXT_SQL, (user_id, user_id))
+    user = None
+    if row['userid'] is not None:
+        user = {k: row[k] for k in ('userid', 'banned', 'language', 'claimed_by',
+                                    'open_ticket_spam', 'open_ticket_link')}
+    current_ticket = None
+    if row['ct_id'] is not None:
+        current_ticket = {'id': row['ct_id'], 'resolved': row['ct_resolved'], 'claimed_by': row['ct_claimed_by']}
+    last_unresolved = None
+    if row['lu_id'] is not None:
+        last_unresolved = {'id': row['lu_id'], 'first_message_link': row['lu_first_link'],
+                           'last_message_link': row['lu_last_link']}
+    conversation = None
+    if row['cv_flow'] is not None:
+        conversation = {'flow': row['cv_flow'], 'state': row['cv_state'], 'payload': row['cv_payload']}
+    return {
+        "user": user,
+        "current_ticket": current_ticket,
+        "last_unresolved": last_unresolved,
+        "conversation": conversation
+    }
+
+async def apply_message_updates(user_id, lang_code, link, ticket_id=None):
+    new = ticket_id is None
+    async with db_transaction() as c:
+        if new:
+            await c.execute(mysql.NEW_TICKET_SQL, (user_id, link, link))
+            ticket_id = c.lastrowid
+            await _set_flag(c, user_id, 'open_ticket', 1)
+        else:
+            await c.execute(mysql.TICKET_LAST_LINK_SQL, (link, ticket_id))
+        await c.execute(mysql.UPSERT_MESSAGE_USER_SQL, (user_id, lang_code, link, ticket_id, int(new)))
+        if c.rowcount == 1:     # 1 = inserted, 2 = updated; counters in name order
+            await _bump(c, 'open_tickets', int(new))
+            await _bump(c, 'users_total', 1)
+        if new:
+            await c.execute(mysql.OPEN_TICKET_TIME_SQL, (datetime.now(), user_id))
+    return ticket_id
+
+async def set_ticket_claim(ticket_id, agent_id):
+    await _execute(mysql.SET_TICKET_CLAIM_SQL, (agent_id, ticket_id))
+
+async def mark_ticket_resolved(ticket_id):
+    await _execute(mysql.RESOLVE_TICKET_SQL, (ticket_id,))
+
+async def close_ticket(ticket_id):
+    await _execute(mysql.SET_TICKET_CLOSED_SQL, (ticket_id,))
+
+async def get_current_ticket(user_id):
+    return await _fetchone(mysql.CURRENT_TICKET_SQL, (user_id,))
+
+async def get_ticket_by_id(ticket_id):
+    return await _fetchone(mysql.TICKET_SQL, (ticket_id,))
+
+async def close_ticket_atomic(ticket_id, user_id):
+    """Async twin of mysql_handler.close_ticket_atomic(); True if this call closed the ticket."""
+    base = getattr(config, 'ticket_commission_base', 1.0)
+    async with db_transaction() as c:
+        await c.execute(mysql.CLOSE_TICKET_SQL, (ticket_id,))
+        if c.rowcount != 1:
+            return False
+        await c.execute(mysql.PAY_AGENT_SQL, (base, ticket_id))
+        paid = c.rowcount
+        if paid:
+            await c.execute(mysql.LEDGER_AMOUNT_SQL, (ticket_id,))
+            await _bump(c, 'earnings', (await c.fetchone())['amount'])
+        await _set_flag(c, user_id, 'open_ticket', 0)
+        await _bump(c, 'tickets_resolved', paid)
+        await c.execute(mysql.CLOSED_USER_SQL, (user_id,))
+    spam_guard.reset(user_id)
+    return True
+
+async def rollup_earnings(lag=None):
+    """Async twin of mysql_handler.rollup_earnings()."""
+    lag = getattr(config, 'earnings_rollup_lag', 5) if lag is None else lag
+    async with db_transaction() as c:
+        await c.execute(mysql.ROLLUP_WATERMARK_SQL)
+        last = (await c.fetchone())['last_id']
+        await c.execute(mysql.ROLLUP_WINDOW_SQL, (last, lag))
+        row = await c.fetchone()
+        if not row['hi']:
+            return 0
+        hi = row['hi']
+        await c.execute(mysql.ROLLUP_DAILY_SQL, (last, hi))
+        await c.execute(mysql.ROLLUP_TOTALS_SQL, (last, hi))
+        await c.execute(mysql.ROLLUP_ADVANCE_SQL, (hi,))
+    return row['n']
+
+async def reset_user_ticket_state(user_id):
+    async with db_transaction() as c:
+        await _set_flag(c, user_id, 'open_ticket', 0)
+        await c.execute(mysql.RESET_TICKET_STATE_SQL, (user_id,))
+    spam_guard.reset(user_id)
+
+# ------------- Transcripts ------------- #
+async def save_ticket_messages(rows):
+    async with db_transaction() as c:
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            await c.execute(mysql.SAVE_TICKET_MESSAGES_SQL.format(rows=", ".join([mysql.TRANSCRIPT_ROW_SQL] * len(chunk))),
+                            [v for row in chunk for v in (row[0], row[1]) + tuple(row[1:])])
+
+async def get_ticket_transcript(ticket_id, limit=500):
+    return await _fetchall(mysql.TICKET_TRANSCRIPT_SQL, (ticket_id, limit))
+
+# ------------- Conversations ------------- #
+async def save_conversation(user_id, flow, state, payload, ttl):
+    await _execute(mysql.SAVE_CONVERSATION_SQL, (user_id, flow, state, payload, int(ttl)))
+
+async def end_conversation(user_id):
+    async with db_cursor() as c:
+        await c.execute(mysql.END_CONVERSATION_SQL, (user_id,))
+        return c.rowcount
+
+async def purge_conversations(batch=1000):
+    """Async twin of mysql_handler.purge_conversations()."""
+    removed = 0
+    while True:
+        async with db_cursor() as c:
+            await c.execute(mysql.PURGE_CONVERSATIONS_SQL, (batch,))
+            n = c.rowcount
+        removed += n
+        if n < batch:
+            return removed
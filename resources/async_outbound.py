@@ -0,0 +1,149 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : async_outbound.py     #
+# --------------------------------------------- #
+# asyncio counterpart of outbound.py (main_async.py). Same global and per-chat
+# token buckets and outbound_* settings, but a call waits in the task that
+# makes it rather than on a worker thread. Calls to one chat go out one at a
+# time and in order; a 429 blocks that chat for Telegram's retry_after and the
+# call is sent again. There are no priority lanes: a waiting call only holds up
+# later calls to the same chat.
+
+import asyncio
+import time
+
+import config
+from telebot.asyncio_helper import ApiTelegramException
+from resources.outbound import TokenBucket
+
+
+class Limiter:
+
+    def __init__(self, global_rate=30, private_rate=1, group_rate=20 / 60, burst=3):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._buckets = {}          # chat_id -> TokenBucket (dropped again once full and idle)
+        self._swept = time.monotonic()
+        self._chats = {}            # chat_id -> [asyncio.Lock, calls waiting or in flight]
+        self._tasks = set()         # send_later() tasks, referenced until done
+        self._stats = {'sent': 0, 'retried_429': 0, 'failed': 0, 'wait_total_ms': 0.0}
+
+    async def send(self, fn, chat_id, *args, **kwargs):
+        """Rate-limited `await fn(chat_id, *args, **kwargs)`; returns the API result (or raises)."""
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        queued_at = time.monotonic()
+        try:
+            async with entry[0]:
+                return await self._call(fn, chat_id, args, kwargs, queued_at)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    def send_later(self, fn, chat_id, *args, **kwargs):
+        """send() in a task of its own; failures are logged."""
+        task = asyncio.ensure_future(self.send(fn, chat_id, *args, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def stats(self):
+        s = dict(self._stats)
+        s['queued'] = sum(n for _, n in self._chats.values())
+        s['buckets'] = len(self._buckets)
+        total = s.pop('wait_total_ms')
+        s['wait_avg_ms'] = round(total / s['sent'], 3) if s['sent'] else 0.0
+        return s
+
+    # ------------- Internals ------------- #
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("⚠️ Outbound call failed:", task.exception())
+
+    def _bucket(self, chat_id):
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = TokenBucket(self._group_rate if chat_id < 0 else self._private_rate, self._burst)
+            self._buckets[chat_id] = b
+        return b
+
+    def _sweep(self, now):
+        """Forget buckets that have refilled and have nothing waiting; a new one starts full anyway."""
+        self._swept = now
+        for chat_id, b in list(self._buckets.items()):
+            if (chat_id not in self._chats and now >= b.blocked_until
+                    and b.tokens + (now - b.stamp) * b.rate >= b.capacity):
+                del self._buckets[chat_id]
+
+    async def _take(self, chat_id):
+        """Wait for a token from both the global and the chat's bucket."""
+        while True:
+            now = time.monotonic()
+            if now - self._swept > 60:
+                self._sweep(now)
+            bucket = self._bucket(chat_id)
+            wait = max(self._global.wait_time(now), bucket.wait_time(now))
+            if not wait:
+                self._global.take()
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def _call(self, fn, chat_id, args, kwargs, queued_at):
+        while True:
+            await self._take(chat_id)
+            try:
+                result = await fn(chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                    self._bucket(chat_id).blocked_until = time.monotonic() + retry_after
+                    self._stats['retried_429'] += 1
+                    continue
+                self._stats['failed'] += 1
+                raise
+            except Exception:
+                self._stats['failed'] += 1
+                raise
+            self._stats['sent'] += 1
+            self._stats['wait_total_ms'] += (time.monotonic() - queued_at) * 1000
+            return result
+
+
+_limiter = None
+
+
+def limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = Limiter(
+            global_rate=getattr(config, 'outbound_global_rate', 30),
+            private_rate=getattr(config, 'outbound_private_rate', 1),
+            group_rate=getattr(config, 'outbound_group_rate', 20 / 60),
+            burst=getattr(config, 'outbound_burst', 3)
+        )
+    return _limiter
+
+
+async def send(fn, chat_id, *args, **kwargs):
+    return await limiter().send(fn, chat_id, *args, **kwargs)
+
+
+def send_later(fn, chat_id, *args, **kwargs):
+    return limiter().send_later(fn, chat_id, *args, **kwargs)
+
+
+async def reply_to(bot, message, text, **kwargs):
+    """Rate-limited equivalent of bot.reply_to()."""
+    return await send(bot.send_message, message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+
+def stats():
+    return limiter().stats()
@@ -0,0 +1,323 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : availability.py       #
+# --------------------------------------------- #
+# Agents' weekly working hours. Free text such as "Mon-Fri 9:00-17:00, Sat
+# 10-14 Europe/Berlin" or "9AM-5PM" is parsed into intervals of minutes since
+# Monday 00:00 in the agent's time zone (config.time_zone when none is given)
+# and stored in agent_shifts. An IntervalIndex over all agents, in UTC, answers
+# "who is on shift now" with one bisect; a manual /shift on|off overrides the
+# schedule until /shift auto.
+#
+#   python -m resources.availability --bench 1000   # index build / query timing
+
+import bisect
+import random
+import re
+import sys
+import threading
+import time
+
+import arrow
+import config
+
+DAY = 24 * 60
+WEEK = 7 * DAY
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+_DASH = r"\s*(?:-|–|—|to)\s*"
+_TIME = r"(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm)?"
+_RANGE = re.compile(_TIME + _DASH + _TIME, re.I)
+_DAY = r"(mon|tue|wed|thu|fri|sat|sun)[a-z]*\.?"
+_DAYS = re.compile(_DAY + "(?:" + _DASH + _DAY + ")?", re.I)
+_TZ_PAREN = re.compile(r"\(([^)]+)\)")
+_TZ_TAIL = re.compile(r"\s((?:utc|gmt)(?:\s*[+-]\s*\d{1,2}(?::?\d{2})?)?|[+-]\d{2}:?\d{2}|[a-z]+/[a-z_/+-]+)\s*$", re.I)
+_ALWAYS = re.compile(r"^\s*(24\s*/\s*7|always|any\s*time|anytime)\s*$", re.I)
+
+
+def default_tz():
+    return getattr(config, 'time_zone', 'UTC')
+
+
+def utc_offset(tz):
+    """Minutes `tz` is ahead of UTC right now (so DST is whatever applies today)."""
+    return int(arrow.utcnow().to(tz).utcoffset().total_seconds() // 60)
+
+
+def check_tz(tz):
+    try:
+        utc_offset(tz)
+    except Exception:
+        raise ValueError(f"Unknown time zone: {tz}")
+    return tz
+
+
+def _minutes(h, m, ampm):
+    h, m = int(h), int(m or 0)
+    if ampm:
+        if not 1 <= h <= 12:
+            raise ValueError(f"{h}{ampm} is not a time")
+        h = h % 12 + (12 if ampm.lower() == 'pm' else 0)
+    if h > 24 or m > 59 or (h == 24 and m):
+        raise ValueError(f"{h}:{m:02d} is not a time")
+    return h * 60 + m
+
+
+def _days(text):
+    """Weekday numbers named in `text` (None if it names none)."""
+    text = text.lower()
+    if re.search(r"week\s*days?\b|workdays?\b", text):
+        return list(range(5))
+    if re.search(r"week\s*ends?\b", text):
+        return [5, 6]
+    found = []
+    for m in _DAYS.finditer(text):
+        first = DAYS.index(m.group(1).lower())
+        last = DAYS.index(m.group(2).lower()) if m.group(2) else first
+        found += [(first + i) % 7 for i in range((last - first) % 7 + 1)]
+    return found or None
+
+
+def merge(intervals):
+    """Sort and join overlapping/touching [start, end) intervals."""
+    out = []
+    for start, end in sorted(intervals):
+        if out and start <= out[-1][1]:
+            out[-1] = (out[-1][0], max(out[-1][1], end))
+        else:
+            out.append((start, end))
+    return out
+
+
+def parse(text, tz=None, strict=False):
+    """
+    (tz, [(start, end)]) from free text: minutes since Monday 00:00 local time,
+    end exclusive, split at the end of the week. Raises ValueError.
+    "9-5" (no am/pm, end earlier but before noon) is read as 09:00-17:00, not
+    as a 20-hour night; with strict=True such a guess raises instead.
+    """
+    text = ' ' + (text or '').strip()
+    m = _TZ_PAREN.search(text) or _TZ_TAIL.search(text)
+    if m:
+        tz = m.group(1).replace(' ', '')
+        text = text[:m.start()] + text[m.end():]
+    tz = check_tz(tz or default_tz())
+    if _ALWAYS.match(text):
+        return tz, [(0, WEEK)]
+
+    intervals = []
+    pending_days = []
+    for segment in re.split(r"[;,\n]|\band\b", text):
+        rng = _RANGE.search(segment)
+        if not rng:
+            pending_days += _days(segment) or []      # "Mon, Wed 9-17": days carry over
+            continue
+        days = _days(segment[:rng.start()] + ' ' + segment[rng.end():])
+        days = sorted(set(pending_days + (days or []))) or list(range(7))
+        pending_days = []
+        start = _minutes(*rng.group(1, 2, 3))
+        end = _minutes(*rng.group(4, 5, 6))
+        if (end <= start and not (rng.group(3) or rng.group(6)) and not rng.group(4).startswith('0')
+                and 0 < end <= 12 * 60 < end + 12 * 60 > start):
+            if strict:
+                raise ValueError(f"{rng.group().strip()} is ambiguous (write e.g. 09:00-17:00 or 9am-5pm)")
+            end += 12 * 60      # "9-5": the afternoon
+        if end <= start:        # overnight, e.g. 22:00-06:00
+            end += DAY
+        for d in days:
+            s, e = d * DAY + start, d * DAY + end
+            if e > WEEK:
+                intervals += [(s, WEEK), (0, e - WEEK)]
+            else:
+                intervals.append((s, e))
+    if not intervals:
+        raise ValueError("No working hours found (e.g. Mon-Fri 9:00-17:00 Europe/Berlin)")
+    return tz, merge(intervals)
+
+
+def _clock(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def describe(tz, intervals):
+    """Readable form of parsed hours, e.g. "Mon–Fri 09:00–17:00 (Europe/Berlin)"."""
+    if intervals == [(0, WEEK)]:
+        return f"24/7 ({tz})"
+    spans = list(intervals)
+    if len(spans) > 1 and spans[0][0] == 0 and spans[-1][1] == WEEK:    # Sunday night into Monday
+        spans = spans[1:-1] + [(spans[-1][0], spans[0][1] + WEEK)]
+    by_hours = {}       # {(start, end) within a day: [weekday]}
+    for start, end in spans:
+        while end - start > DAY:        # several whole days: one entry per day
+            cut = (start // DAY + 1) * DAY
+            by_hours.setdefault((start % DAY, DAY), []).append(start // DAY % 7)
+            start = cut
+        d = start // DAY
+        by_hours.setdefault((start - d * DAY, end - d * DAY), []).append(d % 7)
+    parts = []
+    for (start, end), days in sorted(by_hours.items(), key=lambda kv: (min(kv[1]), kv[0])):
+        days = sorted(days)
+        runs, run = [], [days[0]]
+        for d in days[1:]:
+            if d == run[-1] + 1:
+                run.append(d)
+            else:
+                runs.append(run)
+                run = [d]
+        runs.append(run)
+        names = ', '.join(DAYS[r[0]].title() if len(r) == 1 else f"{DAYS[r[0]].title()}–{DAYS[r[-1]].title()}"
+                          for r in runs)
+        parts.append(f"{names} {_clock(start)}–{_clock(end % DAY if end > DAY else end)}")
+    return f"{', '.join(parts)} ({tz})"
+
+
+def week_minute(moment=None):
+    """Minutes since Monday 00:00 UTC."""
+    moment = moment or arrow.utcnow()
+    return moment.weekday() * DAY + moment.hour * 60 + moment.minute
+
+
+class IntervalIndex:
+    """
+    The week in UTC cut at every shift start/end; each elementary segment holds
+    the frozenset of agents on shift during it. A lookup is a bisect over the
+    cut points (a few µs); a rebuild is O(n log n) in the number of intervals.
+    """
+
+    def __init__(self):
+        self._points = [0]          # segment i covers [points[i], points[i+1])
+        self._segments = [frozenset()]
+        self._languages = {}        # {language: frozenset(agent_id)}
+
+    @classmethod
+    def build(cls, agents):
+        """`agents`: [(agent_id, languages, tz, [(start, end)] local)]."""
+        index = cls()
+        events = {}     # {utc minute: [(agent_id, +1 / -1)]}
+        offsets = {}
+        languages = {}
+        for agent_id, langs, tz, intervals in agents:
+            if tz not in offsets:
+                try:
+                    offsets[tz] = utc_offset(tz)
+                except Exception:
+                    offsets[tz] = utc_offset(default_tz())
+            for lang in langs:
+                languages.setdefault(lang, set()).add(agent_id)
+            for start, end in intervals:
+                start, end = (start - offsets[tz]) % WEEK, (end - offsets[tz]) % WEEK or WEEK
+                pieces = [(start, end)] if start < end else [(start, WEEK), (0, end)]
+                for s, e in pieces:
+                    events.setdefault(s, []).append((agent_id, 1))
+                    events.setdefault(e, []).append((agent_id, -1))
+        events.setdefault(0, [])
+        count = {}
+        on = set()
+        points, segments = [], []
+        for minute in sorted(events):
+            for agent_id, delta in events[minute]:
+                n = count[agent_id] = count.get(agent_id, 0) + delta
+                if n > 0:
+                    on.add(agent_id)
+                else:
+                    on.discard(agent_id)
+            if minute >= WEEK:
+                break
+            points.append(minute)
+            segments.append(frozenset(on))
+        index._points, index._segments = points, segments
+        index._languages = {lang: frozenset(ids) for lang, ids in languages.items()}
+        return index
+
+    def at(self, minute, language=None):
+        """Agents on shift at UTC week minute `minute` (speaking `language` if given)."""
+        agents = self._segments[bisect.bisect_right(self._points, minute % WEEK) - 1]
+        if language is None:
+            return agents
+        return agents & self._languages.get(language, frozenset())
+
+    def __len__(self):
+        return len(self._points)
+
+
+_index = IntervalIndex()
+_scheduled = frozenset()    # agents with any hours on file
+_overrides = {}             # {agent_id: bool} from /shift on|off
+_languages = {}             # {agent_id: frozenset(language)}
+_lock = threading.Lock()
+
+
+def load(rows):
+    """
+    Rebuild from [{"user_id", "languages", "timezone", "on_shift", "shifts": [(start, end)]}]
+    (on_shift is the manual override: None follows the schedule).
+    """
+    global _index, _scheduled, _overrides, _languages
+    index = IntervalIndex.build([(r['user_id'], r['languages'], r['timezone'] or default_tz(), r['shifts'])
+                                 for r in rows])
+    with _lock:
+        _index = index
+        _scheduled = frozenset(r['user_id'] for r in rows if r['shifts'])
+        _overrides = {r['user_id']: bool(r['on_shift']) for r in rows if r['on_shift'] is not None}
+        _languages = {r['user_id']: frozenset(r['languages']) for r in rows}
+
+
+def set_override(agent_id, on_shift):
+    """/shift on (True), off (False) or auto (None)."""
+    with _lock:
+        if on_shift is None:
+            _overrides.pop(agent_id, None)
+        else:
+            _overrides[agent_id] = bool(on_shift)
+
+
+def on_shift_now(language=None):
+    """Agents on shift right now, by schedule or override (speaking `language` if given)."""
+    with _lock:
+        index, overrides, languages = _index, dict(_overrides), _languages
+    agents = set(index.at(week_minute(), language))
+    for agent_id, on in overrides.items():
+        if on and (language is None or language in languages.get(agent_id, ())):
+            agents.add(agent_id)
+        elif not on:
+            agents.discard(agent_id)
+    return agents
+
+
+def status(agent_id):
+    """True / False if the agent is on / off shift now, None if they have no hours and no override."""
+    with _lock:
+        if agent_id in _overrides:
+            return _overrides[agent_id]
+        if agent_id not in _scheduled:
+            return None
+        index = _index
+    return agent_id in index.at(week_minute())
+
+
+# ------------- Benchmark ------------- #
+def bench(n):
+    rnd = random.Random(1)
+    langs = ['en', 'de', 'es', 'fr', 'it', 'pt', 'ru', 'tr']
+    zones = ['UTC', 'Europe/Berlin', 'America/New_York', 'Asia/Tokyo', '+05:30']
+    agents = []
+    for agent_id in range(n):
+        start = rnd.randrange(0, 24) * 60 + rnd.choice([0, 15, 30, 45])
+        days = rnd.sample(range(7), 5)
+        shifts = merge([(d * DAY + start, min(WEEK, d * DAY + start + rnd.choice([240, 480, 600])))
+                        for d in days])
+        agents.append((agent_id, rnd.sample(langs, 2), rnd.choice(zones), shifts))
+    started = time.monotonic()
+    index = IntervalIndex.build(agents)
+    print(f"{n} agents, {sum(len(a[3]) for a in agents)} intervals: built in "
+          f"{(time.monotonic() - started) * 1000:.1f} ms, {len(index)} segments")
+    minutes = [rnd.randrange(WEEK) for _ in range(100000)]
+    started = time.monotonic()
+    for m in minutes:
+        index.at(m, 'de')
+    print(f"on shift now + language: {(time.monotonic() - started) * 1e6 / len(minutes):.2f} µs per query")
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[sys.argv.index('--bench') + 1]) if '--bench' in sys.argv else 1000)
@@ -0,0 +1,105 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : conversation.py       #
+# --------------------------------------------- #
+# Multi-step conversations (e.g. /become_agent) as small state machines. A user
+# in a conversation is one `conversations` row: flow id, state number and the
+# answers so far as compact JSON, with an expiry. Nothing is held in memory, so
+# abandoned flows cost a row until the purge job drops it and survive restarts.
+#
+# A step handler gets (message, payload) and returns (next_state, payload) to
+# move on, (same_state, payload) to ask again, or None when the flow is done.
+# After `max_retries` answers in a row that only got the question again, the
+# flow lets go: the user is told and the message is handled as if there were
+# no conversation. /cancel (cancel()) ends one at any time.
+
+import json
+
+from resources import mysql_handler as mysql
+
+_flows = {}     # {flow_id: Flow}
+
+END, SAVE, GIVE_UP = range(3)       # what a step's result means (Flow._outcome)
+
+
+class Flow:
+    def __init__(self, flow_id, ttl=3600, max_retries=3, gave_up=None):
+        self.flow_id = int(flow_id)
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.gave_up = gave_up      # fn(message) after too many invalid answers
+        self._steps = {}        # {state: handler(message, payload)}
+        _flows[self.flow_id] = self
+
+    def step(self, state):
+        """Decorator registering the handler for `state`."""
+        def register(fn):
+            self._steps[int(state)] = fn
+            return fn
+        return register
+
+    def start(self, user_id, state, payload=None):
+        """Enter `state`, replacing any conversation the user was in."""
+        mysql.save_conversation(user_id, self.flow_id, int(state), _encode(payload or {}), self.ttl)
+
+    def _advance(self, message, state, payload):
+        """Returns False when the message is not the flow's after all (see max_retries)."""
+        user_id = message.from_user.id
+        handler = self._steps.get(state)
+        if handler is None:         # state no longer exists in the code
+            mysql.end_conversation(user_id)
+            return False
+        outcome, next_state, payload = self._outcome(state, handler(message, payload))
+        if outcome == SAVE:
+            mysql.save_conversation(user_id, self.flow_id, next_state, _encode(payload), self.ttl)
+            return True
+        mysql.end_conversation(user_id)
+        if outcome == GIVE_UP:
+            if self.gave_up:
+                self.gave_up(message)
+            return False
+        return True
+
+    def _outcome(self, state, result):
+        """(END / SAVE / GIVE_UP, next_state, payload) for a step handler's result."""
+        if result is None:
+            return END, None, None
+        next_state, payload = result
+        if int(next_state) == state:
+            payload['_retries'] = payload.get('_retries', 0) + 1
+            if payload['_retries'] > self.max_retries:
+                return GIVE_UP, None, None
+        else:
+            payload.pop('_retries', None)
+        return SAVE, int(next_state), payload
+
+
+def dispatch(message, conversation):
+    """
+    Feed `message` to the conversation loaded with it (see load_message_context).
+    Returns True when it was consumed.
+    """
+    if not conversation:
+        return False
+    flow = _flows.get(conversation['flow'])
+    if flow is None:
+        mysql.end_conversation(message.from_user.id)
+        return False
+    return flow._advance(message, conversation['state'], _decode(conversation['payload']))
+
+
+def cancel(user_id):
+    """End whatever conversation the user is in; False if there was none."""
+    return mysql.end_conversation(user_id) > 0
+
+
+def _encode(payload):
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+def _decode(raw):
+    try:
+        return json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
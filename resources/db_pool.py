@@ -0,0 +1,146 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : db_pool.py            #
+# --------------------------------------------- #
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time."""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of DB-API connections.
+
+    Connections are created lazily by `factory` up to `size`. On checkout a
+    connection older than `recycle` seconds is replaced, and one that sat idle
+    for more than `ping_idle` seconds is pinged first (0 = ping every time).
+    """
+
+    def __init__(self, factory, size=10, recycle=3600, timeout=10, ping_idle=30):
+        self._factory = factory
+        self._size = max(1, int(size))
+        self._recycle = recycle
+        self._timeout = timeout
+        self._ping_idle = ping_idle
+        self._cond = threading.Condition()
+        self._idle = deque()        # (conn, created_at, released_at)
+        self._born = {}             # id(conn) -> created_at
+        self._created = 0
+        self._in_use = 0
+        self._stats = {
+            'checkouts': 0, 'waits': 0, 'timeouts': 0,
+            'recycled': 0, 'discarded': 0,
+            'checkout_total_ms': 0.0, 'checkout_max_ms': 0.0,
+        }
+
+    # ------------- Checkout / Release ------------- #
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        conn = None
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, created, released = self._idle.pop()
+                    break
+                if self._created < self._size:
+                    self._created += 1
+                    break
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"no DB connection available after {self._timeout}s")
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            now = time.monotonic()
+            if conn is None:
+                conn = self._new()
+            elif now - created > self._recycle:
+                self._close(conn)
+                conn = self._new()
+                with self._cond:
+                    self._stats['recycled'] += 1
+            elif now - released >= self._ping_idle:
+                conn.ping(reconnect=True)
+        except Exception:
+            if conn is not None:
+                self._close(conn)
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed_ms = (time.monotonic() - start) * 1000
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['checkout_total_ms'] += elapsed_ms
+            self._stats['checkout_max_ms'] = max(self._stats['checkout_max_ms'], elapsed_ms)
+        return conn
+
+    def release(self, conn, discard=False):
+        if discard or not getattr(conn, 'open', True):
+            self._close(conn)
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._stats['discarded'] += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn, self._born.get(id(conn), time.monotonic()), time.monotonic()))
+            self._in_use -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=not getattr(conn, 'open', True))
+            raise
+        self.release(conn)
+
+    # ------------- Housekeeping ------------- #
+    def close_all(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._created -= len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s.update(size=self._size, open=self._created, idle=len(self._idle), in_use=self._in_use)
+        total = s.pop('checkout_total_ms')
+        s['checkout_avg_ms'] = round(total / s['checkouts'], 3) if s['checkouts'] else 0.0
+        s['checkout_max_ms'] = round(s['checkout_max_ms'], 3)
+        return s
+
+    def _new(self):
+        conn = self._factory()
+        self._born[id(conn)] = time.monotonic()
+        return conn
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
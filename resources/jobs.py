@@ -0,0 +1,25 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : jobs.py               #
+# --------------------------------------------- #
+# Tiny periodic-job runner for DB maintenance (rollups, reconciliation).
+
+import threading
+import time
+
+
+def _loop(fn, interval, name):
+    while True:
+        time.sleep(interval)
+        try:
+            fn()
+        except Exception as e:
+            print(f"⚠️ Background job '{name}' failed:", e)
+
+
+def every(interval, fn, name):
+    """Run `fn()` every `interval` seconds on a daemon thread; errors are logged, not raised."""
+    t = threading.Thread(target=_loop, args=(fn, interval, name), name=name, daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,70 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : media_groups.py       #
+# --------------------------------------------- #
+# Albums arrive as one update per photo/video, sharing a media_group_id. They
+# are held here for media_group_wait seconds after the first part and then
+# handled once, as a list, so the album is relayed with a single copyMessages.
+
+import threading
+import time
+
+import config
+
+_groups = {}        # {media_group_id: {"chat_id": int, "messages": [Message]}}
+_lock = threading.Lock()
+
+
+def wait():
+    return getattr(config, 'media_group_wait', 1.0)
+
+
+def add(message):
+    """Buffer an album part; True for the first part of its album."""
+    with _lock:
+        group = _groups.get(message.media_group_id)
+        if group is None:
+            _groups[message.media_group_id] = {"chat_id": message.chat.id, "messages": [message]}
+            return True
+        group["messages"].append(message)
+        return False
+
+
+def take(media_group_id):
+    """The album's parts in order, or None if it was already taken."""
+    with _lock:
+        group = _groups.pop(media_group_id, None)
+    return sorted(group["messages"], key=lambda m: m.message_id) if group else None
+
+
+def take_chat(chat_id):
+    """Every album still buffered for `chat_id` (to handle before a newer message)."""
+    with _lock:
+        ids = [gid for gid, g in _groups.items() if g["chat_id"] == chat_id]
+    return [album for album in map(take, ids) if album]
+
+
+def hold(message, handler, run=None):
+    """
+    Buffer `message` if it is an album part and return True; `handler(parts)`
+    is then called once per album, through `run(fn)` if given (e.g. the user's
+    update queue). Messages outside an album return False.
+    """
+    if not message.media_group_id:
+        return False
+    if add(message):
+        gid = message.media_group_id
+
+        def fire():
+            time.sleep(wait())
+            (run or (lambda fn: fn()))(lambda: _handle(gid, handler))
+
+        threading.Thread(target=fire, name='media-group', daemon=True).start()
+    return True
+
+
+def _handle(media_group_id, handler):
+    album = take(media_group_id)
+    if album:
+        handler(album)
@@ -0,0 +1,96 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : membership.py         #
+# --------------------------------------------- #
+# In-memory sets of user ids (banned users) mirroring a users flag. Loaded from the DB on first use rather than at import, kept in step by
+# the lifecycle functions after they commit, and re-read now and then in case
+# something else changed the table.
+#
+# With a shared state backend (several bot processes) the ids live there as a set
+# instead, next to a marker key; whichever process finds the marker gone reloads.
+
+import threading
+
+
+class IdSet:
+    def __init__(self, name, loader, store=None, ttl=900):
+        self.name = name
+        self._loader = loader       # () -> iterable of user ids
+        self._store = store         # shared state backend, or None to keep the set here
+        self._ttl = ttl             # seconds a shared copy is trusted before a reload
+        self._ids = None            # set, once loaded
+        self._journal = None        # [(op, user_id)] made while a reload is running
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def _apply(self, op, user_id):
+        if self._store is not None:
+            (self._store.sadd if op else self._store.srem)(self.name, user_id)
+            return
+        with self._lock:
+            if self._ids is not None:
+                (self._ids.add if op else self._ids.discard)(user_id)
+            if self._journal is not None:
+                self._journal.append((op, user_id))
+
+    def add(self, user_id):
+        self._apply(True, user_id)
+
+    def discard(self, user_id):
+        self._apply(False, user_id)
+
+    def _loaded(self):
+        ids = self._ids
+        if ids is None:
+            with self._reload_lock:
+                ids = self._ids if self._ids is not None else self._reload()
+        return ids
+
+    def _shared_loaded(self):
+        if not self._store.get(self.name + ':loaded'):
+            self.reload()
+
+    def __contains__(self, user_id):
+        if self._store is not None:
+            self._shared_loaded()
+            return self._store.sismember(self.name, user_id)
+        return user_id in self._loaded()
+
+    def __len__(self):
+        if self._store is not None:
+            self._shared_loaded()
+            return self._store.scard(self.name)
+        return len(self._loaded())
+
+    def reload(self):
+        """
+        Re-read the ids from the DB and swap them in. Changes made while the
+        query runs are replayed on top, so they are not lost. Returns the new set
+        and logs how far the old one had drifted. In shared mode the set is
+        swapped whole; a change racing the query is fixed by the next reload.
+        """
+        if self._store is not None:
+            fresh = set(self._loader())
+            self._store.sreplace(self.name, fresh)
+            self._store.set(self.name + ':loaded', 1, ttl=self._ttl)
+            return fresh
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        with self._lock:
+            self._journal = []
+        try:
+            fresh = set(self._loader())
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+        with self._lock:
+            for op, user_id in self._journal:
+                (fresh.add if op else fresh.discard)(user_id)
+            old, self._ids, self._journal = self._ids, fresh, None
+        if old is not None and old != fresh:
+            print(f"ℹ️ {self.name}: {len(fresh - old)} missing / {len(old - fresh)} stale ids corrected")
+        return fresh
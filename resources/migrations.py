@@ -0,0 +1,364 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : migrations.py         #
+# --------------------------------------------- #
+# Versioned schema migrations. Applied versions are recorded in schema_version,
+# so a warm start costs one SELECT. Steps marked background (index builds,
+# backfills) run on a thread with online DDL while the bot is already serving;
+# the code must work without them, they only make it faster.
+#
+# Every step is idempotent, so a step that was interrupted is simply re-run.
+# Add new steps at the end with the next version number; never edit an applied one.
+
+import threading
+
+import pymysql
+
+from resources import availability
+from resources import mysql_handler as mysql
+
+_LOCK = 'tsb_schema_migrations'         # MySQL named lock: one migrator per database
+_BG_LOCK = 'tsb_schema_migrations_bg'
+
+
+# ------------- Helpers ------------- #
+def _table_exists(cur, name):
+    cur.execute("SHOW TABLES LIKE %s", (name,))
+    return cur.fetchone() is not None
+
+def _column_exists(cur, table, column):
+    cur.execute(f"SHOW COLUMNS FROM `{table}` LIKE %s", (column,))
+    return cur.fetchone() is not None
+
+def _index_exists(cur, table, name):
+    cur.execute(f"SHOW INDEX FROM `{table}` WHERE Key_name = %s", (name,))
+    return cur.fetchone() is not None
+
+def _add_columns(c, table, columns):
+    for col, ddl in columns:
+        if not _column_exists(c, table, col):
+            c.execute(f"ALTER TABLE `{table}` ADD COLUMN {ddl}")
+
+
+# ------------- Steps ------------- #
+def _core_tables(c):
+    # USERS
+    if not _table_exists(c, "users"):
+        c.execute("""
+            CREATE TABLE users (
+              userid            BIGINT      NOT NULL PRIMARY KEY,
+              open_ticket       TINYINT(1)  NOT NULL DEFAULT 0,
+              banned            TINYINT(1)  NOT NULL DEFAULT 0,
+              open_ticket_spam  INT         NOT NULL DEFAULT 1,
+              open_ticket_link  VARCHAR(255)        DEFAULT NULL,
+              open_ticket_time  DATETIME    NOT NULL DEFAULT '1000-01-01 00:00:00',
+              claimed_by        BIGINT              DEFAULT NULL,
+              claim_time        DATETIME            DEFAULT NULL,
+              language          VARCHAR(5)          DEFAULT NULL,
+              current_ticket_id BIGINT              DEFAULT NULL
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+    else:
+        _add_columns(c, "users", [
+            ("claimed_by",        "claimed_by BIGINT DEFAULT NULL"),
+            ("claim_time",        "claim_time DATETIME NULL AFTER claimed_by"),
+            ("current_ticket_id", "current_ticket_id BIGINT NULL AFTER language"),
+        ])
+
+    # AGENTS
+    if not _table_exists(c, "agents"):
+        c.execute("""
+            CREATE TABLE agents (
+              id               INT           NOT NULL AUTO_INCREMENT PRIMARY KEY,
+              user_id          BIGINT        NOT NULL UNIQUE,
+              full_name        VARCHAR(100)           DEFAULT NULL,
+              languages        TEXT                   DEFAULT NULL,
+              availability     TEXT                   DEFAULT NULL,
+              commission_rate  DECIMAL(6,4)  NOT NULL DEFAULT 0,
+              total_earnings   DECIMAL(12,2) NOT NULL DEFAULT 0,
+              tickets_claimed  INT           NOT NULL DEFAULT 0,
+              tickets_resolved INT           NOT NULL DEFAULT 0,
+              approved_at      DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+    else:
+        _add_columns(c, "agents", [
+            ("commission_rate",  "commission_rate  DECIMAL(6,4)  NOT NULL DEFAULT 0"),
+            ("total_earnings",   "total_earnings   DECIMAL(12,2) NOT NULL DEFAULT 0"),
+            ("tickets_claimed",  "tickets_claimed  INT NOT NULL DEFAULT 0"),
+            ("tickets_resolved", "tickets_resolved INT NOT NULL DEFAULT 0"),
+        ])
+
+    # PENDING_AGENTS
+    if not _table_exists(c, "pending_agents"):
+        c.execute("""
+            CREATE TABLE pending_agents (
+              id           INT          NOT NULL AUTO_INCREMENT PRIMARY KEY,
+              user_id      BIGINT       NOT NULL UNIQUE,
+              full_name    VARCHAR(100)          DEFAULT NULL,
+              languages    TEXT                   DEFAULT NULL,
+              availability TEXT                   DEFAULT NULL,
+              requested_at DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+
+    # TICKETS
+    if not _table_exists(c, "tickets"):
+        c.execute("""
+            CREATE TABLE tickets (
+              id                 BIGINT       NOT NULL AUTO_INCREMENT PRIMARY KEY,
+              user_id            BIGINT       NOT NULL,
+              opened_at          DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              closed_at          DATETIME              DEFAULT NULL,
+              resolved           TINYINT(1)   NOT NULL DEFAULT 0,
+              claimed_by         BIGINT                DEFAULT NULL,
+              first_message_link VARCHAR(255)          DEFAULT NULL,
+              last_message_link  VARCHAR(255)          DEFAULT NULL,
+              INDEX idx_ticket_user_state (user_id, resolved, closed_at),
+              INDEX idx_ticket_claim_open (claimed_by, closed_at),
+              INDEX idx_ticket_open       (closed_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+
+def _user_profiles(c):
+    # USER_PROFILES (display names, so listings need no Telegram API calls)
+    if not _table_exists(c, "user_profiles"):
+        c.execute("""
+            CREATE TABLE user_profiles (
+              userid        BIGINT       NOT NULL PRIMARY KEY,
+              first_name    VARCHAR(255)          DEFAULT NULL,
+              last_name     VARCHAR(255)          DEFAULT NULL,
+              username      VARCHAR(64)           DEFAULT NULL,
+              language_code VARCHAR(16)           DEFAULT NULL,
+              updated_at    DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              INDEX idx_profile_updated (updated_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+    else:
+        _add_columns(c, "user_profiles", [
+            ("username",      "username      VARCHAR(64) NULL AFTER last_name"),
+            ("language_code", "language_code VARCHAR(16) NULL AFTER username"),
+        ])
+
+def _earnings_ledger(c):
+    # EARNINGS_LEDGER (append-only, one row per paid ticket) + rollups
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS earnings_ledger (
+          id        BIGINT        NOT NULL AUTO_INCREMENT PRIMARY KEY,
+          ticket_id BIGINT        NOT NULL UNIQUE,
+          agent_id  BIGINT        NOT NULL,
+          amount    DECIMAL(12,2) NOT NULL,
+          rate      DECIMAL(6,4)  NOT NULL,
+          ts        DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          INDEX idx_ledger_agent (agent_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS agent_daily_earnings (
+          agent_id         BIGINT        NOT NULL,
+          day              DATE          NOT NULL,
+          tickets_resolved INT           NOT NULL DEFAULT 0,
+          earnings         DECIMAL(12,2) NOT NULL DEFAULT 0,
+          PRIMARY KEY (agent_id, day)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+          name    VARCHAR(32) NOT NULL PRIMARY KEY,
+          last_id BIGINT      NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    c.execute("INSERT IGNORE INTO rollup_state (name, last_id) VALUES ('earnings', 0)")
+
+def _stats_counters(c):
+    # STATS_COUNTERS (seeded by the background step below)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+          name  VARCHAR(32)   NOT NULL,
+          slot  TINYINT       NOT NULL,
+          value DECIMAL(16,2) NOT NULL DEFAULT 0,
+          PRIMARY KEY (name, slot)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+# Secondary indexes for the hot queries (checked by resources/query_catalogue.py)
+INDEXES = [
+    ("users",   "idx_users_claim",        "claimed_by, open_ticket"),       # agent's active tickets / DM routing
+    ("users",   "idx_users_open",         "open_ticket, open_ticket_time"), # /tickets, oldest first
+    ("users",   "idx_users_banned",       "banned"),                        # /banned
+    ("tickets", "idx_ticket_user_state",  "user_id, resolved, closed_at"),  # last unresolved ticket
+    ("tickets", "idx_ticket_claim_open",  "claimed_by, closed_at"),         # agent's open ticket
+    ("agents",  "idx_agents_resolved",    "tickets_resolved"),              # top agents
+]
+# Superseded by a composite index above (leftmost prefix)
+DROPPED_INDEXES = [
+    ("tickets", "idx_ticket_user"),
+    ("tickets", "idx_ticket_claim"),
+]
+
+def _query_indexes(c):
+    # Online DDL: reads and writes on the table carry on while the index builds
+    for table, name, columns in INDEXES:
+        if not _index_exists(c, table, name):
+            c.execute(f"ALTER TABLE `{table}` ADD INDEX {name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    for table, name in DROPPED_INDEXES:
+        if _index_exists(c, table, name):
+            c.execute(f"ALTER TABLE `{table}` DROP INDEX {name}, ALGORITHM=INPLACE, LOCK=NONE")
+
+def _seed_stats_counters(c):
+    mysql.reconcile_stats_counters()
+
+def _conversations(c):
+    # CONVERSATIONS (one in-progress multi-step flow per user, see resources/conversation.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+          user_id    BIGINT           NOT NULL PRIMARY KEY,
+          flow       TINYINT UNSIGNED NOT NULL,
+          state      TINYINT UNSIGNED NOT NULL,
+          payload    VARCHAR(1024)    NOT NULL DEFAULT '',
+          expires_at DATETIME         NOT NULL,
+          INDEX idx_conv_expires (expires_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+def _ticket_messages(c):
+    # TICKET_MESSAGES (every relayed message of a ticket, written in batches by resources/transcript.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+          id           BIGINT          NOT NULL AUTO_INCREMENT PRIMARY KEY,
+          ticket_id    BIGINT                   DEFAULT NULL,
+          user_id      BIGINT          NOT NULL,
+          direction    ENUM('in','out') NOT NULL,
+          sender_id    BIGINT          NOT NULL,
+          content_type VARCHAR(16)     NOT NULL,
+          text         TEXT                     DEFAULT NULL,
+          file_id      VARCHAR(255)             DEFAULT NULL,
+          message_id   BIGINT                   DEFAULT NULL,
+          ts           DATETIME        NOT NULL,
+          INDEX idx_tm_ticket (ticket_id, id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+def _transcript_fulltext(c):
+    # The first FULLTEXT index on a table rebuilds it (adds FTS_DOC_ID), which only allows LOCK=SHARED:
+    # transcript writes wait meanwhile and stay buffered in resources/transcript.py.
+    if not _index_exists(c, "ticket_messages", "ft_tm_text"):
+        c.execute("ALTER TABLE ticket_messages ADD FULLTEXT INDEX ft_tm_text (text), ALGORITHM=INPLACE, LOCK=SHARED")
+
+def _agent_shift(c):
+    # Manual on/off shift toggle (/shift), read by resources/routing.py
+    _add_columns(c, "agents", [
+        ("on_shift", "on_shift TINYINT(1) NOT NULL DEFAULT 0 AFTER availability"),
+    ])
+
+def _agent_availability(c):
+    # Weekly hours (resources/availability.py). agents.on_shift becomes the manual
+    # /shift override, NULL = follow the hours; 0 was only ever the default.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS agent_shifts (
+          agent_id  BIGINT            NOT NULL,
+          start_min SMALLINT UNSIGNED NOT NULL,
+          end_min   SMALLINT UNSIGNED NOT NULL,
+          PRIMARY KEY (agent_id, start_min)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    _add_columns(c, "agents", [
+        ("timezone", "timezone VARCHAR(64) DEFAULT NULL AFTER availability"),
+    ])
+    c.execute("ALTER TABLE agents MODIFY on_shift TINYINT(1) DEFAULT NULL")
+    c.execute("UPDATE agents SET on_shift=NULL WHERE on_shift=0")
+    # Backfill from the free text collected so far; what can't be read for sure
+    # ("9-5": afternoon or night?) stays text only, until the agent sets /availability
+    c.execute("SELECT user_id, availability FROM agents WHERE availability IS NOT NULL AND timezone IS NULL")
+    for row in c.fetchall():
+        try:
+            tz, intervals = availability.parse(row['availability'], strict=True)
+        except ValueError:
+            continue
+        mysql.write_agent_shifts(c, row['user_id'], tz, intervals)
+
+# (version, name, step, background)
+MIGRATIONS = [
+    (1, "core tables",          _core_tables,         False),
+    (2, "user profiles",        _user_profiles,       False),
+    (3, "earnings ledger",      _earnings_ledger,     False),
+    (4, "stats counters",       _stats_counters,      False),
+    (5, "query indexes",        _query_indexes,       True),
+    (6, "seed stats counters",  _seed_stats_counters, True),
+    (7, "conversations",        _conversations,       False),
+    (8, "ticket transcripts",   _ticket_messages,     False),
+    (9, "transcript fulltext",  _transcript_fulltext, True),
+    (10, "agent shift",         _agent_shift,         False),
+    (11, "agent availability",  _agent_availability,  False),
+]
+
+
+# ------------- Runner ------------- #
+def applied_versions(c):
+    try:
+        c.execute("SELECT version FROM schema_version")
+    except pymysql.err.ProgrammingError as e:
+        if e.args[0] != 1146:       # table doesn't exist
+            raise
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+              version    INT          NOT NULL PRIMARY KEY,
+              name       VARCHAR(64)  NOT NULL,
+              applied_at DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+        return set()
+    return {r['version'] for r in c.fetchall()}
+
+def _apply(steps, lock):
+    """Run `steps` in order under a named lock; stops at the first failure. Returns True if all applied."""
+    conn = mysql.getConnection()        # own session: long DDL must not hold a pool slot
+    try:
+        with conn.cursor() as c:
+            c.execute("SELECT GET_LOCK(%s, 600) AS ok", (lock,))
+            if not c.fetchone()['ok']:
+                print("❌ Timed out waiting for another instance's migrations")
+                return False
+            try:
+                done = applied_versions(c)     # another instance may have got here first
+                for version, name, step, _ in steps:
+                    if version in done:
+                        continue
+                    try:
+                        step(c)
+                    except Exception as e:
+                        print(f"❌ Migration {version} ({name}) failed:", e)
+                        return False
+                    c.execute("INSERT IGNORE INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+                    print(f"✅ Migration {version} ({name}) applied")
+                return True
+            finally:
+                c.execute("SELECT RELEASE_LOCK(%s)", (lock,))
+    finally:
+        conn.close()
+
+def run(wait=False):
+    """
+    Apply pending migrations. Foreground steps finish before this returns;
+    background steps run on a thread afterwards, or inline with wait=True.
+    """
+    try:
+        with mysql.db_cursor() as c:
+            done = applied_versions(c)
+    except Exception as e:
+        print("❌ DB migration failed:", e)
+        return
+    pending = [m for m in MIGRATIONS if m[0] not in done]
+    if not pending:
+        return
+    foreground = [m for m in pending if not m[3]]
+    background = [m for m in pending if m[3]]
+    if foreground and not _apply(foreground, _LOCK):
+        return
+    if not background:
+        return
+    if wait:
+        _apply(background, _BG_LOCK)
+    else:
+        threading.Thread(target=_apply, args=(background, _BG_LOCK), name='bg-migrations', daemon=True).start()
@@ -7,9 +7,15 @@
 import config
 from resources import mysql_handler as mysql
 from resources import lang_emojis as emoji
+from resources import outbound
+from resources import profile_store as profiles
+from resources import spam_guard
+from resources import transcript
+from resources import word_filter
 import re
 import arrow
 import traceback
+from concurrent.futures import Future
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -18,211 +24,228 @@ def getReferrer(text):
     return parts[1] if len(parts) > 1 else None
 
 
+# Everything users and agents may send; relayed with copyMessage as it is
+RELAY_TYPES = ['text', 'photo', 'video', 'animation', 'document', 'audio', 'voice', 'video_note',
+               'sticker', 'location', 'venue', 'contact', 'poll', 'dice']
+# Types that carry a caption (so the "who / #id" header can go on the copy itself)
+CAPTIONED = {'photo', 'video', 'animation', 'document', 'audio', 'voice'}
+
+
 def msg_type(message):
-    if message.content_type == 'text':
-        return message.text
-    elif message.content_type in ['photo', 'document']:
-        return message.caption or ''
-    return ''
+    return message.text or message.caption or ''
 
 
 def getUserID(message):
     src = message.reply_to_message
-    if src.content_type == 'text':
-        return int(src.text.split('(#id')[1].split(')')[0])
-    elif src.content_type in ['photo', 'document']:
-        return int(src.caption.split('(#id')[1].split(')')[0])
+    text = src.text or src.caption
+    if text and '(#id' in text:
+        return int(text.split('(#id')[1].split(')')[0])
     return None
 
 
 def msgCheck(message):
     src = message.reply_to_message
-    if src.content_type == 'text':
-        return src.text
-    elif src.content_type in ['photo', 'document']:
-        return src.caption
-    return ''
+    return src.text or src.caption or ''
+
+
+def as_album(message):
+    """A single message or an album (list of parts) as a list."""
+    return message if isinstance(message, list) else [message]
 
 
 def msgCaption(message):
     return message.caption if message.caption else ''
 
 
+def display_name(first_name, last_name, fallback='User'):
+    name = f"{first_name or ''}{f' {last_name}' if last_name else ''}".strip()
+    return name or fallback
+
+
+def transcript_line(row):
+    """One ticket_messages row as a plain-text line for /transcript."""
+    who = '👤' if row['direction'] == 'in' else '🎧'
+    body = row['text'] or ''
+    if row['content_type'] != 'text':
+        body = f"[{row['content_type']}] {body}".strip()
+    return f"{row['ts']:%d.%m %H:%M} {who} {body}\n"
+
+
+def send_chunked(bot, chat_id, header, lines, limit=4000, **kwargs):
+    """Send `header` + `lines` split over as few messages as Telegram's size limit allows."""
+    text = header
+    for line in lines:
+        if len(text) + len(line) > limit and text != header:
+            outbound.send(bot.send_message, chat_id, text, **kwargs)
+            text = header
+        text += line
+    outbound.send(bot.send_message, chat_id, text, **kwargs)
+
+
 # (Support -> User Handler)
-def snd_handler(user_id, bot, message, txt):
+def snd_handler(user_id, bot, message, txt=None):
+    """Copy an agent's message (or album) to the user, signed with the team line."""
+    parts = as_album(message)
+    first = parts[0]
+    sign = config.text_messages['support_response'].format(profiles.first_name(user_id))
     try:
-        if message.content_type == 'text':
-            bot.send_chat_action(user_id, 'typing')
-            bot.send_message(
+        if len(parts) > 1:
+            outbound.send(bot.send_message, user_id, sign, parse_mode='Markdown')
+            outbound.send(bot.copy_messages, user_id, first.chat.id, [m.message_id for m in parts])
+        elif first.content_type == 'text':
+            outbound.send(
+                bot.send_message,
                 user_id,
-                config.text_messages['support_response'].format(bot.get_chat(user_id).first_name) + f'\n\n{message.text}',
+                sign + f'\n\n{first.text}',
                 parse_mode='Markdown',
                 disable_web_page_preview=True
             )
-
-        elif message.content_type == 'photo':
-            bot.send_chat_action(user_id, 'upload_photo')
-            bot.send_photo(
-                user_id,
-                message.photo[-1].file_id,
-                caption=config.text_messages['support_response'].format(bot.get_chat(user_id).first_name) + f'\n\n{msgCaption(message)}',
-                parse_mode='Markdown'
-            )
-
-        elif message.content_type == 'document':
-            bot.send_chat_action(user_id, 'upload_document')
-            bot.send_document(
-                user_id,
-                message.document.file_id,
-                caption=config.text_messages['support_response'].format(bot.get_chat(user_id).first_name) + f'\n\n{msgCaption(message)}',
-                parse_mode='Markdown'
-            )
+        elif first.content_type in CAPTIONED:
+            outbound.send(bot.copy_message, user_id, first.chat.id, first.message_id,
+                          caption=sign + f'\n\n{msgCaption(first)}', parse_mode='Markdown')
         else:
-            bot.reply_to(message, '❌ That format is not supported.')
+            outbound.send(bot.copy_message, user_id, first.chat.id, first.message_id)
+
+        for m in parts:
+            transcript.record(user_id, transcript.OUT, m)
+        # The team answered: the user may write freely again
+        spam_guard.reset(user_id)
     except Exception as e:
         print("❌ Failed to send message to user:", e)
         traceback.print_exc()
         try:
-            bot.reply_to(message, '❌ That format is not supported.')
+            outbound.reply_to(bot, first, '❌ That format is not supported.')
         except Exception:
             pass
 
 def snd_to_agent(agent_id, bot, message):
     """
-    Send the user's private message to the claiming agent (in the agent's DM).
+    Copy the user's private message (or album) to the claiming agent's DM.
     """
+    parts = as_album(message)
+    first = parts[0]
     try:
-        if message.content_type == 'text':
-            bot.send_chat_action(agent_id, 'typing')
-            bot.send_message(
-                agent_id,
-                f"{message.text}",
-                parse_mode='Markdown',
-                disable_web_page_preview=True
-            )
-
-        elif message.content_type == 'photo':
-            bot.send_chat_action(agent_id, 'upload_photo')
-            bot.send_photo(
-                agent_id,
-                message.photo[-1].file_id,
-                caption=f"{msgCaption(message)}",
-                parse_mode='Markdown'
-            )
-
-        elif message.content_type == 'document':
-            bot.send_chat_action(agent_id, 'upload_document')
-            bot.send_document(
-                agent_id,
-                message.document.file_id,
-                caption=f"{msgCaption(message)}",
-                parse_mode='Markdown'
-            )
-
+        if len(parts) > 1:
+            outbound.send(bot.copy_messages, agent_id, first.chat.id, [m.message_id for m in parts])
         else:
-            # Ignore unsupported types or add more handlers (voice, video, etc.)
-            pass
-
+            outbound.send(bot.copy_message, agent_id, first.chat.id, first.message_id)
+        for m in parts:
+            transcript.record(first.from_user.id, transcript.IN, m)
     except Exception as e:
         print("❌ Failed to DM agent:", e)
 
 
-def fwd_handler(user_id, bot, message):
-    # Update the Spamfilter
-    mysql.spam(message.chat.id)
-
-    # Capture and save user language
-    lang_code = message.from_user.language_code
-    lang_emoji = emoji.lang_emoji(lang_code)
-    mysql.save_user_language(message.from_user.id, lang_code)
+def relay_to_support(user_id, bot, message):
+    """
+    Post the user's message (or album) to the support group, headed by who sent
+    it and a claim button. Returns a Future of the link to the posted message
+    (None if Telegram refused to copy it); the caller is not held up by the
+    group's rate limit.
+    """
+    parts = as_album(message)
+    first = parts[0]
+    lang_code = first.from_user.language_code or config.DEFAULT_LANG
 
     # Claim button
     claim_markup = InlineKeyboardMarkup()
     claim_markup.add(
         InlineKeyboardButton(
             f"🎯 Claim Ticket ({lang_code.upper()})",
-            callback_data=f"claim_ticket_{message.from_user.id}"
+            callback_data=f"claim_ticket_{first.from_user.id}"
         )
     )
+    header = "[{0}{1}](tg://user?id={2}) (#id{2}) | {3}".format(
+        first.from_user.first_name,
+        f" {first.from_user.last_name}" if first.from_user.last_name else '',
+        first.from_user.id,
+        emoji.lang_emoji(lang_code)
+    )
 
-    # Forward to support group
-    if message.content_type == 'text':
-        msg = bot.send_message(
-            config.support_chat,
-            "[{0}{1}](tg://user?id={2}) (#id{2}) | {3}\n\n{4}".format(
-                message.from_user.first_name,
-                f" {message.from_user.last_name}" if message.from_user.last_name else '',
-                message.from_user.id,
-                lang_emoji,
-                message.text
-            ),
-            parse_mode='Markdown',
-            disable_web_page_preview=True,
-            reply_markup=claim_markup
-        )
-
-    elif message.content_type == 'photo':
-        msg = bot.send_photo(
-            config.support_chat,
-            message.photo[-1].file_id,
-            caption="[{0}{1}](tg://user?id={2}) (#id{2}) | {3}\n\n{4}".format(
-                message.from_user.first_name,
-                f" {message.from_user.last_name}" if message.from_user.last_name else '',
-                message.from_user.id,
-                lang_emoji,
-                msgCaption(message)
-            ),
-            parse_mode='Markdown',
-            reply_markup=claim_markup
-        )
+    link = Future()
+    channel_id = re.sub(r"-100(\S+)", r"\1", str(config.support_chat))
 
-    elif message.content_type == 'document':
-        msg = bot.send_document(
-            config.support_chat,
-            message.document.file_id,
-            caption="[{0}{1}](tg://user?id={2}) (#id{2}) | {3}\n\n{4}".format(
-                message.from_user.first_name,
-                f" {message.from_user.last_name}" if message.from_user.last_name else '',
-                message.from_user.id,
-                lang_emoji,
-                msgCaption(message)
-            ),
-            parse_mode='Markdown',
-            reply_markup=claim_markup
-        )
+    def failed(e):
+        print("❌ Failed to relay message to support:", e)
+        outbound.send_later(bot.send_message, first.chat.id, "❌ That message could not be forwarded, please try again.",
+                            priority=outbound.PRIORITY_REPLY, reply_to_message_id=first.message_id)
+        link.set_result(None)
 
-    elif message.content_type == 'sticker':
-        # Send sticker to group (was incorrectly sending to user before)
-        msg = bot.send_sticker(config.support_chat, message.sticker.file_id)
+    def copied(future, msg):
+        try:
+            future.result()
+        except Exception as e:
+            return failed(e)
+        link.set_result(f'https://t.me/c/{channel_id}/{msg.message_id}')
 
+    def posted(future):
+        try:
+            msg = future.result()
+        except Exception as e:
+            return failed(e)
+        if header_only:
+            # The album / caption-less message itself, under the header
+            if len(parts) > 1:
+                copy = outbound.submit(bot.copy_messages, config.support_chat, first.chat.id,
+                                       [m.message_id for m in parts])
+            else:
+                copy = outbound.submit(bot.copy_message, config.support_chat, first.chat.id, first.message_id,
+                                       reply_to_message_id=msg.message_id)
+            copy.add_done_callback(lambda f: copied(f, msg))
+        else:
+            link.set_result(f'https://t.me/c/{channel_id}/{msg.message_id}')
+
+    header_only = False
+    if len(parts) == 1 and first.content_type == 'text':
+        post = outbound.submit(bot.send_message, config.support_chat, f"{header}\n\n{first.text}",
+                               parse_mode='Markdown', disable_web_page_preview=True, reply_markup=claim_markup)
+    elif len(parts) == 1 and first.content_type in CAPTIONED:
+        post = outbound.submit(bot.copy_message, config.support_chat, first.chat.id, first.message_id,
+                               caption=f"{header}\n\n{msgCaption(first)}", parse_mode='Markdown',
+                               reply_markup=claim_markup)
     else:
-        bot.reply_to(message, "❌ That format is not supported and won't be forwarded.")
+        # Albums and caption-less types (stickers, voice notes, locations, ...): header first,
+        # so agents have a message with the #id to reply to
+        header_only = True
+        post = outbound.submit(bot.send_message, config.support_chat, header, parse_mode='Markdown',
+                               reply_markup=claim_markup)
+    post.add_done_callback(posted)
+    return link
+
+
+def notify_submitted(bot, user_id):
+    # Confirmation is not worth blocking the handler for; failures are logged by outbound.
+    outbound.send_later(
+        bot.send_message,
+        user_id,
+        "✅ Your message has been submitted.\nOur support team will respond shortly.",
+        parse_mode='Markdown'
+    )
+
+
+def fwd_handler(user_id, bot, message):
+    # Update the Spamfilter
+    spam_guard.count(message.chat.id, mysql.get_spam_counter)   # load the stored value once
+    spam_guard.hit(message.chat.id)
+
+    # Capture and save user language
+    mysql.save_user_language(message.from_user.id, message.from_user.language_code)
+
+    message_link = relay_to_support(user_id, bot, message).result()
+    if not message_link:
         return False
 
     # Save the ticket link in DB
-    import re
-    channel_id = re.sub(r"-100(\S+)", r"\1", str(config.support_chat))
-    message_link = f'https://t.me/c/{channel_id}/{msg.message_id}'
     mysql.post_open_ticket(message_link, user_id)
 
-    # Notify user
-    try:
-        bot.send_message(
-            user_id,
-            "✅ Your message has been submitted.\nOur support team will respond shortly.",
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        print("⚠️ Failed to send confirmation:", e)
-
+    notify_submitted(bot, user_id)
     return True
 
 
 def bad_words_handler(bot, message):
     if config.bad_words_toggle:
         try:
-            if re.findall(config.regex_filter['bad_words'], msg_type(message)):
-                bot.reply_to(message, '❗️ Watch your tongue...')
+            if word_filter.find_bad_word(msg_type(message), message.from_user.language_code):
+                outbound.reply_to(bot, message, '❗️ Watch your tongue...')
                 return bad_words_handler
         except Exception:
             pass
@@ -236,11 +259,11 @@ def repo():
     return '\n\n[» Source Code](github.com/vsnz/Telegram-Support-Bot)'
 
 
-def spam_handler_warning(bot, user_id, message):
+def spam_handler_warning(bot, message, ticket_spam):
+    """`ticket_spam` is spam_guard's counter before this message; over the limit it is not forwarded."""
     if config.spam_toggle:
-        ticket_spam = mysql.user_tables(user_id)['open_ticket_spam']
         if ticket_spam > config.spam_protection:
-            bot.reply_to(
+            outbound.reply_to(bot, 
                 message,
                 '{}, your messages are not being forwarded anymore. Please wait until the team responded. Thank you.\n\n'
                 f'_The support\'s local time is_ `{time_zone()}`.'.format(message.from_user.first_name),
@@ -249,12 +272,11 @@ def spam_handler_warning(bot, user_id, message):
             return spam_handler_warning
 
 
-def spam_handler_blocked(bot, user_id, message):
+def spam_handler_blocked(bot, message, ticket_spam):
+    """`ticket_spam` is spam_guard.hit()'s counter for this (already forwarded) message."""
     if config.spam_toggle:
-        ticket_spam = mysql.user_tables(user_id)['open_ticket_spam']
-        if ticket_spam == config.spam_protection - 1:
-            fwd_handler(user_id, bot, message)
-            bot.reply_to(
+        if ticket_spam == config.spam_protection:
+            outbound.reply_to(bot, 
                 message,
                 'We will be with you shortly.\n\n{}, to prevent spam you can only send us *1* more message.\n\n'
                 f'_The support\'s local time is_ `{time_zone()}`.'.format(message.from_user.first_name),
@@ -6,10 +6,18 @@
 
 import pymysql
 import config
+import random
+from contextlib import contextmanager
 from datetime import datetime
+from resources import spam_guard
+from resources import availability
+from resources.db_pool import ConnectionPool
+from resources.membership import IdSet
+from resources import state
 
 # ------------- Connection ------------- #
 def getConnection():
+    """Open a fresh connection. Helpers should go through the pool instead."""
     return pymysql.connect(
         host=config.mysql_host,
         user=config.mysql_user,
@@ -20,491 +28,960 @@ def getConnection():
         autocommit=True
     )
 
-# ------------- Migration Helpers ------------- #
-def _table_exists(cur, name):
-    cur.execute("SHOW TABLES LIKE %s", (name,))
-    return cur.fetchone() is not None
-
-def _column_exists(cur, table, column):
-    cur.execute(f"SHOW COLUMNS FROM `{table}` LIKE %s", (column,))
-    return cur.fetchone() is not None
+_pool = ConnectionPool(
+    getConnection,
+    size=getattr(config, 'mysql_pool_size', 10),
+    recycle=getattr(config, 'mysql_pool_recycle', 3600),
+    timeout=getattr(config, 'mysql_pool_timeout', 10),
+    ping_idle=getattr(config, 'mysql_pool_ping_idle', 30)
+)
+
+@contextmanager
+def db_cursor():
+    """Pooled autocommit cursor."""
+    with _pool.connection() as conn:
+        with conn.cursor() as c:
+            yield c
 
-def run_migrations():
-    """Create/alter all required tables & columns. Safe to call every start."""
-    conn = getConnection()
-    try:
+@contextmanager
+def db_transaction():
+    """Pooled cursor whose statements commit together (rolled back on error)."""
+    with _pool.connection() as conn:
+        conn.begin()
+        try:
+            with conn.cursor() as c:
+                yield c
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+
+@contextmanager
+def db_snapshot():
+    """Pooled cursor whose reads all see one consistent snapshot; takes no locks."""
+    with _pool.connection() as conn:
         with conn.cursor() as c:
-            # USERS
-            if not _table_exists(c, "users"):
-                c.execute("""
-                    CREATE TABLE users (
-                      userid            BIGINT      NOT NULL PRIMARY KEY,
-                      open_ticket       TINYINT(1)  NOT NULL DEFAULT 0,
-                      banned            TINYINT(1)  NOT NULL DEFAULT 0,
-                      open_ticket_spam  INT         NOT NULL DEFAULT 1,
-                      open_ticket_link  VARCHAR(255)        DEFAULT NULL,
-                      open_ticket_time  DATETIME    NOT NULL DEFAULT '1000-01-01 00:00:00',
-                      claimed_by        BIGINT              DEFAULT NULL,
-                      claim_time        DATETIME            DEFAULT NULL,
-                      language          VARCHAR(5)          DEFAULT NULL,
-                      current_ticket_id BIGINT              DEFAULT NULL
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-            else:
-                if not _column_exists(c, "users", "claim_time"):
-                    c.execute("ALTER TABLE users ADD COLUMN claim_time DATETIME NULL AFTER claimed_by")
-                if not _column_exists(c, "users", "current_ticket_id"):
-                    c.execute("ALTER TABLE users ADD COLUMN current_ticket_id BIGINT NULL AFTER language")
-
-            # AGENTS
-            if not _table_exists(c, "agents"):
-                c.execute("""
-                    CREATE TABLE agents (
-                      id               INT           NOT NULL AUTO_INCREMENT PRIMARY KEY,
-                      user_id          BIGINT        NOT NULL UNIQUE,
-                      full_name        VARCHAR(100)           DEFAULT NULL,
-                      languages        TEXT                   DEFAULT NULL,
-                      availability     TEXT                   DEFAULT NULL,
-                      commission_rate  DECIMAL(6,4)  NOT NULL DEFAULT 0,
-                      total_earnings   DECIMAL(12,2) NOT NULL DEFAULT 0,
-                      tickets_claimed  INT           NOT NULL DEFAULT 0,
-                      tickets_resolved INT           NOT NULL DEFAULT 0,
-                      approved_at      DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-            else:
-                for col, ddl in [
-                    ("commission_rate",  "ALTER TABLE agents ADD COLUMN commission_rate  DECIMAL(6,4)  NOT NULL DEFAULT 0"),
-                    ("total_earnings",   "ALTER TABLE agents ADD COLUMN total_earnings   DECIMAL(12,2) NOT NULL DEFAULT 0"),
-                    ("tickets_claimed",  "ALTER TABLE agents ADD COLUMN tickets_claimed  INT NOT NULL DEFAULT 0"),
-                    ("tickets_resolved", "ALTER TABLE agents ADD COLUMN tickets_resolved INT NOT NULL DEFAULT 0"),
-                ]:
-                    if not _column_exists(c, "agents", col):
-                        c.execute(ddl)
-
-            # PENDING_AGENTS
-            if not _table_exists(c, "pending_agents"):
-                c.execute("""
-                    CREATE TABLE pending_agents (
-                      id           INT          NOT NULL AUTO_INCREMENT PRIMARY KEY,
-                      user_id      BIGINT       NOT NULL UNIQUE,
-                      full_name    VARCHAR(100)          DEFAULT NULL,
-                      languages    TEXT                   DEFAULT NULL,
-                      availability TEXT                   DEFAULT NULL,
-                      requested_at DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-
-            # TICKETS
-            if not _table_exists(c, "tickets"):
-                c.execute("""
-                    CREATE TABLE tickets (
-                      id                 BIGINT       NOT NULL AUTO_INCREMENT PRIMARY KEY,
-                      user_id            BIGINT       NOT NULL,
-                      opened_at          DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                      closed_at          DATETIME              DEFAULT NULL,
-                      resolved           TINYINT(1)   NOT NULL DEFAULT 0,
-                      claimed_by         BIGINT                DEFAULT NULL,
-                      first_message_link VARCHAR(255)          DEFAULT NULL,
-                      last_message_link  VARCHAR(255)          DEFAULT NULL,
-                      INDEX idx_ticket_user  (user_id),
-                      INDEX idx_ticket_open  (closed_at),
-                      INDEX idx_ticket_claim (claimed_by)
-                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-                """)
-
-        conn.commit()
-        print("✅ DB migrations ok")
-    except Exception as e:
-        print("❌ DB migration failed:", e)
-    finally:
-        conn.close()
+            c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            c.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+            try:
+                yield c
+            finally:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+
+def pool_stats():
+    return _pool.stats()
 
 # ------------- Language / Misc ------------- #
+SAVE_USER_LANGUAGE_SQL = "UPDATE users SET language = %s WHERE userid = %s"
 def save_user_language(user_id, lang_code):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET language = %s WHERE userid = %s", (lang_code, user_id))
+    with db_cursor() as cursor:
+        cursor.execute(SAVE_USER_LANGUAGE_SQL, (lang_code, user_id))
 
 def clear_ticket_claim(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
+    with db_cursor() as cursor:
         cursor.execute("UPDATE users SET claimed_by = NULL, claim_time=NULL WHERE userid = %s", (user_id,))
 
+CLAIMED_BY_AGENT_USERS_SQL = """
+    SELECT userid FROM users
+    WHERE claimed_by=%s AND open_ticket=1 LIMIT 1
+"""
+CLAIMED_BY_AGENT_TICKETS_SQL = """
+    SELECT user_id FROM tickets
+    WHERE claimed_by=%s AND closed_at IS NULL
+    LIMIT 1
+"""
 def get_claimed_ticket_by_agent(agent_id):
     """
     Return the user_id of the ticket currently claimed by this agent.
     Checks users table first (legacy), then tickets table.
     """
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""SELECT userid FROM users
-                         WHERE claimed_by=%s AND open_ticket=1 LIMIT 1""", (agent_id,))
-            r = c.fetchone()
-            if r:
-                return r['userid']
-            c.execute("""SELECT user_id FROM tickets
-                         WHERE claimed_by=%s AND closed_at IS NULL
-                         LIMIT 1""", (agent_id,))
-            r = c.fetchone()
-            return r['user_id'] if r else None
-    finally:
-        conn.close()
-
+    with db_cursor() as c:
+        c.execute(CLAIMED_BY_AGENT_USERS_SQL, (agent_id,))
+        r = c.fetchone()
+        if r:
+            return r['userid']
+        c.execute(CLAIMED_BY_AGENT_TICKETS_SQL, (agent_id,))
+        r = c.fetchone()
+        return r['user_id'] if r else None
+
+LEDGER_TAIL_SQL = """
+    SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0) AS amount
+      FROM earnings_ledger
+     WHERE agent_id=%s AND id > (SELECT last_id FROM rollup_state WHERE name='earnings')
+"""
+def _add_unrolled(c, row, agent_id):
+    """
+    Add ledger rows the rollup job has not folded into agents yet (a short tail).
+    `c` must be a db_snapshot() cursor that also read `row`: otherwise a rollup
+    committing in between moves the tail into the totals and it is counted twice.
+    """
+    c.execute(LEDGER_TAIL_SQL, (agent_id,))
+    tail = c.fetchone()
+    row['tickets_resolved'] += tail['n']
+    row['total_earnings'] += tail['amount']
+    return row
+
+AGENT_PROFILE_SQL = """
+    SELECT full_name, languages, availability,
+           commission_rate, total_earnings,
+           tickets_claimed, tickets_resolved
+    FROM agents WHERE user_id=%s
+"""
 def get_agent_profile(user_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""
-                SELECT full_name, languages, availability,
-                       commission_rate, total_earnings,
-                       tickets_claimed, tickets_resolved
-                FROM agents WHERE user_id=%s
-            """, (user_id,))
-            return c.fetchone()
-    finally:
-        conn.close()
+    with db_snapshot() as c:
+        c.execute(AGENT_PROFILE_SQL, (user_id,))
+        row = c.fetchone()
+        return _add_unrolled(c, row, user_id) if row else None
 
+INCREMENT_CLAIM_SQL = "UPDATE agents SET tickets_claimed = tickets_claimed + 1 WHERE user_id=%s"
 def increment_claim(agent_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE agents SET tickets_claimed = tickets_claimed + 1 WHERE user_id=%s", (agent_id,))
-    finally:
-        conn.close()
-
-def increment_resolved_and_pay(agent_id):
-    base = getattr(config, 'ticket_commission_base', 1.0)
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("SELECT commission_rate FROM agents WHERE user_id=%s", (agent_id,))
-            row = c.fetchone()
-            if not row:
-                return
-            rate = float(row['commission_rate'] or 0)
-            earning = base * rate
-            c.execute("""
-                UPDATE agents
-                   SET tickets_resolved = tickets_resolved + 1,
-                       total_earnings   = total_earnings + %s
-                 WHERE user_id=%s
-            """, (earning, agent_id))
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute(INCREMENT_CLAIM_SQL, (agent_id,))
 
+SET_COMMISSION_SQL = "UPDATE agents SET commission_rate=%s WHERE user_id=%s"
 def set_commission(agent_id, rate):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE agents SET commission_rate=%s WHERE user_id=%s", (rate, agent_id))
-    finally:
-        conn.close()
-
+    with db_cursor() as c:
+        c.execute(SET_COMMISSION_SQL, (rate, agent_id))
+    if agent_id in agents:
+        agents[agent_id] = dict(agents[agent_id], commission_rate=float(rate))
+
+AGENT_TOTALS_SQL = """
+    SELECT full_name, commission_rate, total_earnings,
+           tickets_claimed, tickets_resolved
+    FROM agents WHERE user_id=%s
+"""
+AGENT_WEEK_SQL = """
+    SELECT COALESCE(SUM(tickets_resolved), 0) AS n, COALESCE(SUM(earnings), 0) AS amount
+      FROM agent_daily_earnings
+     WHERE agent_id=%s AND day >= CURDATE() - INTERVAL 6 DAY
+"""
 def get_agent_stats(agent_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""
-                SELECT full_name, commission_rate, total_earnings,
-                       tickets_claimed, tickets_resolved
-                FROM agents WHERE user_id=%s
-            """, (agent_id,))
-            return c.fetchone()
-    finally:
-        conn.close()
-
+    """Agent totals plus the last 7 days, served from the earnings rollups."""
+    with db_snapshot() as c:
+        c.execute(AGENT_TOTALS_SQL, (agent_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        before = (row['tickets_resolved'], row['total_earnings'])
+        _add_unrolled(c, row, agent_id)
+        c.execute(AGENT_WEEK_SQL, (agent_id,))
+        week = c.fetchone()
+        row['week_resolved'] = week['n'] + row['tickets_resolved'] - before[0]
+        row['week_earnings'] = week['amount'] + row['total_earnings'] - before[1]
+        return row
+
+# ------------- Stats counters ------------- #
+# /report_summary figures, kept in step by the lifecycle functions in the same
+# transaction as the change they count. Each counter is split over a few slot
+# rows so concurrent writers rarely wait on the same row lock.
+STATS_COUNTERS = ('users_total', 'open_tickets', 'banned_users', 'tickets_resolved', 'earnings')
+_FLAG_COUNTERS = {'open_ticket': 'open_tickets', 'banned': 'banned_users'}
+
+def _stats_slots():
+    return max(1, getattr(config, 'stats_counter_slots', 8))
+
+BUMP_SQL = """
+    INSERT INTO stats_counters (name, slot, value) VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+"""
+def _bump(c, name, delta):
+    if delta:
+        c.execute(BUMP_SQL, (name, random.randrange(_stats_slots()), delta))
+
+SET_FLAG_SQL = "UPDATE users SET {column}=%s WHERE userid=%s AND {column}<>%s"
+def _set_flag(c, user_id, column, value):
+    """Set users.open_ticket / users.banned and move its counter if it really changed."""
+    c.execute(SET_FLAG_SQL.format(column=column), (value, user_id, value))
+    if c.rowcount:
+        _bump(c, _FLAG_COUNTERS[column], 1 if value else -1)
+    return bool(c.rowcount)
+
+STATS_COUNTERS_SQL = "SELECT name, SUM(value) AS value FROM stats_counters GROUP BY name"
+def get_stats_counters():
+    with db_cursor() as c:
+        c.execute(STATS_COUNTERS_SQL)
+        return {r['name']: r['value'] for r in c.fetchall()}
+
+USER_COUNTS_SQL = """
+    SELECT COUNT(*)                          AS users_total,
+           COALESCE(SUM(open_ticket = 1), 0) AS open_tickets,
+           COALESCE(SUM(banned = 1), 0)      AS banned_users
+      FROM users
+"""
+ROLLED_TOTALS_SQL = """
+    SELECT COALESCE(SUM(tickets_resolved), 0) AS resolved,
+           COALESCE(SUM(total_earnings), 0)   AS earned
+      FROM agents
+"""
+LEDGER_TAIL_ALL_SQL = """
+    SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0) AS amount
+      FROM earnings_ledger
+     WHERE id > (SELECT last_id FROM rollup_state WHERE name='earnings')
+"""
+def reconcile_stats_counters():
+    """
+    Re-derive every counter from the source tables. Counters and tables are
+    read in one snapshot without locks (each change commits together with its
+    counter delta, so in a snapshot they must agree); only the drift found is
+    then added, so writers never wait for the recount. Returns {name: drift}.
+    """
+    with db_snapshot() as c:
+        c.execute(STATS_COUNTERS_SQL)
+        stored = {r['name']: r['value'] for r in c.fetchall()}
+        c.execute(USER_COUNTS_SQL)
+        actual = dict(c.fetchone())
+        c.execute(ROLLED_TOTALS_SQL)
+        rolled = c.fetchone()
+        c.execute(LEDGER_TAIL_ALL_SQL)
+        tail = c.fetchone()
+        actual['tickets_resolved'] = rolled['resolved'] + tail['n']
+        actual['earnings'] = rolled['earned'] + tail['amount']
+    drift = {name: actual[name] - stored.get(name, 0) for name in STATS_COUNTERS}
+    drift = {k: v for k, v in drift.items() if v}
+    if drift:
+        with db_transaction() as c:
+            for name, delta in drift.items():
+                _bump(c, name, delta)
+        print("ℹ️ Stats counters corrected:", drift)
+    return drift
+
+TOP_AGENTS_SQL = """
+    SELECT user_id, full_name, tickets_resolved
+    FROM agents ORDER BY tickets_resolved DESC LIMIT 5
+"""
 def get_report_summary():
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("SELECT COUNT(*) AS total_tickets FROM users")
-            total_tickets = c.fetchone()['total_tickets']
-
-            c.execute("SELECT COUNT(*) AS open_now FROM users WHERE open_ticket=1")
-            open_now = c.fetchone()['open_now']
-
-            c.execute("SELECT COUNT(*) AS banned_cnt FROM users WHERE banned=1")
-            banned_cnt = c.fetchone()['banned_cnt']
-
-            c.execute("SELECT SUM(tickets_resolved) AS resolved, SUM(total_earnings) AS earned FROM agents")
-            row = c.fetchone()
-            resolved = row['resolved'] or 0
-            earned = float(row['earned'] or 0)
-
-            c.execute("""
-                SELECT user_id, full_name, tickets_resolved
-                FROM agents ORDER BY tickets_resolved DESC LIMIT 5
-            """)
-            top = c.fetchall()
-
-            return {
-                "total_tickets": total_tickets,
-                "open_now": open_now,
-                "banned_cnt": banned_cnt,
-                "resolved": resolved,
-                "earned": earned,
-                "top": top
-            }
-    finally:
-        conn.close()
+    """Served from stats_counters (one small primary-key scan) plus the top-5 agents."""
+    counters = get_stats_counters()
+    with db_cursor() as c:
+        c.execute(TOP_AGENTS_SQL)
+        top = c.fetchall()
+
+    return {
+        "total_tickets": int(counters.get('users_total', 0)),
+        "open_now": int(counters.get('open_tickets', 0)),
+        "banned_cnt": int(counters.get('banned_users', 0)),
+        "resolved": int(counters.get('tickets_resolved', 0)),
+        "earned": float(counters.get('earnings', 0)),
+        "top": top
+    }
+
+SET_AGENT_LANGUAGES_SQL = "UPDATE agents SET languages=%s WHERE user_id=%s"
+def set_agent_languages(agent_id, languages):
+    with db_cursor() as c:
+        c.execute(SET_AGENT_LANGUAGES_SQL, (languages, agent_id))
+    if agent_id in agents:
+        agents[agent_id] = dict(agents[agent_id], languages=_split_languages(languages))
+
+AGENT_ACTIVE_TICKETS_SQL = "SELECT userid, open_ticket_link FROM users WHERE claimed_by=%s AND open_ticket=1"
+def get_agent_active_tickets(agent_id):
+    with db_cursor() as c:
+        c.execute(AGENT_ACTIVE_TICKETS_SQL, (agent_id,))
+        return c.fetchall()
+
+COUNT_AGENT_ACTIVE_TICKETS_SQL = "SELECT COUNT(*) AS cnt FROM users WHERE claimed_by=%s AND open_ticket=1"
+def count_agent_active_tickets(agent_id):
+    with db_cursor() as c:
+        c.execute(COUNT_AGENT_ACTIVE_TICKETS_SQL, (agent_id,))
+        return c.fetchone()['cnt']
 
 def get_agent_languages(agent_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT languages FROM agents WHERE user_id = %s", (agent_id,))
-        row = cursor.fetchone()
-        if not row:
-            return None
-        if not row['languages']:
-            return []
-        return [lang.strip() for lang in row['languages'].split(',')]
+    """Languages of an agent (from the registry), or None if not an agent."""
+    entry = agents.get(agent_id)
+    if entry is None:
+        return None
+    return sorted(entry['languages'])
 
+USER_LANGUAGE_SQL = "SELECT language FROM users WHERE userid = %s"
 def get_user_language(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT language FROM users WHERE userid = %s", (user_id,))
+    with db_cursor() as cursor:
+        cursor.execute(USER_LANGUAGE_SQL, (user_id,))
         row = cursor.fetchone()
         return row['language'] if row and row['language'] else 'en'
 
-# (legacy helper; kept for compatibility)
 def ensure_claimed_by_column():
-    try:
-        conn = getConnection()
-        with conn.cursor() as cursor:
-            cursor.execute("SHOW COLUMNS FROM users LIKE 'claimed_by'")
-            if not cursor.fetchone():
-                cursor.execute("ALTER TABLE users ADD claimed_by BIGINT DEFAULT NULL")
-                print("✅ Added 'claimed_by' column to users table")
-    except Exception as e:
-        print("⚠️ Failed to ensure claimed_by column:", e)
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    """No-op (backward compatibility; covered by schema migration 1)."""
+    return
 
 def createTables():
     """No-op (backward compatibility)."""
     return
 
+SAVE_PENDING_AGENT_SQL = "INSERT INTO pending_agents (user_id, full_name, languages, availability) VALUES (%s, %s, %s, %s)"
 def save_pending_agent(user_id, full_name, languages, availability):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute(
-            "INSERT INTO pending_agents (user_id, full_name, languages, availability) VALUES (%s, %s, %s, %s)",
-            (user_id, full_name, languages, availability)
-        )
+    with db_cursor() as cursor:
+        cursor.execute(SAVE_PENDING_AGENT_SQL, (user_id, full_name, languages, availability))
 
 def get_pending_agents():
-    conn = getConnection()
-    with conn.cursor() as cursor:
+    with db_cursor() as cursor:
         cursor.execute("SELECT * FROM pending_agents")
         return cursor.fetchall()
 
+PENDING_AGENT_SQL = "SELECT full_name, languages, availability FROM pending_agents WHERE user_id = %s"
+APPROVE_AGENT_SQL = """
+    INSERT INTO agents (user_id, full_name, languages, availability) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE full_name=VALUES(full_name), languages=VALUES(languages), availability=VALUES(availability)
+"""
+DELETE_PENDING_AGENT_SQL = "DELETE FROM pending_agents WHERE user_id = %s"
 def approve_agent(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT full_name, languages, availability FROM pending_agents WHERE user_id = %s", (user_id,))
+    with db_transaction() as cursor:
+        cursor.execute(PENDING_AGENT_SQL, (user_id,))
         row = cursor.fetchone()
         if not row:
             return
-        cursor.execute(
-            "INSERT INTO agents (user_id, full_name, languages, availability) VALUES (%s, %s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE full_name=VALUES(full_name), languages=VALUES(languages), availability=VALUES(availability)",
-            (user_id, row['full_name'], row['languages'], row['availability'])
-        )
-        cursor.execute("DELETE FROM pending_agents WHERE user_id = %s", (user_id,))
+        cursor.execute(APPROVE_AGENT_SQL, (user_id, row['full_name'], row['languages'], row['availability']))
+        try:
+            tz, intervals = availability.parse(row['availability'])
+            write_agent_shifts(cursor, user_id, tz, intervals)
+        except ValueError:
+            pass    # requested before hours were validated: the agent sets them with /availability
+        cursor.execute(DELETE_PENDING_AGENT_SQL, (user_id,))
+    refresh_agent(user_id)
 
 def reject_agent(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("DELETE FROM pending_agents WHERE user_id = %s", (user_id,))
+    with db_cursor() as cursor:
+        cursor.execute(DELETE_PENDING_AGENT_SQL, (user_id,))
+    refresh_agent(user_id)
+
+# ------------- Agent registry ------------- #
+# Loaded on first use (so MySQL being down at import doesn't leave it empty) and
+# re-read by the agents-reload job
+agents = {}     # {user_id: {"languages": frozenset, "commission_rate": float, "availability": str}}
+_agents_loaded = False
+
+def _split_languages(raw):
+    return frozenset(l.strip() for l in raw.split(',') if l.strip()) if raw else frozenset()
+
+def _agent_entry(row):
+    return {
+        "languages": _split_languages(row['languages']),
+        "commission_rate": float(row['commission_rate'] or 0),
+        "availability": row['availability']
+    }
+
+AGENTS_SQL = "SELECT user_id, languages, commission_rate, availability FROM agents"
+def getAgents():
+    with db_cursor() as c:
+        c.execute(AGENTS_SQL)
+        return {r['user_id']: _agent_entry(r) for r in c.fetchall()}
+
+AGENT_SQL = AGENTS_SQL + " WHERE user_id=%s"
+def refresh_agent(user_id):
+    """Re-read one agent into the registry (drops it if no longer an agent)."""
+    with db_cursor() as c:
+        c.execute(AGENT_SQL, (user_id,))
+        row = c.fetchone()
+    if row:
+        agents[user_id] = _agent_entry(row)
+    else:
+        agents.pop(user_id, None)
+
+def reload_agents():
+    """Re-read the whole registry (periodic job: picks up changes made by other processes)."""
+    global agents, _agents_loaded
+    agents = getAgents()
+    _agents_loaded = True
+
+def _registry():
+    if not _agents_loaded:
+        reload_agents()     # raises while MySQL is down; the next call tries again
+    return agents
+
+ROUTING_AGENTS_SQL = """
+       SELECT a.user_id, a.languages, COUNT(t.id) AS active
+         FROM agents a
+    LEFT JOIN tickets t ON t.claimed_by = a.user_id AND t.closed_at IS NULL
+     GROUP BY a.user_id
+"""
+def get_routing_agents():
+    """Every agent with its languages, shift flag and open ticket count (resources/routing.py)."""
+    with db_cursor() as c:
+        c.execute(ROUTING_AGENTS_SQL)
+        return [dict(r, languages=_split_languages(r['languages'])) for r in c.fetchall()]
+
+SET_AGENT_SHIFT_SQL = "UPDATE agents SET on_shift=%s WHERE user_id=%s"
+def set_agent_shift(agent_id, on_shift):
+    """Manual override: True / False, or None to follow the agent's hours again."""
+    with db_cursor() as c:
+        c.execute(SET_AGENT_SHIFT_SQL, (None if on_shift is None else int(bool(on_shift)), agent_id))
+
+# ------------- Agent availability ------------- #
+DELETE_AGENT_SHIFTS_SQL = "DELETE FROM agent_shifts WHERE agent_id=%s"
+INSERT_AGENT_SHIFTS_SQL = "INSERT INTO agent_shifts (agent_id, start_min, end_min) VALUES {rows}"
+SET_AGENT_TIMEZONE_SQL = "UPDATE agents SET timezone=%s WHERE user_id=%s"
+def write_agent_shifts(c, agent_id, tz, intervals):
+    """Replace an agent's weekly hours (inside the caller's transaction)."""
+    c.execute(DELETE_AGENT_SHIFTS_SQL, (agent_id,))
+    if intervals:
+        c.execute(INSERT_AGENT_SHIFTS_SQL.format(rows=", ".join(["(%s, %s, %s)"] * len(intervals))),
+                  [v for start, end in intervals for v in (agent_id, start, end)])
+    c.execute(SET_AGENT_TIMEZONE_SQL, (tz, agent_id))
+
+SET_AGENT_AVAILABILITY_SQL = "UPDATE agents SET availability=%s WHERE user_id=%s"
+def set_agent_availability(agent_id, tz, intervals):
+    with db_transaction() as c:
+        c.execute(SET_AGENT_AVAILABILITY_SQL, (availability.describe(tz, intervals), agent_id))
+        write_agent_shifts(c, agent_id, tz, intervals)
+
+AGENT_AVAILABILITY_SQL = "SELECT user_id, languages, timezone, on_shift FROM agents"
+AGENT_SHIFTS_SQL = "SELECT agent_id, start_min, end_min FROM agent_shifts ORDER BY agent_id, start_min"
+def get_agent_availability():
+    """Every agent's languages, time zone, shift override and hours, for availability.load()."""
+    with db_cursor() as c:
+        c.execute(AGENT_AVAILABILITY_SQL)
+        rows = {r['user_id']: dict(r, languages=_split_languages(r['languages']), shifts=[])
+                for r in c.fetchall()}
+        c.execute(AGENT_SHIFTS_SQL)
+        for r in c.fetchall():
+            if r['agent_id'] in rows:
+                rows[r['agent_id']]['shifts'].append((r['start_min'], r['end_min']))
+    return list(rows.values())
+
+def is_agent(user_id):
+    return user_id in _registry()
+
+def get_agent(user_id):
+    return _registry().get(user_id)
 
 # ------------- Spam / user state ------------- #
 def spam(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT banned, open_ticket, open_ticket_spam FROM users WHERE userid = %s", user_id)
-        data = cursor.fetchone()
-        ticket_spam = data['open_ticket_spam']
-        cursor.execute("UPDATE users SET open_ticket_spam = %s WHERE userid = %s", (ticket_spam + 1, user_id))
-        return ticket_spam + 1
+    """Atomically bump and return the stored counter (no read-modify-write race)."""
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE users SET open_ticket_spam = LAST_INSERT_ID(open_ticket_spam + 1) WHERE userid = %s",
+                       (user_id,))
+        cursor.execute("SELECT LAST_INSERT_ID() AS spam")
+        return cursor.fetchone()['spam']
+
+def get_spam_counter(user_id):
+    with db_cursor() as cursor:
+        cursor.execute("SELECT open_ticket_spam FROM users WHERE userid = %s", (user_id,))
+        row = cursor.fetchone()
+        return row['open_ticket_spam'] if row else None
 
+SAVE_SPAM_COUNTERS_SQL = """
+    INSERT INTO users (userid, open_ticket_spam) VALUES {rows}
+    ON DUPLICATE KEY UPDATE open_ticket_spam = VALUES(open_ticket_spam)
+"""
+def save_spam_counters(rows):
+    """
+    Persist [(user_id, count), ...] from spam_guard in one multi-row statement.
+    (A user row created here is not counted in users_total until the next reconciliation.)
+    """
+    if not rows:
+        return
+    with db_cursor() as cursor:
+        cursor.execute(SAVE_SPAM_COUNTERS_SQL.format(rows=", ".join(["(%s, %s)"] * len(rows))),
+                       [v for row in rows for v in row])
+
+USER_TABLES_SQL = """
+    SELECT open_ticket, banned, open_ticket_time, open_ticket_spam, open_ticket_link
+    FROM users WHERE userid = %s
+"""
 def user_tables(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            SELECT open_ticket, banned, open_ticket_time, open_ticket_spam, open_ticket_link
-            FROM users WHERE userid = %s
-        """, user_id)
+    with db_cursor() as cursor:
+        cursor.execute(USER_TABLES_SQL, user_id)
         return cursor.fetchone()
 
-def getOpenTickets():
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT userid FROM users WHERE open_ticket = 1")
-        return [i['userid'] for i in cursor.fetchall()]
-
+SAVE_USER_PROFILE_SQL = """
+    INSERT INTO user_profiles (userid, first_name, last_name, username, language_code, updated_at)
+    VALUES (%s, %s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE first_name=VALUES(first_name), last_name=VALUES(last_name),
+                            username=VALUES(username), language_code=VALUES(language_code),
+                            updated_at=NOW()
+"""
+def save_user_profile(user_id, first_name, last_name, username=None, language_code=None):
+    with db_cursor() as c:
+        c.execute(SAVE_USER_PROFILE_SQL, (user_id, first_name, last_name, username, language_code))
+
+USER_PROFILE_SQL = """
+    SELECT first_name, last_name, username, language_code, updated_at
+    FROM user_profiles WHERE userid=%s
+"""
+def get_user_profile(user_id):
+    with db_cursor() as c:
+        c.execute(USER_PROFILE_SQL, (user_id,))
+        return c.fetchone()
+
+TOUCH_USER_PROFILE_SQL = """
+    INSERT INTO user_profiles (userid, updated_at) VALUES (%s, NOW())
+    ON DUPLICATE KEY UPDATE updated_at=NOW()
+"""
+def touch_user_profile(user_id):
+    with db_cursor() as c:
+        c.execute(TOUCH_USER_PROFILE_SQL, (user_id,))
+
+STALE_PROFILES_SQL = """
+    SELECT userid FROM user_profiles
+    WHERE updated_at < NOW() - INTERVAL %s DAY
+    ORDER BY updated_at LIMIT %s
+"""
+def get_stale_profiles(max_age_days, limit=50):
+    """User ids whose stored profile is older than `max_age_days`, oldest first."""
+    with db_cursor() as c:
+        c.execute(STALE_PROFILES_SQL, (max_age_days, limit))
+        return [r['userid'] for r in c.fetchall()]
+
+OPEN_TICKETS_SQL = """
+       SELECT u.userid, u.open_ticket_link, u.open_ticket_time, u.language, p.first_name, p.last_name
+         FROM users u
+    LEFT JOIN user_profiles p ON p.userid = u.userid
+        WHERE u.open_ticket = 1
+     ORDER BY u.open_ticket_time
+"""
+def list_open_tickets():
+    """Open tickets with display names, oldest first (one query)."""
+    with db_cursor() as c:
+        c.execute(OPEN_TICKETS_SQL)
+        return c.fetchall()
+
+BANNED_USERS_SQL = """
+       SELECT u.userid, u.open_ticket_link, p.first_name, p.last_name
+         FROM users u
+    LEFT JOIN user_profiles p ON p.userid = u.userid
+        WHERE u.banned = 1
+"""
+def list_banned_users():
+    """Banned users with display names (one query)."""
+    with db_cursor() as c:
+        c.execute(BANNED_USERS_SQL)
+        return c.fetchall()
+
+BANNED_IDS_SQL = "SELECT userid FROM users WHERE banned = 1"
 def getBanned():
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT userid FROM users WHERE banned = 1")
+    with db_cursor() as cursor:
+        cursor.execute(BANNED_IDS_SQL)
         return [i['userid'] for i in cursor.fetchall()]
 
+START_BOT_SQL = "INSERT IGNORE INTO users(userid) VALUES (%s)"
 def start_bot(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT EXISTS(SELECT userid FROM users WHERE userid = %s)", user_id)
-        if not list(cursor.fetchone().values())[0]:
-            cursor.execute("INSERT INTO users(userid) VALUES (%s)", user_id)
+    with db_transaction() as cursor:
+        cursor.execute(START_BOT_SQL, (user_id,))
+        _bump(cursor, 'users_total', cursor.rowcount)
 
 def open_ticket(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET open_ticket = 1, open_ticket_time = %s WHERE userid = %s",
-                       (datetime.now(), user_id))
-        if user_id not in open_tickets:
-            open_tickets.append(user_id)
+    with db_transaction() as cursor:
+        _set_flag(cursor, user_id, 'open_ticket', 1)
+        cursor.execute("UPDATE users SET open_ticket_time = %s WHERE userid = %s", (datetime.now(), user_id))
 
 def post_open_ticket(link, msg_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
+    with db_cursor() as cursor:
         cursor.execute("UPDATE users SET open_ticket_link = %s WHERE userid = %s", (link, msg_id))
 
 def reset_open_ticket(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET open_ticket = 0, open_ticket_spam = 1 WHERE userid = %s", user_id)
-        if user_id in open_tickets:
-            open_tickets.remove(user_id)
+    with db_transaction() as cursor:
+        _set_flag(cursor, user_id, 'open_ticket', 0)
+        cursor.execute("UPDATE users SET open_ticket_spam = 1 WHERE userid = %s", (user_id,))
+    spam_guard.reset(user_id)
 
 def ban_user(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET banned = 1 WHERE userid = %s", user_id)
-        if user_id not in banned:
-            banned.append(user_id)
+    with db_transaction() as cursor:
+        _set_flag(cursor, user_id, 'banned', 1)
+    banned.add(user_id)
 
 def unban_user(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET banned = 0 WHERE userid = %s", user_id)
-        if user_id in banned:
-            banned.remove(user_id)
+    with db_transaction() as cursor:
+        _set_flag(cursor, user_id, 'banned', 0)
+    banned.discard(user_id)
 
+SET_USER_CLAIM_SQL = "UPDATE users SET claimed_by = %s, claim_time=%s WHERE userid = %s"
 def claim_ticket(user_id, agent_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE users SET claimed_by = %s, claim_time=%s WHERE userid = %s",
-                       (agent_id, datetime.now(), user_id))
+    with db_cursor() as cursor:
+        cursor.execute(SET_USER_CLAIM_SQL, (agent_id, datetime.now(), user_id))
 
+TICKET_CLAIM_SQL = "SELECT claimed_by FROM users WHERE userid = %s"
 def get_ticket_claim(user_id):
-    conn = getConnection()
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT claimed_by FROM users WHERE userid = %s", (user_id,))
+    with db_cursor() as cursor:
+        cursor.execute(TICKET_CLAIM_SQL, (user_id,))
         row = cursor.fetchone()
         return row['claimed_by'] if row else None
 
+LOCK_AGENT_SQL = "SELECT user_id FROM agents WHERE user_id=%s FOR UPDATE"
+CLAIM_CAP_SQL = "SELECT COUNT(*) AS n FROM tickets WHERE claimed_by=%s AND closed_at IS NULL"
+CLAIM_SQL = """
+    UPDATE users SET claimed_by=%s, claim_time=NOW()
+    WHERE userid=%s AND claimed_by IS NULL
+"""
+CLAIM_OPEN_TICKET_SQL = """
+    UPDATE tickets t
+      JOIN users u ON u.current_ticket_id = t.id
+       SET t.claimed_by = %s
+     WHERE u.userid = %s AND t.closed_at IS NULL
+"""
+def claim_ticket_atomic(user_id, agent_id, cap=None):
+    """
+    Compare-and-set claim: only an unclaimed user row can be taken, so of any
+    number of simultaneous claims exactly one wins. The winner's users, tickets
+    and agents rows are updated in the same transaction.
+    With `cap` (auto-routing) the agent must hold fewer open tickets than that.
+    Returns (claimer_id, won); claimer_id is the current owner (None if no such
+    user, or if the agent is at the cap).
+    """
+    with db_transaction() as c:
+        # The agent's row is locked first by every claim, which serialises one agent's claims
+        c.execute(LOCK_AGENT_SQL, (agent_id,))
+        if cap is not None:
+            c.execute(CLAIM_CAP_SQL, (agent_id,))
+            if c.fetchone()['n'] >= cap:
+                return None, False
+        c.execute(CLAIM_SQL, (agent_id, user_id))
+        if c.rowcount != 1:
+            c.execute(TICKET_CLAIM_SQL, (user_id,))
+            row = c.fetchone()
+            return (row['claimed_by'] if row else None), False
+        c.execute(CLAIM_OPEN_TICKET_SQL, (agent_id, user_id))
+        c.execute(INCREMENT_CLAIM_SQL, (agent_id,))
+    return agent_id, True
+
 # ------------- Ticket lifecycle ------------- #
+MESSAGE_CONTEXT_SQL = """
+       SELECT u.userid, u.banned, u.language, u.claimed_by, u.open_ticket_spam,
+              u.open_ticket_link,
+              ct.id         AS ct_id,
+              ct.resolved   AS ct_resolved,
+              ct.claimed_by AS ct_claimed_by,
+              lu.id         AS lu_id,
+              lu.first_message_link AS lu_first_link,
+              lu.last_message_link  AS lu_last_link,
+              cv.flow       AS cv_flow,
+              cv.state      AS cv_state,
+              cv.payload    AS cv_payload
+         FROM (SELECT %s AS uid) q
+    LEFT JOIN users   u  ON u.userid = q.uid
+    LEFT JOIN conversations cv ON cv.user_id = q.uid AND cv.expires_at > NOW()
+    LEFT JOIN tickets ct ON ct.id = u.current_ticket_id AND ct.closed_at IS NULL
+    LEFT JOIN tickets lu ON lu.id = (
+              SELECT id FROM tickets
+               WHERE user_id=%s AND resolved=0 AND closed_at IS NOT NULL
+            ORDER BY closed_at DESC LIMIT 1)
+"""
+def load_message_context(user_id):
+    """
+    Everything echo_all needs about a sender in one round trip: the user row,
+    the open ticket, the last closed-but-unresolved ticket and any conversation
+    (see resources/conversation.py) the user is in the middle of.
+    """
+    with db_cursor() as c:
+        c.execute(MESSAGE_CONTEXT_SQL, (user_id, user_id))
+        row = c.fetchone()
+
+    user = None
+    if row['userid'] is not None:
+        user = {k: row[k] for k in ('userid', 'banned', 'language', 'claimed_by',
+                                    'open_ticket_spam', 'open_ticket_link')}
+    current_ticket = None
+    if row['ct_id'] is not None:
+        current_ticket = {'id': row['ct_id'], 'resolved': row['ct_resolved'], 'claimed_by': row['ct_claimed_by']}
+    last_unresolved = None
+    if row['lu_id'] is not None:
+        last_unresolved = {'id': row['lu_id'], 'first_message_link': row['lu_first_link'],
+                           'last_message_link': row['lu_last_link']}
+    conversation = None
+    if row['cv_flow'] is not None:
+        conversation = {'flow': row['cv_flow'], 'state': row['cv_state'], 'payload': row['cv_payload']}
+    return {
+        "user": user,
+        "current_ticket": current_ticket,
+        "last_unresolved": last_unresolved,
+        "conversation": conversation
+    }
+
+NEW_TICKET_SQL = "INSERT INTO tickets (user_id, first_message_link, last_message_link) VALUES (%s, %s, %s)"
+TICKET_LAST_LINK_SQL = "UPDATE tickets SET last_message_link=%s WHERE id=%s"
+UPSERT_MESSAGE_USER_SQL = """
+    INSERT INTO users (userid, language, open_ticket_link, current_ticket_id, open_ticket)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE language          = VALUES(language),
+                            open_ticket_link  = VALUES(open_ticket_link),
+                            current_ticket_id = VALUES(current_ticket_id)
+"""
+OPEN_TICKET_TIME_SQL = "UPDATE users SET open_ticket_time=%s WHERE userid=%s"
+def apply_message_updates(user_id, lang_code, link, ticket_id=None):
+    """
+    Write path for one forwarded user message, committed as one transaction:
+    creates the ticket and flags the user's open_ticket (or bumps the ticket's
+    last link), then upserts the user row with language, last link and current
+    ticket. Returns the ticket id.
+    (The spam counter lives in spam_guard and is flushed separately.)
+    """
+    new = ticket_id is None
+    with db_transaction() as c:
+        if new:
+            c.execute(NEW_TICKET_SQL, (user_id, link, link))
+            ticket_id = c.lastrowid
+            _set_flag(c, user_id, 'open_ticket', 1)     # existing user; a new row gets it from the INSERT
+        else:
+            c.execute(TICKET_LAST_LINK_SQL, (link, ticket_id))
+        c.execute(UPSERT_MESSAGE_USER_SQL, (user_id, lang_code, link, ticket_id, int(new)))
+        if c.rowcount == 1:     # 1 = inserted, 2 = updated; counters in name order
+            _bump(c, 'open_tickets', int(new))
+            _bump(c, 'users_total', 1)
+        if new:
+            c.execute(OPEN_TICKET_TIME_SQL, (datetime.now(), user_id))
+    return ticket_id
+
 def create_ticket(user_id, first_link):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""INSERT INTO tickets (user_id, first_message_link)
-                         VALUES (%s, %s)""", (user_id, first_link))
-            tid = c.lastrowid
-            c.execute("UPDATE users SET current_ticket_id=%s WHERE userid=%s", (tid, user_id))
-            return tid
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute("""INSERT INTO tickets (user_id, first_message_link)
+                     VALUES (%s, %s)""", (user_id, first_link))
+        tid = c.lastrowid
+        c.execute("UPDATE users SET current_ticket_id=%s WHERE userid=%s", (tid, user_id))
+        return tid
 
 def mark_ticket_last_link(ticket_id, link):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE tickets SET last_message_link=%s WHERE id=%s", (link, ticket_id))
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute(TICKET_LAST_LINK_SQL, (link, ticket_id))
 
+SET_TICKET_CLAIM_SQL = "UPDATE tickets SET claimed_by=%s WHERE id=%s"
 def set_ticket_claim(ticket_id, agent_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE tickets SET claimed_by=%s WHERE id=%s", (agent_id, ticket_id))
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute(SET_TICKET_CLAIM_SQL, (agent_id, ticket_id))
 
+RESOLVE_TICKET_SQL = "UPDATE tickets SET resolved=1 WHERE id=%s"
 def mark_ticket_resolved(ticket_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE tickets SET resolved=1 WHERE id=%s", (ticket_id,))
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute(RESOLVE_TICKET_SQL, (ticket_id,))
 
+SET_TICKET_CLOSED_SQL = "UPDATE tickets SET closed_at=NOW() WHERE id=%s"
 def close_ticket(ticket_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("UPDATE tickets SET closed_at=NOW() WHERE id=%s", (ticket_id,))
-    finally:
-        conn.close()
-
+    with db_cursor() as c:
+        c.execute(SET_TICKET_CLOSED_SQL, (ticket_id,))
+
+CURRENT_TICKET_SQL = """
+    SELECT t.* FROM tickets t
+    JOIN users u ON u.current_ticket_id=t.id
+    WHERE u.userid=%s AND t.closed_at IS NULL
+"""
 def get_current_ticket(user_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""
-                SELECT t.* FROM tickets t
-                JOIN users u ON u.current_ticket_id=t.id
-                WHERE u.userid=%s AND t.closed_at IS NULL
-            """, (user_id,))
-            return c.fetchone()
-    finally:
-        conn.close()
+    with db_cursor() as c:
+        c.execute(CURRENT_TICKET_SQL, (user_id,))
+        return c.fetchone()
 
+TICKET_SQL = "SELECT * FROM tickets WHERE id=%s"
 def get_ticket_by_id(ticket_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("SELECT * FROM tickets WHERE id=%s", (ticket_id,))
-            return c.fetchone()
-    finally:
-        conn.close()
-
+    with db_cursor() as c:
+        c.execute(TICKET_SQL, (ticket_id,))
+        return c.fetchone()
+
+LAST_UNRESOLVED_TICKET_SQL = """
+      SELECT * FROM tickets
+       WHERE user_id=%s AND resolved=0 AND closed_at IS NOT NULL
+    ORDER BY closed_at DESC LIMIT 1
+"""
 def get_last_unresolved_ticket(user_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""
-                SELECT * FROM tickets
-                 WHERE user_id=%s AND resolved=0 AND closed_at IS NOT NULL
-              ORDER BY closed_at DESC LIMIT 1
-            """, (user_id,))
-            return c.fetchone()
-    finally:
-        conn.close()
-
+    with db_cursor() as c:
+        c.execute(LAST_UNRESOLVED_TICKET_SQL, (user_id,))
+        return c.fetchone()
+
+RESET_TICKET_STATE_SQL = """
+    UPDATE users
+       SET current_ticket_id=NULL,
+           open_ticket_spam=1
+     WHERE userid=%s
+"""
 def reset_user_ticket_state(user_id):
-    conn = getConnection()
-    try:
-        with conn.cursor() as c:
-            c.execute("""
-                UPDATE users
-                   SET current_ticket_id=NULL,
-                       open_ticket=0,
-                       open_ticket_spam=1
-                 WHERE userid=%s
-            """, (user_id,))
-    finally:
-        conn.close()
+    with db_transaction() as c:
+        _set_flag(c, user_id, 'open_ticket', 0)
+        c.execute(RESET_TICKET_STATE_SQL, (user_id,))
+    spam_guard.reset(user_id)
+
+CLOSE_TICKET_SQL = "UPDATE tickets SET closed_at=NOW() WHERE id=%s AND closed_at IS NULL"
+PAY_AGENT_SQL = """
+    INSERT INTO earnings_ledger (ticket_id, agent_id, amount, rate)
+    SELECT t.id, a.user_id, ROUND(%s * a.commission_rate, 2), a.commission_rate
+      FROM tickets t
+      JOIN agents a ON a.user_id = t.claimed_by
+     WHERE t.id = %s
+"""
+LEDGER_AMOUNT_SQL = "SELECT amount FROM earnings_ledger WHERE ticket_id=%s"
+CLOSED_USER_SQL = """
+    UPDATE users
+       SET current_ticket_id=NULL,
+           open_ticket_spam=1,
+           claimed_by=NULL,
+           claim_time=NULL
+     WHERE userid=%s
+"""
+def close_ticket_atomic(ticket_id, user_id):
+    """
+    Close a ticket, pay the claiming agent (one earnings_ledger row) and reset
+    the user's ticket state in one transaction. Idempotent per ticket: only the
+    call that actually sets closed_at pays. Returns True if this call closed it.
+    """
+    base = getattr(config, 'ticket_commission_base', 1.0)
+    with db_transaction() as c:
+        c.execute(CLOSE_TICKET_SQL, (ticket_id,))
+        if c.rowcount != 1:
+            return False
+        c.execute(PAY_AGENT_SQL, (base, ticket_id))
+        paid = c.rowcount
+        if paid:
+            c.execute(LEDGER_AMOUNT_SQL, (ticket_id,))
+            _bump(c, 'earnings', c.fetchone()['amount'])
+        # Counter rows are always locked in name order (as the reconciler does) to avoid deadlocks
+        _set_flag(c, user_id, 'open_ticket', 0)
+        _bump(c, 'tickets_resolved', paid)
+        c.execute(CLOSED_USER_SQL, (user_id,))
+    spam_guard.reset(user_id)
+    return True
+
+ROLLUP_WATERMARK_SQL = "SELECT last_id FROM rollup_state WHERE name='earnings' FOR UPDATE"
+ROLLUP_WINDOW_SQL = """
+    SELECT MAX(id) AS hi, COUNT(*) AS n FROM earnings_ledger
+     WHERE id > %s AND ts < NOW() - INTERVAL %s SECOND
+"""
+ROLLUP_DAILY_SQL = """
+    INSERT INTO agent_daily_earnings (agent_id, day, tickets_resolved, earnings)
+    SELECT * FROM (
+        SELECT agent_id, DATE(ts), COUNT(*), SUM(amount)
+          FROM earnings_ledger
+         WHERE id > %s AND id <= %s
+      GROUP BY agent_id, DATE(ts)
+    ) AS d
+    ON DUPLICATE KEY UPDATE tickets_resolved = tickets_resolved + VALUES(tickets_resolved),
+                            earnings         = earnings + VALUES(earnings)
+"""
+ROLLUP_TOTALS_SQL = """
+    UPDATE agents a
+      JOIN (SELECT agent_id, COUNT(*) AS n, SUM(amount) AS amount
+              FROM earnings_ledger
+             WHERE id > %s AND id <= %s
+          GROUP BY agent_id) l ON l.agent_id = a.user_id
+       SET a.tickets_resolved = a.tickets_resolved + l.n,
+           a.total_earnings   = a.total_earnings + l.amount
+"""
+ROLLUP_ADVANCE_SQL = "UPDATE rollup_state SET last_id=%s WHERE name='earnings'"
+def rollup_earnings(lag=None):
+    """
+    Fold new earnings_ledger rows into agent_daily_earnings and the agents
+    totals, then move the watermark. Rows younger than `lag` seconds wait for
+    the next run so an in-flight close with a lower id is never skipped.
+    Returns the number of ledger rows rolled up.
+    """
+    lag = getattr(config, 'earnings_rollup_lag', 5) if lag is None else lag
+    with db_transaction() as c:
+        c.execute(ROLLUP_WATERMARK_SQL)
+        last = c.fetchone()['last_id']
+        c.execute(ROLLUP_WINDOW_SQL, (last, lag))
+        row = c.fetchone()
+        if not row['hi']:
+            return 0
+        hi = row['hi']
+        c.execute(ROLLUP_DAILY_SQL, (last, hi))
+        c.execute(ROLLUP_TOTALS_SQL, (last, hi))
+        c.execute(ROLLUP_ADVANCE_SQL, (hi,))
+    return row['n']
+
+# ------------- Transcripts ------------- #
+TRANSCRIPT_ROW_SQL = "(COALESCE(%s, (SELECT current_ticket_id FROM users WHERE userid=%s)), %s, %s, %s, %s, %s, %s, %s, %s)"
+SAVE_TICKET_MESSAGES_SQL = """
+    INSERT INTO ticket_messages (ticket_id, user_id, direction, sender_id, content_type, text,
+                                 file_id, message_id, ts)
+    VALUES {rows}
+"""
+
+def save_ticket_messages(rows):
+    """
+    Write transcript rows from resources/transcript.py, 500 per INSERT. Rows
+    without a ticket id get the user's current ticket. One transaction, so a
+    failed batch can be requeued whole without writing any row twice.
+    """
+    with db_transaction() as c:
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            c.execute(SAVE_TICKET_MESSAGES_SQL.format(rows=", ".join([TRANSCRIPT_ROW_SQL] * len(chunk))),
+                      [v for row in chunk for v in (row[0], row[1]) + tuple(row[1:])])
+
+TICKET_TRANSCRIPT_SQL = """
+      SELECT direction, sender_id, content_type, text, file_id, ts
+        FROM ticket_messages
+       WHERE ticket_id=%s
+    ORDER BY id LIMIT %s
+"""
+def get_ticket_transcript(ticket_id, limit=500):
+    with db_cursor() as c:
+        c.execute(TICKET_TRANSCRIPT_SQL, (ticket_id, limit))
+        return c.fetchall()
+
+SEARCH_TICKETS_SQL = """
+      SELECT m.ticket_id, m.score, t.user_id, t.first_message_link, t.last_message_link, t.closed_at
+        FROM (SELECT ticket_id, SUM(MATCH(text) AGAINST (%s)) AS score
+                FROM ticket_messages
+               WHERE MATCH(text) AGAINST (%s) AND ticket_id IS NOT NULL
+            GROUP BY ticket_id
+            ORDER BY score DESC, ticket_id DESC
+               LIMIT %s OFFSET %s) m
+        JOIN tickets t ON t.id = m.ticket_id
+    ORDER BY m.score DESC, m.ticket_id DESC
+"""
+def search_tickets(query, limit=10, offset=0):
+    """Tickets whose transcript matches `query` (FULLTEXT, natural language mode), best first."""
+    with db_cursor() as c:
+        c.execute(SEARCH_TICKETS_SQL, (query, query, limit, offset))
+        return c.fetchall()
+
+TICKET_MESSAGES_SINCE_SQL = """
+      SELECT id, ticket_id, text FROM ticket_messages
+       WHERE id > %s AND ticket_id IS NOT NULL AND text IS NOT NULL
+    ORDER BY id LIMIT %s
+"""
+def get_ticket_messages_since(last_id, limit):
+    """Transcript text after ticket_messages.id `last_id` (feeds resources/search.py's local index)."""
+    with db_cursor() as c:
+        c.execute(TICKET_MESSAGES_SINCE_SQL, (last_id, limit))
+        return c.fetchall()
+
+def get_tickets_brief(ticket_ids):
+    """{ticket_id: {"user_id", "first_message_link", "last_message_link", "closed_at"}}"""
+    if not ticket_ids:
+        return {}
+    with db_cursor() as c:
+        c.execute("SELECT id, user_id, first_message_link, last_message_link, closed_at FROM tickets "
+                  "WHERE id IN (" + ", ".join(["%s"] * len(ticket_ids)) + ")", list(ticket_ids))
+        return {r.pop('id'): r for r in c.fetchall()}
+
+# ------------- Conversations ------------- #
+SAVE_CONVERSATION_SQL = """
+    INSERT INTO conversations (user_id, flow, state, payload, expires_at)
+    VALUES (%s, %s, %s, %s, NOW() + INTERVAL %s SECOND)
+    ON DUPLICATE KEY UPDATE flow=VALUES(flow), state=VALUES(state),
+                            payload=VALUES(payload), expires_at=VALUES(expires_at)
+"""
+def save_conversation(user_id, flow, state, payload, ttl):
+    with db_cursor() as c:
+        c.execute(SAVE_CONVERSATION_SQL, (user_id, flow, state, payload, int(ttl)))
+
+END_CONVERSATION_SQL = "DELETE FROM conversations WHERE user_id=%s"
+def end_conversation(user_id):
+    with db_cursor() as c:
+        c.execute(END_CONVERSATION_SQL, (user_id,))
+        return c.rowcount
+
+PURGE_CONVERSATIONS_SQL = "DELETE FROM conversations WHERE expires_at <= NOW() LIMIT %s"
+def purge_conversations(batch=1000):
+    """Delete expired conversations in small batches (periodic job). Returns the number removed."""
+    removed = 0
+    while True:
+        with db_cursor() as c:
+            c.execute(PURGE_CONVERSATIONS_SQL, (batch,))
+            n = c.rowcount
+        removed += n
+        if n < batch:
+            return removed
 
 # ------------- Globals ------------- #
-try:
-    open_tickets = getOpenTickets()
-    banned = getBanned()
-except Exception:
-    open_tickets = []
-    banned = []
+# Loaded on first use; kept in the shared state backend when several processes run
+_id_store = state.backend() if state.shared() else None
+_id_ttl = getattr(config, 'membership_reconcile_interval', 900)
+banned = IdSet('banned', getBanned, _id_store, _id_ttl)
+
+def is_banned(user_id):
+    return user_id in banned
+
+def reconcile_membership():
+    """Re-read the banned id set from the DB (periodic job)."""
+    banned.reload()
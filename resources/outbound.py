@@ -0,0 +1,295 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : outbound.py           #
+# --------------------------------------------- #
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import config
+from telebot.apihelper import ApiTelegramException
+
+# Priority lanes (lower is served first)
+PRIORITY_REPLY = 0      # user-facing replies / relays
+PRIORITY_NOTICE = 1     # confirmations, group notices
+PRIORITY_ACTION = 2     # typing indicators (coalesced, dropped when congested)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until one token is available (0 = now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ('chat_id', 'fn', 'args', 'kwargs', 'priority', 'seq', 'future', 'queued_at')
+
+    def __init__(self, chat_id, fn, args, kwargs, priority, seq):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+
+class Dispatcher:
+    """
+    Central queue for outbound Telegram calls. Keeps per-chat and global token
+    buckets, never sends two calls to the same chat at once and re-queues calls
+    that got a 429 after the `retry_after` Telegram asks for.
+
+    Every chat has its own FIFO queue, so order is kept per chat. A chat whose
+    bucket has a token sits in `_ready`, ranked by the priority of the call at
+    the head of its queue; one that has to wait sits in `_waiting` until its
+    bucket refills. Picking the next call is therefore O(log chats), however
+    many calls are queued behind rate-limited chats.
+    """
+
+    def __init__(self, global_rate=30, private_rate=1, group_rate=20 / 60, burst=3,
+                 workers=4, action_backlog=200):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._action_backlog = action_backlog
+        self._buckets = {}          # chat_id -> TokenBucket (dropped again once full and idle)
+        self._swept = time.monotonic()
+        self._queues = {}           # chat_id -> deque of jobs (dropped again once empty and idle)
+        self._ready = []            # (priority, seq, chat_id) of the job at the head of a sendable chat
+        self._waiting = []          # (ready_at, chat_id) for chats whose bucket is empty or blocked
+        self._queued = 0
+        self._seq = itertools.count()
+        self._busy = set()          # chat ids with a call in flight
+        self._actions = set()       # chat ids with a queued chat action
+        self._cond = threading.Condition()
+        self._stats = {'sent': 0, 'retried_429': 0, 'failed': 0, 'actions_dropped': 0, 'wait_total_ms': 0.0}
+        self._workers = [
+            threading.Thread(target=self._run, name=f'outbound-{i}', daemon=True) for i in range(workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    # ------------- Public API ------------- #
+    def submit(self, fn, chat_id, *args, priority=PRIORITY_REPLY, **kwargs):
+        """Queue `fn(chat_id, *args, **kwargs)`; returns a Future with the API result."""
+        with self._cond:
+            job = _Job(chat_id, fn, (chat_id,) + args, kwargs, priority, next(self._seq))
+            self._enqueue(job)
+        return job.future
+
+    def chat_action(self, bot, chat_id, action):
+        """Fire-and-forget chat action; duplicates are coalesced and dropped under load."""
+        with self._cond:
+            if chat_id in self._actions:
+                return
+            if self._queued >= self._action_backlog:
+                self._stats['actions_dropped'] += 1
+                return
+            self._actions.add(chat_id)
+            self._enqueue(_Job(chat_id, bot.send_chat_action, (chat_id, action), {}, PRIORITY_ACTION, next(self._seq)))
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s['queued'] = self._queued
+            s['buckets'] = len(self._buckets)
+        total = s.pop('wait_total_ms')
+        s['wait_avg_ms'] = round(total / s['sent'], 3) if s['sent'] else 0.0
+        return s
+
+    # ------------- Worker ------------- #
+    def _bucket(self, chat_id):
+        b = self._buckets.get(chat_id)
+        if b is None:
+            if chat_id < 0:
+                b = TokenBucket(self._group_rate, self._burst)
+            else:
+                b = TokenBucket(self._private_rate, self._burst)
+            self._buckets[chat_id] = b
+        return b
+
+    def _sweep(self, now):
+        """Forget buckets that have refilled and have nothing in flight; a new one starts full anyway."""
+        self._swept = now
+        for chat_id, b in list(self._buckets.items()):
+            if (chat_id not in self._busy and now >= b.blocked_until
+                    and b.tokens + (now - b.stamp) * b.rate >= b.capacity):
+                del self._buckets[chat_id]
+
+    def _enqueue(self, job):
+        q = self._queues.get(job.chat_id)
+        if q is None:
+            q = self._queues[job.chat_id] = deque()
+        q.append(job)
+        self._queued += 1
+        if len(q) == 1 and job.chat_id not in self._busy:
+            self._schedule(job.chat_id, time.monotonic())
+            self._cond.notify()
+
+    def _schedule(self, chat_id, now):
+        """Put an idle chat with queued calls into `_ready` or `_waiting`."""
+        wait = self._bucket(chat_id).wait_time(now)
+        if wait:
+            heapq.heappush(self._waiting, (now + wait, chat_id))
+        else:
+            head = self._queues[chat_id][0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _release(self, chat_id):
+        """The call in flight for `chat_id` is done; schedule its next one (or forget the chat)."""
+        self._busy.discard(chat_id)
+        if self._queues[chat_id]:
+            self._schedule(chat_id, time.monotonic())
+        else:
+            del self._queues[chat_id]
+        self._cond.notify_all()
+
+    def _next_job(self):
+        """Pop the best runnable job, or return the seconds to sleep (None = until notified)."""
+        now = time.monotonic()
+        if now - self._swept > 60:
+            self._sweep(now)
+        while self._waiting and self._waiting[0][0] <= now:
+            self._schedule(heapq.heappop(self._waiting)[1], now)
+        if not self._ready:
+            return None, (self._waiting[0][0] - now if self._waiting else None)
+        g_wait = self._global.wait_time(now)
+        if g_wait:
+            return None, g_wait
+        chat_id = heapq.heappop(self._ready)[2]
+        job = self._queues[chat_id].popleft()
+        self._queued -= 1
+        self._global.take()
+        self._bucket(chat_id).take()
+        self._busy.add(chat_id)
+        if job.priority == PRIORITY_ACTION:
+            self._actions.discard(chat_id)
+        return job, 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    job, sleep = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait(sleep)
+            self._execute(job)
+
+    def _execute(self, job):
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            with self._cond:
+                if e.error_code == 429:
+                    retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                    self._bucket(job.chat_id).blocked_until = time.monotonic() + retry_after
+                    self._stats['retried_429'] += 1
+                    # Keep its place in line: back to the head of its chat's queue.
+                    self._queues[job.chat_id].appendleft(job)
+                    self._queued += 1
+                    self._release(job.chat_id)
+                    return
+                self._stats['failed'] += 1
+                self._release(job.chat_id)
+            job.future.set_exception(e)
+            return
+        except Exception as e:
+            with self._cond:
+                self._stats['failed'] += 1
+                self._release(job.chat_id)
+            job.future.set_exception(e)
+            return
+        with self._cond:
+            self._stats['sent'] += 1
+            self._stats['wait_total_ms'] += (time.monotonic() - job.queued_at) * 1000
+            self._release(job.chat_id)
+        job.future.set_result(result)
+
+
+_dispatcher = None
+_lock = threading.Lock()
+
+
+def dispatcher():
+    global _dispatcher
+    with _lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(
+                global_rate=getattr(config, 'outbound_global_rate', 30),
+                private_rate=getattr(config, 'outbound_private_rate', 1),
+                group_rate=getattr(config, 'outbound_group_rate', 20 / 60),
+                burst=getattr(config, 'outbound_burst', 3),
+                workers=getattr(config, 'outbound_workers', 4)
+            )
+        return _dispatcher
+
+
+def send(fn, chat_id, *args, priority=PRIORITY_REPLY, **kwargs):
+    """Rate-limited `fn(chat_id, ...)`; blocks until sent and returns the API result (or raises)."""
+    return submit(fn, chat_id, *args, priority=priority, **kwargs).result()
+
+
+def submit(fn, chat_id, *args, priority=PRIORITY_REPLY, **kwargs):
+    """
+    Rate-limited `fn(chat_id, ...)` without waiting; returns the Future of the
+    API result. For posts to the support group, whose bucket (20/min) would
+    otherwise park the calling update worker.
+    """
+    return dispatcher().submit(fn, chat_id, *args, priority=priority, **kwargs)
+
+
+def send_later(fn, chat_id, *args, priority=PRIORITY_NOTICE, **kwargs):
+    """Rate-limited `fn(chat_id, ...)` without waiting; failures are logged."""
+    future = dispatcher().submit(fn, chat_id, *args, priority=priority, **kwargs)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def reply_to(bot, message, text, priority=PRIORITY_REPLY, **kwargs):
+    """
+    Rate-limited equivalent of bot.reply_to(). In private chats it waits for the
+    API result; in groups (the support group's bucket allows 20/min) it only
+    queues the reply and returns its Future, failures being logged.
+    """
+    if message.chat.type == 'private':
+        return send(bot.send_message, message.chat.id, text, priority=priority,
+                    reply_to_message_id=message.message_id, **kwargs)
+    return send_later(bot.send_message, message.chat.id, text, priority=priority,
+                      reply_to_message_id=message.message_id, **kwargs)
+
+
+def chat_action(bot, chat_id, action):
+    dispatcher().chat_action(bot, chat_id, action)
+
+
+def stats():
+    return dispatcher().stats()
+
+
+def _log_failure(future):
+    e = future.exception()
+    if e is not None:
+        print("⚠️ Outbound call failed:", e)
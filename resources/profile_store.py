@@ -0,0 +1,131 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : profile_store.py      #
+# --------------------------------------------- #
+
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from resources import mysql_handler as mysql
+
+_FIELDS = ('first_name', 'last_name', 'username', 'language_code')
+
+_cache = OrderedDict()      # {user_id: {"first_name": .., "last_name": .., "username": .., "language_code": ..}}
+_lock = threading.Lock()
+_pending_refresh = set()    # user ids we know nothing about yet
+_written = {}               # {user_id: monotonic time we last wrote updated_at}, for cached users
+
+
+def _put(user_id, profile, written=False):
+    with _lock:
+        _cache[user_id] = profile
+        _cache.move_to_end(user_id)
+        if written:
+            _written[user_id] = time.monotonic()
+        while len(_cache) > getattr(config, 'profile_cache_size', 10000):
+            old, _ = _cache.popitem(last=False)
+            _written.pop(old, None)
+
+
+def _cached(user_id):
+    with _lock:
+        profile = _cache.get(user_id)
+        if profile is not None:
+            _cache.move_to_end(user_id)
+        return profile
+
+
+def peek(user_id):
+    """Cached profile or None, without touching the DB (for the asyncio runtime)."""
+    return _cached(user_id)
+
+
+def store(user_id, profile, written=False):
+    """Put an already persisted profile into the cache (`written`: its updated_at was just set)."""
+    _put(user_id, {f: profile.get(f) for f in _FIELDS}, written)
+
+
+def touch_due(user_id):
+    """True if an unchanged profile's updated_at should be bumped now (see remember())."""
+    with _lock:
+        written = _written.get(user_id)
+    return written is None or time.monotonic() - written >= getattr(config, 'profile_touch_interval', 86400)
+
+
+def remember(user):
+    """
+    Store a telebot `User` seen on an incoming update. Writes when something
+    changed; otherwise only bumps updated_at, at most every profile_touch_interval
+    seconds, so active users are never picked up by the stale-profile refresh.
+    """
+    if user is None or getattr(user, 'is_bot', False):
+        return
+    profile = {f: getattr(user, f, None) for f in _FIELDS}
+    if _cached(user.id) == profile:
+        if not touch_due(user.id):
+            return
+        mysql.touch_user_profile(user.id)
+    else:
+        mysql.save_user_profile(user.id, **profile)
+    _put(user.id, profile, written=True)
+
+
+def get(user_id):
+    """Profile dict from memory or the DB. Never calls Telegram; unknown users are queued for refresh."""
+    profile = _cached(user_id)
+    if profile is not None:
+        return profile
+    row = mysql.get_user_profile(user_id)
+    if row:
+        profile = {f: row[f] for f in _FIELDS}
+        _put(user_id, profile)
+        return profile
+    with _lock:
+        _pending_refresh.add(user_id)
+    return None
+
+
+def first_name(user_id, default=''):
+    profile = get(user_id)
+    return (profile or {}).get('first_name') or default
+
+
+def _refresh(bot, user_id):
+    chat = bot.get_chat(user_id)
+    profile = {
+        'first_name': chat.first_name,
+        'last_name': chat.last_name,
+        'username': chat.username,
+        'language_code': (_cached(user_id) or {}).get('language_code')
+    }
+    mysql.save_user_profile(user_id, **profile)
+    _put(user_id, profile, written=True)
+
+
+def _refresher(bot):
+    while True:
+        time.sleep(getattr(config, 'profile_refresh_interval', 300))
+        try:
+            with _lock:
+                ids = list(_pending_refresh)
+                _pending_refresh.clear()
+            ids += mysql.get_stale_profiles(getattr(config, 'profile_max_age', 7))
+            for user_id in ids:
+                try:
+                    _refresh(bot, user_id)
+                except Exception as e:
+                    # e.g. the user blocked the bot - don't retry on every tick
+                    mysql.touch_user_profile(user_id)
+                    print(f"⚠️ Profile refresh failed for {user_id}:", e)
+        except Exception as e:
+            print("⚠️ Profile refresher error:", e)
+
+
+def start_refresher(bot):
+    """Refresh unknown and stale profiles in the background so handlers never block on get_chat."""
+    t = threading.Thread(target=_refresher, args=(bot,), name='profile-refresher', daemon=True)
+    t.start()
+    return t
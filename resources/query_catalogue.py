@@ -0,0 +1,147 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : query_catalogue.py    #
+# --------------------------------------------- #
+# Every hot query the bot runs, EXPLAINed against a seeded database. A query
+# fails the check when MySQL would read a whole table/index (type ALL/index)
+# or sort the result itself (Using filesort).
+#
+#   python -m resources.query_catalogue --seed 20000   # seed, check, clean up
+#   python -m resources.query_catalogue                # check the data as it is
+#
+# Point config.mysql_db at a scratch copy of the database: seeding writes rows.
+
+import sys
+
+import pymysql
+
+from resources import migrations
+from resources import mysql_handler as mysql
+
+BASE = 9_000_000_000_000          # seeded ids start here, far above real Telegram ids
+USER = BASE + 1
+AGENT = BASE + 2
+
+# (name, sql, params, scan_ok). The statements are mysql_handler's own, so the
+# check follows the code. scan_ok marks tables that stay tiny (agents,
+# counters) or a LIMIT read straight off an index.
+QUERIES = [
+    ("load_message_context", mysql.MESSAGE_CONTEXT_SQL, (USER, USER), False),
+    ("get_last_unresolved_ticket", mysql.LAST_UNRESOLVED_TICKET_SQL, (USER,), False),
+    ("get_current_ticket", mysql.CURRENT_TICKET_SQL, (USER,), False),
+    ("get_claimed_ticket_by_agent/users", mysql.CLAIMED_BY_AGENT_USERS_SQL, (AGENT,), False),
+    ("get_claimed_ticket_by_agent/tickets", mysql.CLAIMED_BY_AGENT_TICKETS_SQL, (AGENT,), False),
+    ("get_agent_active_tickets", mysql.AGENT_ACTIVE_TICKETS_SQL, (AGENT,), False),
+    ("count_agent_active_tickets", mysql.COUNT_AGENT_ACTIVE_TICKETS_SQL, (AGENT,), False),
+    ("getBanned", mysql.BANNED_IDS_SQL, (), False),
+    ("list_open_tickets", mysql.OPEN_TICKETS_SQL, (), False),
+    ("list_banned_users", mysql.BANNED_USERS_SQL, (), False),
+    ("get_stale_profiles", mysql.STALE_PROFILES_SQL, (7, 50), False),
+    ("claim_ticket_atomic", mysql.CLAIM_SQL, (AGENT, USER), False),
+    ("claim_ticket_atomic/cap", mysql.CLAIM_CAP_SQL, (AGENT,), False),
+    ("close_ticket_atomic", mysql.CLOSE_TICKET_SQL, (1,), False),
+    ("agent earnings tail", mysql.LEDGER_TAIL_SQL, (AGENT,), False),
+    ("agent last 7 days", mysql.AGENT_WEEK_SQL, (AGENT,), False),
+    ("rollup_earnings/daily", mysql.ROLLUP_DAILY_SQL, (0, 1000), False),
+    ("rollup_earnings/totals", mysql.ROLLUP_TOTALS_SQL, (0, 1000), True),
+    ("report top agents", mysql.TOP_AGENTS_SQL, (), True),
+    ("get_stats_counters", mysql.STATS_COUNTERS_SQL, (), True),
+    ("get_ticket_transcript", mysql.TICKET_TRANSCRIPT_SQL, (1, 500), False),
+    ("search_tickets", mysql.SEARCH_TICKETS_SQL, ("refund", "refund", 10, 0), False),
+    ("get_ticket_messages_since", mysql.TICKET_MESSAGES_SINCE_SQL, (0, 50000), False),
+    ("purge_conversations", mysql.PURGE_CONVERSATIONS_SQL, (1000,), False),
+    ("getAgents", mysql.AGENTS_SQL, (), True),
+    ("get_routing_agents", mysql.ROUTING_AGENTS_SQL, (), True),
+    ("get_agent_availability", mysql.AGENT_SHIFTS_SQL, (), True),
+]
+
+# Ranked by relevance: sorting the (LIMITed) matches is the point of the query
+SORT_OK = {"search_tickets"}
+
+def explain(c, sql, params):
+    c.execute("EXPLAIN " + sql, params)
+    return c.fetchall()
+
+
+def problems(plan, scan_ok=False, sort_ok=False):
+    """Why a plan is rejected: full scans and filesorts (unless allowed)."""
+    found = []
+    for row in plan:
+        table, access, extra = row.get('table'), row.get('type'), row.get('Extra') or ''
+        if access in ('ALL', 'index') and not scan_ok and not str(table).startswith('<'):
+            found.append(f"full scan of {table} ({access})")
+        if 'Using filesort' in extra and not sort_ok:
+            found.append(f"filesort on {table}")
+    return found
+
+
+def check():
+    """EXPLAIN every catalogued query; returns the number of failures."""
+    failures = 0
+    with mysql.db_cursor() as c:
+        for name, sql, params, scan_ok in QUERIES:
+            try:
+                bad = problems(explain(c, sql, params), scan_ok, name in SORT_OK)
+            except pymysql.err.MySQLError as e:
+                bad = [f"EXPLAIN failed: {e}"]     # e.g. 1191 while the FULLTEXT index is still building
+            failures += bool(bad)
+            print(f"{'❌' if bad else '✅'} {name}" + (f": {'; '.join(bad)}" if bad else ''))
+    return failures
+
+
+def seed(n):
+    """Insert `n` synthetic users/tickets/profiles (+ ledger rows and 20 agents) above BASE."""
+    users, tickets, profiles, ledger = [], [], [], []
+    for i in range(n):
+        uid = BASE + i
+        is_open = i % 20 == 0
+        agent = BASE + (i % 20) if is_open or i % 3 == 0 else None
+        users.append((uid, int(is_open), int(i % 97 == 0), agent, i % 1440))
+        tickets.append((uid, int(i % 2 == 0), agent, None if is_open else i % 10000))
+        profiles.append((uid, f"user{i}", 30 if i % 100 == 0 else 1))
+        if agent and not is_open:
+            ledger.append((BASE + i, agent, 1.5, 0.15))
+    with mysql.db_cursor() as c:
+        for chunk in range(0, n, 1000):
+            c.executemany("""INSERT IGNORE INTO users (userid, open_ticket, banned, claimed_by, open_ticket_time, language)
+                             VALUES (%s, %s, %s, %s, NOW() - INTERVAL %s MINUTE, 'en')""",
+                          users[chunk:chunk + 1000])
+            c.executemany("""INSERT INTO tickets (user_id, resolved, claimed_by, closed_at)
+                             VALUES (%s, %s, %s, NOW() - INTERVAL %s MINUTE)""",
+                          tickets[chunk:chunk + 1000])
+            c.executemany("""INSERT IGNORE INTO user_profiles (userid, first_name, updated_at)
+                             VALUES (%s, %s, NOW() - INTERVAL %s DAY)""", profiles[chunk:chunk + 1000])
+        for chunk in range(0, len(ledger), 1000):
+            c.executemany("""INSERT IGNORE INTO earnings_ledger (ticket_id, agent_id, amount, rate)
+                             VALUES (%s, %s, %s, %s)""", ledger[chunk:chunk + 1000])
+        c.executemany("INSERT IGNORE INTO agents (user_id, full_name, tickets_resolved) VALUES (%s, %s, %s)",
+                      [(BASE + i, f"agent{i}", i) for i in range(20)])
+        for table in ("users", "tickets", "user_profiles", "earnings_ledger", "agents"):
+            c.execute(f"ANALYZE TABLE {table}")
+            c.fetchall()
+
+
+def cleanup():
+    with mysql.db_cursor() as c:
+        c.execute("DELETE FROM users WHERE userid >= %s", (BASE,))
+        c.execute("DELETE FROM tickets WHERE user_id >= %s", (BASE,))
+        c.execute("DELETE FROM user_profiles WHERE userid >= %s", (BASE,))
+        c.execute("DELETE FROM earnings_ledger WHERE ticket_id >= %s", (BASE,))
+        c.execute("DELETE FROM agent_daily_earnings WHERE agent_id >= %s", (BASE,))
+        c.execute("DELETE FROM agents WHERE user_id >= %s", (BASE,))
+    mysql.reconcile_stats_counters()
+
+
+if __name__ == '__main__':
+    migrations.run(wait=True)
+    rows = int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else 0
+    if rows:
+        seed(rows)
+    try:
+        failed = check()
+    finally:
+        if rows:
+            cleanup()
+    print(f"\n{len(QUERIES) - failed}/{len(QUERIES)} queries use an index without sorting")
+    sys.exit(1 if failed else 0)
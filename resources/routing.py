@@ -0,0 +1,189 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : routing.py            #
+# --------------------------------------------- #
+# Auto-assignment of new tickets. Per language, a heap of the agents who could
+# take one now: on shift (resources/availability.py) first, then fewest open
+# tickets, then whoever waited longest since their last change. Agents at
+# route_max_active are not in any heap, so the top of the heap is the pick and
+# assigning is O(log n). When a language's heap is empty the ticket keeps its
+# claim button.
+#
+# The loads here are this process's view; the claim itself re-checks the cap
+# in the DB (claim_ticket_atomic), and a periodic load() resyncs from it.
+
+import heapq
+import itertools
+import threading
+
+import config
+
+
+class Router:
+    """
+    Heap entries are (off_shift, active, seq, agent_id). Any change to an agent
+    gives it a new seq and pushes fresh entries; older ones are skipped when they
+    reach the top (lazy deletion) and dropped when a heap is compacted.
+    """
+
+    def __init__(self, max_active=1, off_shift=False):
+        self.max_active = max_active
+        self.off_shift = off_shift
+        self._agents = {}       # {agent_id: {"languages", "on_shift", "active", "seq"}}
+        self._heaps = {}        # {language: [entry]}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {'assigned': 0, 'fallback': 0}
+
+    def _eligible(self, a):
+        return a['active'] < self.max_active and (a['on_shift'] or self.off_shift) and a['languages']
+
+    def _push(self, agent_id, a):
+        a['seq'] = next(self._seq)
+        if not self._eligible(a):
+            return
+        entry = (not a['on_shift'], a['active'], a['seq'], agent_id)
+        for lang in a['languages']:
+            heap = self._heaps.setdefault(lang, [])
+            heapq.heappush(heap, entry)
+            if len(heap) > 64 and len(heap) > 4 * len(self._agents):
+                self._compact(lang)
+
+    def _live(self, entry):
+        a = self._agents.get(entry[3])
+        return a is not None and a['seq'] == entry[2]
+
+    def _compact(self, lang):
+        heap = [e for e in self._heaps[lang] if self._live(e)]
+        heapq.heapify(heap)
+        self._heaps[lang] = heap
+
+    def load(self, rows, on_shift=()):
+        """Replace everything with `rows`: [{"user_id", "languages", "active"}]; `on_shift`: agent ids."""
+        with self._lock:
+            self._agents = {}
+            self._heaps = {}
+            for r in rows:
+                a = self._agents[r['user_id']] = {'languages': frozenset(r['languages']),
+                                                  'on_shift': r['user_id'] in on_shift,
+                                                  'active': int(r['active']), 'seq': 0}
+                self._push(r['user_id'], a)
+
+    def set_shifts(self, on_shift):
+        """Mark exactly the agents in `on_shift` as on shift (see availability.on_shift_now)."""
+        with self._lock:
+            for agent_id, a in self._agents.items():
+                if a['on_shift'] != (agent_id in on_shift):
+                    a['on_shift'] = not a['on_shift']
+                    self._push(agent_id, a)
+
+    def update(self, agent_id, **fields):
+        """Change an agent's languages/on_shift/active (adding the agent if unknown)."""
+        with self._lock:
+            a = self._agents.setdefault(agent_id, {'languages': frozenset(), 'on_shift': False,
+                                                   'active': 0, 'seq': 0})
+            if 'languages' in fields:
+                fields['languages'] = frozenset(fields['languages'])
+            a.update(fields)
+            self._push(agent_id, a)
+
+    def assign(self, language):
+        """Take the best agent for `language` and count the ticket against them; None if nobody."""
+        with self._lock:
+            heap = self._heaps.get(language)
+            while heap and not self._live(heap[0]):
+                heapq.heappop(heap)
+            if not heap:
+                self._stats['fallback'] += 1
+                return None
+            agent_id = heapq.heappop(heap)[3]
+            a = self._agents[agent_id]
+            a['active'] += 1
+            self._push(agent_id, a)
+            self._stats['assigned'] += 1
+            return agent_id
+
+    def claimed(self, agent_id):
+        """The agent claimed a ticket through the button."""
+        with self._lock:
+            a = self._agents.get(agent_id)
+            if a is not None:
+                a['active'] += 1
+                self._push(agent_id, a)
+
+    def release(self, agent_id, full=False):
+        """One of the agent's tickets was closed (or an assignment fell through).
+        full=True: the DB says the agent is at the cap already."""
+        with self._lock:
+            a = self._agents.get(agent_id)
+            if a is None:
+                return
+            a['active'] = self.max_active if full else max(0, a['active'] - 1)
+            self._push(agent_id, a)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['agents'] = len(self._agents)
+            s['on_shift'] = sum(1 for a in self._agents.values() if a['on_shift'])
+            s['eligible'] = sum(1 for a in self._agents.values() if self._eligible(a))
+            s['active'] = sum(a['active'] for a in self._agents.values())
+        return s
+
+
+_router = None
+_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(config, 'route_tickets', True)
+
+
+def router():
+    global _router
+    with _lock:
+        if _router is None:
+            _router = Router(max_active=getattr(config, 'route_max_active', 1),
+                             off_shift=getattr(config, 'route_off_shift', False))
+        return _router
+
+
+def route(user_id, language, claim):
+    """
+    Assign `user_id`'s new ticket through `claim(user_id, agent_id, cap=...)`
+    (mysql_handler.claim_ticket_atomic). Returns the agent id, or None to leave
+    the ticket to the claim button.
+    """
+    r = router()
+    for _ in range(getattr(config, 'route_attempts', 3)):
+        agent_id = r.assign(language)
+        if agent_id is None:
+            return None
+        owner, won = claim(user_id, agent_id, cap=r.max_active)
+        if won:
+            return agent_id
+        r.release(agent_id, full=owner is None)
+        if owner is not None:       # claimed through the button meanwhile
+            return None
+    return None
+
+
+async def route_async(user_id, language, claim):
+    """route() for main_async.py, with the async claim (async_mysql_handler.claim_ticket_atomic)."""
+    r = router()
+    for _ in range(getattr(config, 'route_attempts', 3)):
+        agent_id = r.assign(language)
+        if agent_id is None:
+            return None
+        owner, won = await claim(user_id, agent_id, cap=r.max_active)
+        if won:
+            return agent_id
+        r.release(agent_id, full=owner is None)
+        if owner is not None:
+            return None
+    return None
+
+
+def stats():
+    return router().stats()
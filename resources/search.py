@@ -0,0 +1,242 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : search.py             #
+# --------------------------------------------- #
+# /search over ticket transcripts (ticket_messages). Normally MySQL's FULLTEXT
+# index ranks the tickets (until background migration 9 has built it, searches
+# raise IndexBuilding). With search_backend = 'local' an inverted index kept in
+# this process does instead (BM25 ranking, fed incrementally from
+# ticket_messages by id); it holds every transcript in memory, so it is only
+# ever loaded when chosen explicitly, by start_indexer() on a background thread
+# (searches raise IndexBuilding until the first load is done).
+#
+#   python -m resources.search --seed 1000000   # seed, time both backends, clean up
+#
+# Point config.mysql_db at a scratch copy of the database: seeding writes rows.
+
+import heapq
+import itertools
+import math
+import random
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, deque
+
+import config
+import pymysql
+from resources import mysql_handler as mysql
+
+_TOKEN = re.compile(r"\w{2,}", re.UNICODE)
+_NO_FULLTEXT = 1191     # ER_FT_MATCHING_KEY_NOT_FOUND
+
+
+class IndexBuilding(Exception):
+    """The FULLTEXT index does not exist yet (migration 9 still running), or the local index is still loading."""
+
+
+def tokens(text):
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+class InvertedIndex:
+    """
+    token -> array of ticket ids (one entry per occurrence, so the term count per
+    ticket is how often the id repeats). Arrays of ints keep a million messages
+    in tens of MB where dicts of dicts would take a GB.
+    """
+
+    K1, B = 1.2, 0.75
+
+    def __init__(self):
+        self._postings = {}     # {token: array('q')}
+        self._doc_len = {}      # {ticket_id: tokens indexed}
+        self._total_len = 0
+        self.last_id = 0        # highest ticket_messages.id indexed
+        self._lock = threading.Lock()
+
+    def add(self, ticket_id, text):
+        words = tokens(text)
+        if not words:
+            return
+        with self._lock:
+            for w in words:
+                p = self._postings.get(w)
+                if p is None:
+                    p = self._postings[w] = array('q')
+                p.append(ticket_id)
+            self._doc_len[ticket_id] = self._doc_len.get(ticket_id, 0) + len(words)
+            self._total_len += len(words)
+
+    def search(self, query, limit=10, offset=0):
+        """[(ticket_id, score)] best first."""
+        with self._lock:
+            n = len(self._doc_len)
+            if not n:
+                return []
+            avg = self._total_len / n
+            scores = Counter()
+            for term in set(tokens(query)):
+                p = self._postings.get(term)
+                if not p:
+                    continue
+                tf = Counter(p)
+                idf = math.log(1 + (n - len(tf) + 0.5) / (len(tf) + 0.5))
+                for tid, f in tf.items():
+                    norm = self.K1 * (1 - self.B + self.B * self._doc_len[tid] / avg)
+                    scores[tid] += idf * f * (self.K1 + 1) / (f + norm)
+        best = heapq.nlargest(offset + limit, scores.items(), key=lambda kv: (kv[1], kv[0]))
+        return best[offset:]
+
+    def __len__(self):
+        return len(self._doc_len)
+
+
+_index = InvertedIndex()
+_refresh_lock = threading.Lock()
+_ready = threading.Event()      # set once the local index holds every transcript row
+_latency = deque(maxlen=1000)   # (backend, ms) of recent searches
+
+
+def refresh(batch=50000):
+    """Index transcript rows written since the last call."""
+    with _refresh_lock:
+        while True:
+            rows = mysql.get_ticket_messages_since(_index.last_id, batch)
+            for r in rows:
+                _index.add(r['ticket_id'], r['text'])
+            if rows:
+                _index.last_id = rows[-1]['id']
+            if len(rows) < batch:
+                return
+
+
+def _indexer(interval):
+    while True:
+        try:
+            refresh()
+            _ready.set()
+        except Exception as e:
+            print("⚠️ Search index refresh failed:", e)
+        time.sleep(interval)
+
+
+def start_indexer():
+    """Load the local index now and pick up new transcript rows every search_refresh_interval seconds."""
+    t = threading.Thread(target=_indexer, args=(getattr(config, 'search_refresh_interval', 5),),
+                         name='search-indexer', daemon=True)
+    t.start()
+    return t
+
+
+def _local(query, limit, offset):
+    if not _ready.is_set():
+        raise IndexBuilding()
+    hits = _index.search(query, limit, offset)
+    info = mysql.get_tickets_brief([tid for tid, _ in hits])
+    return [dict(info[tid], ticket_id=tid, score=score) for tid, score in hits if tid in info]
+
+
+def search(query, limit=10, offset=0):
+    """
+    Tickets matching `query`, best first: [{"ticket_id", "score", "user_id",
+    "first_message_link", "last_message_link", "closed_at"}].
+    """
+    started = time.monotonic()
+    backend = getattr(config, 'search_backend', 'mysql')
+    if backend == 'mysql':
+        try:
+            rows = mysql.search_tickets(query, limit, offset)
+        except pymysql.err.MySQLError as e:
+            if e.args[0] == _NO_FULLTEXT:
+                raise IndexBuilding() from e
+            raise
+    else:
+        rows = _local(query, limit, offset)
+    _latency.append((backend, (time.monotonic() - started) * 1000))
+    return rows
+
+
+def stats():
+    """Recent search latency per backend: {backend: {"n", "avg_ms", "p95_ms", "max_ms"}}."""
+    by = {}
+    for backend, ms in list(_latency):
+        by.setdefault(backend, []).append(ms)
+    out = {}
+    for backend, values in by.items():
+        values.sort()
+        out[backend] = {'n': len(values), 'avg_ms': round(sum(values) / len(values), 1),
+                        'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))], 1),
+                        'max_ms': round(values[-1], 1)}
+    return out
+
+
+# ------------- Benchmark ------------- #
+BASE = 9_000_000_000_000        # seeded user ids start here, like query_catalogue's
+
+
+def corpus(n, tickets=None, seed=1):
+    """`n` synthetic support messages [(ticket number, text)], Zipf-ish word frequencies."""
+    rnd = random.Random(seed)
+    vocab = [f"w{i}" for i in range(20000)] + ["payment", "refund", "login", "password", "crash",
+                                               "withdraw", "deposit", "verify", "bonus", "bug"]
+    cum = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    tickets = tickets or max(1, n // 10)
+    for _ in range(n):
+        yield rnd.randrange(tickets), " ".join(rnd.choices(vocab, cum_weights=cum, k=rnd.randint(4, 20)))
+
+
+BENCH_QUERIES = ["payment bug", "refund", "login password", "crash after deposit", "w5 w17", "verify bonus w300"]
+
+
+def _timed(fn, queries, rounds=5):
+    ms = []
+    for _ in range(rounds):
+        for q in queries:
+            started = time.monotonic()
+            fn(q)
+            ms.append((time.monotonic() - started) * 1000)
+    ms.sort()
+    return f"p50 {ms[len(ms) // 2]:.1f} ms | p95 {ms[int(len(ms) * 0.95)]:.1f} ms | max {ms[-1]:.1f} ms"
+
+
+def bench(n):
+    rows = list(corpus(n))
+    numbers = sorted({k for k, _ in rows})
+    with mysql.db_cursor() as c:
+        # Real tickets rows (one user each) so the FULLTEXT query's JOIN finds them
+        for i in range(0, len(numbers), 5000):
+            c.executemany("""INSERT INTO tickets (user_id, resolved, closed_at, first_message_link, last_message_link)
+                             VALUES (%s, 1, NOW(), %s, %s)""",
+                          [(BASE + k, f"bench/{k}/first", f"bench/{k}/last") for k in numbers[i:i + 5000]])
+        c.execute("SELECT id, user_id FROM tickets WHERE user_id >= %s", (BASE,))
+        ticket_of = {r['user_id'] - BASE: r['id'] for r in c.fetchall()}
+        for i in range(0, n, 5000):
+            c.executemany("""INSERT INTO ticket_messages (ticket_id, user_id, direction, sender_id, content_type, text, ts)
+                             VALUES (%s, %s, 'in', %s, 'text', %s, NOW())""",
+                          [(ticket_of[k], BASE + k, BASE + k, text) for k, text in rows[i:i + 5000]])
+    try:
+        hits = sum(len(mysql.search_tickets(q, 10, 0)) for q in BENCH_QUERIES)
+        print(f"mysql FULLTEXT  ({n} messages, {len(numbers)} tickets, {hits} hits): "
+              + _timed(lambda q: mysql.search_tickets(q, 10, 0), BENCH_QUERIES))
+        started = time.monotonic()
+        refresh()
+        _ready.set()
+        print(f"local index built in {time.monotonic() - started:.1f} s")
+        hits = sum(len(_local(q, 10, 0)) for q in BENCH_QUERIES)
+        print(f"local index     ({n} messages, {len(numbers)} tickets, {hits} hits): "
+              + _timed(lambda q: _local(q, 10, 0), BENCH_QUERIES))
+    finally:
+        with mysql.db_cursor() as c:
+            c.execute("""DELETE m FROM ticket_messages m JOIN tickets t ON t.id = m.ticket_id
+                          WHERE t.user_id >= %s""", (BASE,))
+            c.execute("DELETE FROM tickets WHERE user_id >= %s", (BASE,))
+
+
+if __name__ == '__main__':
+    from resources import migrations
+    migrations.run(wait=True)
+    bench(int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else 100000)
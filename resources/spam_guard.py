@@ -0,0 +1,144 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : spam_guard.py         #
+# --------------------------------------------- #
+# Per-user "messages since the team last replied" counters, kept in memory
+# and written back to users.open_ticket_spam in batches. With spam_window set the
+# counter is a token bucket of spam_protection messages that refills completely
+# over spam_window seconds of silence; a team reply always empties it.
+# Entries are only a cache of the stored value: they are dropped on reset, after
+# spam_idle_evict seconds without messages and beyond spam_max_users (least
+# recently used first); values not yet written wait in _dirty until they are.
+
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+_counters = OrderedDict()   # {user_id: [count, refilled_at, seen_at]}, least recently used first
+_dirty = {}                 # {user_id: count} to write on the next flush
+_lock = threading.Lock()
+
+
+def _step():
+    """Seconds of silence that take one message off the counter (0 = never)."""
+    window = getattr(config, 'spam_window', 0)
+    return window / max(1, getattr(config, 'spam_protection', 5)) if window else 0
+
+
+def _refill(entry, now):
+    step = _step()
+    if step and entry[0] > 1:
+        gained = int((now - entry[1]) / step)
+        if gained:
+            entry[0] = max(1, entry[0] - gained)
+            entry[1] = now if entry[0] == 1 else entry[1] + gained * step
+    elif entry[0] <= 1:
+        entry[1] = now
+
+
+def _drop(user_id, now):
+    """Evict one entry, keeping a refill that happened meanwhile for the next flush."""
+    entry = _counters.pop(user_id)
+    stored = entry[0]
+    _refill(entry, now)
+    if entry[0] != stored:
+        _dirty[user_id] = entry[0]
+
+
+def _cached(user_id, now):
+    entry = _counters.get(user_id)
+    if entry is not None:
+        _counters.move_to_end(user_id)
+        _refill(entry, now)
+        entry[2] = now
+    return entry
+
+
+def _insert(user_id, value, now):
+    entry = _counters[user_id] = [value, now, now]
+    limit = getattr(config, 'spam_max_users', 100000)
+    while len(_counters) > limit:
+        _drop(next(iter(_counters)), now)
+    return entry
+
+
+def hit(user_id, seed=1):
+    """Count one more user message and return the new counter. `seed` is the stored value for unseen users."""
+    now = time.monotonic()
+    with _lock:
+        entry = _cached(user_id, now)
+        if entry is None:
+            entry = _insert(user_id, _dirty.get(user_id) or seed or 1, now)
+        entry[0] += 1
+        _dirty[user_id] = entry[0]
+        return entry[0]
+
+
+def count(user_id, loader=None):
+    """Current counter; `loader(user_id)` supplies the stored value the first time a user is seen."""
+    now = time.monotonic()
+    with _lock:
+        entry = _cached(user_id, now)
+        if entry is not None:
+            return entry[0]
+        pending = _dirty.get(user_id)
+    value = pending or (loader(user_id) if loader else None) or 1
+    with _lock:
+        entry = _cached(user_id, now) or _insert(user_id, value, now)
+        return entry[0]
+
+
+def reset(user_id):
+    """The team replied or the ticket ended: start counting from scratch."""
+    with _lock:
+        _counters.pop(user_id, None)
+        _dirty[user_id] = 1
+
+
+def evict_idle():
+    """Drop entries without messages for spam_idle_evict seconds (run by the flusher)."""
+    now = time.monotonic()
+    idle = getattr(config, 'spam_idle_evict', 3600)
+    with _lock:
+        for user_id in [uid for uid, e in _counters.items() if now - e[2] > idle]:
+            _drop(user_id, now)
+
+
+def drain_dirty():
+    """[(user_id, count)] changed since the last call."""
+    with _lock:
+        rows = list(_dirty.items())
+        _dirty.clear()
+    return rows
+
+
+def requeue(rows):
+    """Put drained rows whose write failed back, unless a newer value is waiting."""
+    with _lock:
+        for uid, n in rows:
+            _dirty.setdefault(uid, n)
+
+
+def _flusher(write_fn, interval):
+    while True:
+        time.sleep(interval)
+        evict_idle()
+        rows = drain_dirty()
+        if not rows:
+            continue
+        try:
+            write_fn(rows)
+        except Exception as e:
+            print("⚠️ Failed to persist spam counters:", e)
+            requeue(rows)
+
+
+def start_flusher(write_fn):
+    """Persist changed counters with `write_fn([(user_id, count), ...])` every spam_flush_interval seconds."""
+    t = threading.Thread(target=_flusher, args=(write_fn, getattr(config, 'spam_flush_interval', 10)),
+                         name='spam-flusher', daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,184 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : state.py              #
+# --------------------------------------------- #
+# Where short-lived runtime state lives (issue-type choices, the banned id
+# set). Multi-step conversations such as /become_agent are kept in MySQL
+# instead (resources/conversation.py). MemoryBackend keeps it in this process; RedisBackend
+# keeps it in any Redis-protocol server so several bot processes can share it.
+# Values may be any picklable object; keys can expire after `ttl` seconds.
+
+import heapq
+import pickle
+import threading
+import time
+
+import config
+
+
+class MemoryBackend:
+    """Dict + sets in this process. Expired keys are dropped on access and on writes."""
+
+    def __init__(self):
+        self._data = {}         # {key: (value, expires_at or None)}
+        self._expiry = []       # heap of (expires_at, key); entries may be stale
+        self._lock = threading.Lock()
+
+    def _alive(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def _purge(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            self._alive(key, now)
+
+    def _put(self, key, value, ttl, now):
+        expires = now + ttl if ttl else None
+        self._data[key] = (value, expires)
+        if expires is not None:
+            heapq.heappush(self._expiry, (expires, key))
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._alive(key, time.monotonic())
+        return default if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._put(key, value, ttl, now)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._alive(key, time.monotonic())
+            self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def sadd(self, key, *members):
+        now = time.monotonic()
+        with self._lock:
+            item = self._alive(key, now)
+            if item is None:
+                self._put(key, set(members), None, now)
+            else:
+                item[0].update(members)
+
+    def srem(self, key, *members):
+        with self._lock:
+            item = self._alive(key, time.monotonic())
+            if item is not None:
+                item[0].difference_update(members)
+
+    def sismember(self, key, member):
+        with self._lock:
+            item = self._alive(key, time.monotonic())
+            return item is not None and member in item[0]
+
+    def scard(self, key):
+        with self._lock:
+            item = self._alive(key, time.monotonic())
+            return 0 if item is None else len(item[0])
+
+    def sreplace(self, key, members, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._put(key, set(members), ttl, now)
+
+
+class RedisBackend:
+    """
+    Same API on a Redis-protocol server (Redis, Valkey, KeyDB, ...). Needs the
+    `redis` package; pass `client=` to use an existing client or a stand-in such
+    as fakeredis.FakeRedis(). Set members are stored as strings and must be ints.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='', client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("state_backend = 'redis' needs the redis package: pip install redis")
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+
+    def _k(self, key):
+        return self.prefix + key
+
+    def get(self, key, default=None):
+        raw = self.redis.get(self._k(key))
+        return default if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(self._k(key), pickle.dumps(value), ex=int(ttl) if ttl else None)
+
+    def pop(self, key, default=None):
+        pipe = self.redis.pipeline()
+        pipe.get(self._k(key))
+        pipe.delete(self._k(key))
+        raw, _ = pipe.execute()
+        return default if raw is None else pickle.loads(raw)
+
+    def delete(self, key):
+        self.redis.delete(self._k(key))
+
+    def sadd(self, key, *members):
+        if members:
+            self.redis.sadd(self._k(key), *members)
+
+    def srem(self, key, *members):
+        if members:
+            self.redis.srem(self._k(key), *members)
+
+    def sismember(self, key, member):
+        return bool(self.redis.sismember(self._k(key), member))
+
+    def scard(self, key):
+        return self.redis.scard(self._k(key))
+
+    def sreplace(self, key, members, ttl=None):
+        """Swap the whole set in one MULTI so readers never see it half-built."""
+        pipe = self.redis.pipeline()
+        pipe.delete(self._k(key))
+        members = list(members)
+        for i in range(0, len(members), 1000):
+            pipe.sadd(self._k(key), *members[i:i + 1000])
+        if ttl and members:
+            pipe.expire(self._k(key), int(ttl))
+        pipe.execute()
+
+
+_backend = None
+_lock = threading.Lock()
+
+
+def shared():
+    """True when state is kept outside this process (several workers may run)."""
+    return getattr(config, 'state_backend', 'memory') != 'memory'
+
+
+def backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            kind = getattr(config, 'state_backend', 'memory')
+            if kind == 'memory':
+                _backend = MemoryBackend()
+            elif kind == 'redis':
+                _backend = RedisBackend(getattr(config, 'state_redis_url', 'redis://localhost:6379/0'),
+                                        prefix=getattr(config, 'state_key_prefix', 'supportbot:'))
+            else:
+                raise ValueError(f"Unknown state_backend {kind!r} (use 'memory' or 'redis')")
+        return _backend
+
@@ -0,0 +1,126 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : transcript.py         #
+# --------------------------------------------- #
+# Every message of a ticket, both ways, for later review (/transcript). record()
+# only appends to a buffer; a writer flushes it with multi-row INSERTs every
+# transcript_flush_ms, or sooner once transcript_batch_rows are waiting, so a
+# relayed message never waits for its transcript row.
+
+import threading
+import time
+from datetime import datetime
+
+import config
+
+IN = 'in'       # user -> support
+OUT = 'out'     # support -> user
+
+_buffer = []    # [(ticket_id, user_id, direction, sender_id, content_type, text, file_id, message_id, ts)]
+_cond = threading.Condition()
+_stats = {'recorded': 0, 'written': 0, 'dropped': 0}
+_write_lock = threading.Lock()   # one write at a time (the writer thread, or flush() at exit)
+_write_fn = None
+
+
+def _content(message):
+    """(content_type, text or caption, file_id) of a Telegram message."""
+    kind = message.content_type
+    if kind == 'text':
+        return kind, message.text, None
+    media = getattr(message, kind, None)
+    if isinstance(media, list):         # photo sizes: keep the largest
+        media = media[-1] if media else None
+    return kind, message.caption, getattr(media, 'file_id', None)
+
+
+def _trim():
+    over = len(_buffer) - getattr(config, 'transcript_max_buffer', 50000)
+    if over > 0:    # DB unreachable for a long time: keep the newest rows
+        del _buffer[:over]
+        _stats['dropped'] += over
+
+
+def record(user_id, direction, message, ticket_id=None):
+    """
+    Queue `message` for the transcript of `user_id`'s ticket. Without a
+    ticket_id the row goes to the user's current ticket at write time.
+    """
+    kind, text, file_id = _content(message)
+    row = (ticket_id, user_id, direction, message.from_user.id, kind, text, file_id,
+           message.message_id, datetime.fromtimestamp(message.date))
+    with _cond:
+        _buffer.append(row)
+        _stats['recorded'] += 1
+        _trim()
+        if len(_buffer) >= getattr(config, 'transcript_batch_rows', 200):
+            _cond.notify()
+
+
+def drain():
+    """Take everything buffered so far."""
+    with _cond:
+        rows = _buffer[:]
+        del _buffer[:]
+    return rows
+
+
+def requeue(rows):
+    """Put rows whose write failed back in front of the buffer."""
+    with _cond:
+        _buffer[:0] = rows
+        _trim()
+
+
+def written(n):
+    with _cond:
+        _stats['written'] += n
+
+
+def stats():
+    with _cond:
+        s = dict(_stats)
+        s['buffered'] = len(_buffer)
+    return s
+
+
+def _write(write_fn):
+    """Write everything buffered; on failure put it back. Returns False if that happened."""
+    with _write_lock:
+        rows = drain()
+        if not rows:
+            return True
+        try:
+            write_fn(rows)
+            written(len(rows))
+            return True
+        except Exception as e:
+            print("⚠️ Failed to write transcript rows:", e)
+            requeue(rows)
+            return False
+
+
+def _writer(write_fn, interval, batch):
+    while True:
+        with _cond:
+            _cond.wait_for(lambda: len(_buffer) >= batch, timeout=interval)
+        if not _write(write_fn):
+            time.sleep(interval)
+
+
+def flush():
+    """Write what is still buffered (at shutdown); waits for a write in progress."""
+    if _write_fn is not None:
+        _write(_write_fn)
+
+
+def start_writer(write_fn):
+    """Flush buffered rows with `write_fn(rows)` on a daemon thread."""
+    global _write_fn
+    _write_fn = write_fn
+    t = threading.Thread(target=_writer, name='transcript-writer', daemon=True,
+                         args=(write_fn, getattr(config, 'transcript_flush_ms', 200) / 1000,
+                               getattr(config, 'transcript_batch_rows', 200)))
+    t.start()
+    return t
@@ -0,0 +1,226 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : updates.py            #
+# --------------------------------------------- #
+# Runs incoming updates (polling or webhook) on a worker pool, keyed by sender:
+# one user's updates are handled strictly one after another, in arrival order,
+# while different users run in parallel. So two quick messages from the same
+# user can no longer race on ticket creation or the spam counter.
+#
+# A task that has to wait on something slow (a post queued behind the support
+# group's rate limit) hands the rest of its work to after(): the worker is
+# freed, but the user's later updates still wait until that rest has run.
+# Work handed over with after() and then() runs in the order it was handed over.
+
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config
+
+
+class KeyedExecutor:
+    """
+    Thread pool with a FIFO per key. A key's queue is drained by at most one
+    worker at a time, one task per turn (then it goes to the back of the pool's
+    queue), so a slow or chatty user never holds a worker for others.
+    """
+
+    def __init__(self, workers=8, name='update'):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._workers = workers
+        self._queues = {}           # {key: deque[(fn, args, queued_at, waits_for)]}; head is running or next
+        self._lock = threading.Lock()
+        self._closing = False
+        self._local = threading.local()     # .key: key of the task running on this thread
+        self._stats = {'done': 0, 'failed': 0, 'queued': 0, 'max_queued': 0, 'max_key_depth': 0,
+                       'wait_total_ms': 0.0, 'wait_max_ms': 0.0, 'run_total_ms': 0.0}
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            q = self._queues.get(key)
+            idle = q is None
+            if idle:
+                q = self._queues[key] = deque()
+            q.append((fn, args, time.monotonic(), None))
+            s = self._stats
+            s['queued'] += 1
+            s['max_queued'] = max(s['max_queued'], s['queued'])
+            s['max_key_depth'] = max(s['max_key_depth'], len(q))
+        if idle:
+            self._pool.submit(self._run_next, key)
+
+    def after(self, future, fn, *args):
+        """
+        From inside a task: end this turn without waiting for `future`, and run
+        fn(future, *args) as the key's next task once it is done (ahead of
+        anything queued for the key meanwhile). Outside a task: wait, then call.
+        """
+        if getattr(self._local, 'key', None) is None:
+            wait([future])
+            fn(future, *args)
+            return
+        self._local.held.append((fn, (future,) + args, future))
+
+    def then(self, fn, *args):
+        """
+        From inside a task: run fn(*args) as the key's next task, after the work
+        already handed to after() (so it sees what that work wrote). Outside a
+        task: call it now.
+        """
+        if getattr(self._local, 'key', None) is None:
+            fn(*args)
+            return
+        self._local.held.append((fn, args, None))
+
+    def pending(self):
+        """Updates accepted but not finished yet."""
+        with self._lock:
+            return self._stats['queued']
+
+    def _run_next(self, key):
+        while True:
+            with self._lock:
+                fn, args, queued_at, waits_for = self._queues[key][0]
+            if waits_for is not None and not waits_for.done():
+                waits_for.add_done_callback(lambda _: self._resume(key))
+                return
+            started = time.monotonic()
+            self._local.key, self._local.held = key, []
+            try:
+                fn(*args)
+                failed = 0
+            except Exception as e:
+                failed = 1
+                print("⚠️ Update task failed:", e)
+                traceback.print_exc()
+            finally:
+                self._local.key, held = None, self._local.held    # kept on failure: their work has started
+            finished = time.monotonic()
+            with self._lock:
+                q = self._queues[key]
+                q.popleft()
+                for then, then_args, waits_for in reversed(held):
+                    q.appendleft((then, then_args, None, waits_for))
+                self._stats['queued'] += len(held)
+                if not q:
+                    del self._queues[key]
+                s = self._stats
+                s['queued'] -= 1
+                s['done'] += 1
+                s['failed'] += failed
+                wait_ms = (started - (queued_at or started)) * 1000
+                s['wait_total_ms'] += wait_ms
+                s['wait_max_ms'] = max(s['wait_max_ms'], wait_ms)
+                s['run_total_ms'] += (finished - started) * 1000
+                more, closing = bool(q), self._closing
+            if not more:
+                return
+            if not closing:
+                try:
+                    self._pool.submit(self._run_next, key)
+                    return
+                except RuntimeError:    # pool shut down meanwhile: finish the key here
+                    pass
+
+    def _resume(self, key):
+        with self._lock:
+            fn, args, _, waits_for = self._queues[key][0]
+            self._queues[key][0] = (fn, args, time.monotonic(), waits_for)
+        try:
+            self._pool.submit(self._run_next, key)
+        except RuntimeError:        # pool shut down: finish the key on this thread
+            self._run_next(key)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['keys'] = len(self._queues)
+            s['backlog'] = {k: len(q) for k, q in self._queues.items() if len(q) > 1}
+        done = s['done']
+        s['workers'] = self._workers
+        s['wait_avg_ms'] = round(s.pop('wait_total_ms') / done, 3) if done else 0.0
+        s['run_avg_ms'] = round(s.pop('run_total_ms') / done, 3) if done else 0.0
+        s['wait_max_ms'] = round(s['wait_max_ms'], 3)
+        s['busiest'] = sorted(s.pop('backlog').items(), key=lambda kv: -kv[1])[:3]
+        return s
+
+    def shutdown(self, wait=True):
+        """Stop taking turns; keys already queued are drained by their current worker."""
+        with self._lock:
+            self._closing = True
+        self._pool.shutdown(wait=wait)
+
+
+def update_key(update):
+    """Who an update belongs to: the sending user, else the chat, else nobody (own key)."""
+    for obj in (update.message, update.edited_message, update.callback_query,
+                update.my_chat_member, update.chat_member, update.channel_post):
+        if obj is None:
+            continue
+        user = getattr(obj, 'from_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(obj, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return ('update', update.update_id)
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = KeyedExecutor(workers=getattr(config, 'update_workers', getattr(config, 'webhook_workers', 8)))
+        return _executor
+
+
+def _process(bot, update):
+    bot.process_new_updates([update])
+
+
+def submit(bot, update):
+    executor().submit(update_key(update), _process, bot, update)
+
+
+def after(future, fn, *args):
+    """See KeyedExecutor.after."""
+    executor().after(future, fn, *args)
+
+
+def then(fn, *args):
+    """See KeyedExecutor.then."""
+    executor().then(fn, *args)
+
+
+def stats():
+    return executor().stats()
+
+
+def poll(bot, timeout=20):
+    """
+    Long-poll getUpdates and hand every update to the executor. Stops fetching
+    while more than `update_max_pending` updates are still waiting.
+    """
+    max_pending = getattr(config, 'update_max_pending', 1000)
+    offset = None
+    while True:
+        if executor().pending() > max_pending:
+            time.sleep(0.1)
+            continue
+        try:
+            batch = bot.get_updates(offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            print("⚠️ Polling failed:", e)
+            time.sleep(5)
+            continue
+        for update in batch:
+            offset = update.update_id + 1
+            submit(bot, update)
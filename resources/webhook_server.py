@@ -0,0 +1,71 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : webhook_server.py     #
+# --------------------------------------------- #
+
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from resources import updates
+from telebot.types import Update
+
+
+def _make_handler(bot):
+    path = '/' + config.webhook_path.strip('/')
+    secret = getattr(config, 'webhook_secret', '') or ''
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body=b''):
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            # Health check for load balancers
+            self._reply(200 if self.path == '/healthz' else 404, b'ok' if self.path == '/healthz' else b'')
+
+        def do_POST(self):
+            if self.path != path:
+                self._reply(404)
+                return
+            token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            # Compared as bytes: compare_digest raises TypeError on non-ASCII str
+            if secret and not hmac.compare_digest(token.encode(), secret.encode()):
+                self._reply(403)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                update = Update.de_json(self.rfile.read(length).decode('utf-8'))
+            except Exception as e:
+                print("⚠️ Bad webhook payload:", e)
+                self._reply(400)
+                return
+            # Acknowledge right away; Telegram re-sends updates that aren't answered quickly.
+            updates.submit(bot, update)
+            self._reply(200)
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def serve(bot):
+    """Register the webhook with Telegram and serve updates until interrupted."""
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=config.webhook_url,
+        secret_token=getattr(config, 'webhook_secret', '') or None,
+        max_connections=getattr(config, 'webhook_max_connections', 40)
+    )
+    server = ThreadingHTTPServer((config.webhook_host, config.webhook_port), _make_handler(bot))
+    print(f"Webhook listening on {config.webhook_host}:{config.webhook_port}/{config.webhook_path.strip('/')}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        updates.executor().shutdown(wait=True)
@@ -0,0 +1,152 @@
+# --------------------------------------------- #
+# Plugin Name           : Telegram Support Bot  #
+# Author Name           : fabston (extended)    #
+# File Name             : word_filter.py        #
+# --------------------------------------------- #
+# Bad-word filter built once per language as an Aho-Corasick automaton, so a
+# message is scanned in a single linear pass no matter how many words are
+# listed. Word list syntax (config.bad_words):
+#   'word'   whole word only
+#   '*word'  word may have a prefix   ('*fuck'  -> 'motherfuck')
+#   'word*'  word may have a suffix   ('arsch*' -> 'arschloch')
+
+import re
+import threading
+import unicodedata
+from collections import deque
+
+import config
+
+_LEET = str.maketrans({'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't',
+                       '@': 'a', '$': 's', '!': 'i', '+': 't'})
+_LEET_RUN = re.compile(r"[\w@$!+]*[013457@$!+][\w@$!+]*")     # runs with something to undo
+
+
+def _unleet(match):
+    # Only runs that also contain letters ("a55", "$hit"): order / room numbers stay numbers
+    run = match.group()
+    return run.translate(_LEET) if any(ch.isalpha() for ch in run) else run
+
+
+def normalize(text):
+    """Casefold, strip diacritics, undo common leetspeak and collapse whitespace."""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(_LEET_RUN.sub(_unleet, text).split())
+
+
+def _is_word(ch):
+    return ch.isalnum() or ch == '_'
+
+
+class WordFilter:
+    def __init__(self, patterns):
+        self._goto = [{}]       # node -> {char: node}
+        self._fail = [0]
+        self._out = [[]]        # node -> [(length, prefix_ok, suffix_ok)]
+        for p in patterns:
+            self._add(p)
+        self._link()
+
+    def _add(self, pattern):
+        prefix_ok = pattern.startswith('*')
+        suffix_ok = pattern.endswith('*')
+        word = normalize(pattern.strip('*'))
+        if not word:
+            return
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((len(word), prefix_ok, suffix_ok))
+
+    def _link(self):
+        # Breadth-first, so every fail target is finished before it is used. Missing
+        # transitions are filled in from the fail target, turning the trie into a DFA:
+        # scanning is then one dict lookup per character, with no fail-link walking.
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in list(goto[node].items()):
+                queue.append(nxt)
+                if node:
+                    fail[nxt] = goto[fail[node]].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+            if node:
+                for ch, nxt in goto[fail[node]].items():
+                    goto[node].setdefault(ch, nxt)
+
+    def find(self, text):
+        """First listed word in `text` (normalized form), or None."""
+        text = normalize(text)
+        goto, out = self._goto, self._out
+        n = len(text)
+        node = 0
+        for i, ch in enumerate(text):
+            node = goto[node].get(ch, 0)
+            if not out[node]:
+                continue
+            for length, prefix_ok, suffix_ok in out[node]:
+                start = i - length + 1
+                if not prefix_ok and start > 0 and _is_word(text[start - 1]):
+                    continue
+                if not suffix_ok and i + 1 < n and _is_word(text[i + 1]):
+                    continue
+                return text[start:i + 1]
+        return None
+
+
+_filters = {}
+_lock = threading.Lock()
+
+
+def get_filter(lang=None):
+    """Filter for a language: the shared '*' list plus that language's own words. Built once."""
+    lang = lang if lang in getattr(config, 'bad_words', {}) else '*'
+    f = _filters.get(lang)
+    if f is None:
+        with _lock:
+            f = _filters.get(lang)
+            if f is None:
+                words = set(config.bad_words.get('*', []))
+                if lang != '*':
+                    words.update(config.bad_words[lang])
+                f = _filters[lang] = WordFilter(sorted(words))
+    return f
+
+
+def find_bad_word(text, lang=None):
+    return get_filter(lang).find(text) if text else None
+
+
+# ------------- Micro-benchmark: python -m resources.word_filter ------------- #
+if __name__ == '__main__':
+    import timeit
+
+    for text, expected in (("My order #455 has not arrived", None), ("room 455", None),
+                           ("price 455 EUR", None), ("order#455", None), ("call 555-0134", None),
+                           ("you a55", 'ass'), ("$hit, you 4ss", 'ass'), ("Arschloch!", 'arsch')):
+        found = find_bad_word(text, 'de')
+        assert found == expected, f"{text!r}: {found!r} != {expected!r}"
+
+    legacy = (r'(?i)^(.*?(\b\w*fuck|shut up|dick|bitch|bastart|cunt|bollocks|bugger|rubbish|wanker|twat|'
+              r'suck|ass|pussy|arsch\w*\b)[^$]*)$')
+    engine = get_filter('de')
+    filler = 'Hello support team, my order number 12345 has not arrived yet and I would like an update. '
+    for size in (1_000, 10_000, 100_000):
+        clean = (filler * (size // len(filler) + 1))[:size]
+        dirty = clean + ' arschloch'
+        # A listed substring early on plus a '$' later makes the old pattern backtrack quadratically
+        prices = ('class ' * (size // 6))[:size] + ' $5'
+        for label, text in (('clean', clean), ('match at end', dirty), ('"$" pricing', prices)):
+            n = 3 if label == '"$" pricing' and size > 1_000 else 20
+            t_re = timeit.timeit(lambda: re.findall(legacy, text), number=n) / n * 1000
+            t_ac = timeit.timeit(lambda: engine.find(text), number=n) / n * 1000
+            print(f"{size:>7} chars, {label:<13} regex {t_re:9.3f} ms | automaton {t_ac:8.3f} ms")
@@ -0,0 +1,118 @@
+# ------------------------------------------------- #
+# Plugin Name           : Telegram Support Bot      #
+# Author Name           : fabston (extended)        #
+# File Name             : test_claim_concurrency.py #
+# ------------------------------------------------- #
+# Hundreds of simultaneous claims against a real MySQL: exactly one may win,
+# and no claim may take longer than CLAIM_MAX_SECONDS. Needs a scratch database
+# (the schema is migrated into it and test rows are removed afterwards):
+#
+#   SUPPORTBOT_TEST_MYSQL=mysql://user:pw@localhost/scratch python -m pytest tests
+
+import os
+import threading
+import time
+import unittest
+from urllib.parse import urlparse
+
+import config
+
+DSN = os.environ.get('SUPPORTBOT_TEST_MYSQL')
+CLAIMS = int(os.environ.get('SUPPORTBOT_TEST_CLAIMS', 200))
+CLAIM_MAX_SECONDS = float(os.environ.get('SUPPORTBOT_TEST_CLAIM_MAX_SECONDS', 5))
+
+USER_ID = 9_000_000_001             # far outside real Telegram ids
+AGENT_BASE = 9_000_100_000
+
+if DSN:
+    _dsn = urlparse(DSN)
+    config.mysql_host = _dsn.hostname
+    config.mysql_user = _dsn.username
+    config.mysql_pw = _dsn.password or ''
+    config.mysql_db = _dsn.path.lstrip('/')
+    config.mysql_pool_size = 50
+    config.mysql_pool_timeout = 30
+    from resources import migrations
+    from resources import mysql_handler as mysql
+
+
+def fire(n, claim):
+    """Run claim(i) on n threads released together; [(result, seconds)] in thread order."""
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def worker(i):
+        barrier.wait()
+        started = time.monotonic()
+        try:
+            result = claim(i)
+        except Exception as e:
+            result = e
+        results[i] = (result, time.monotonic() - started)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+@unittest.skipUnless(DSN, "set SUPPORTBOT_TEST_MYSQL to a scratch database")
+class ClaimConcurrencyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        migrations.run(wait=True)
+
+    def setUp(self):
+        self.tearDown()
+        with mysql.db_transaction() as c:
+            c.executemany("INSERT INTO agents (user_id, languages) VALUES (%s, 'en')",
+                          [(AGENT_BASE + i,) for i in range(CLAIMS)])
+            for user_id in range(USER_ID, USER_ID + CLAIMS):
+                c.execute("INSERT INTO users (userid, open_ticket) VALUES (%s, 1)", (user_id,))
+                c.execute("INSERT INTO tickets (user_id) VALUES (%s)", (user_id,))
+                c.execute("UPDATE users SET current_ticket_id=LAST_INSERT_ID() WHERE userid=%s", (user_id,))
+
+    def tearDown(self):
+        users = (USER_ID, USER_ID + CLAIMS)
+        with mysql.db_transaction() as c:
+            c.execute("DELETE FROM tickets WHERE user_id >= %s AND user_id < %s", users)
+            c.execute("DELETE FROM users WHERE userid >= %s AND userid < %s", users)
+            c.execute("DELETE FROM agents WHERE user_id >= %s AND user_id < %s", (AGENT_BASE, AGENT_BASE + CLAIMS))
+
+    def assertBounded(self, results):
+        errors = [r for r, _ in results if isinstance(r, Exception)]
+        self.assertFalse(errors, f"{len(errors)} claims failed, e.g. {errors[:1]}")
+        slowest = max(s for _, s in results)
+        self.assertLess(slowest, CLAIM_MAX_SECONDS, f"slowest claim took {slowest:.2f}s")
+
+    def test_one_ticket_many_agents(self):
+        results = fire(CLAIMS, lambda i: mysql.claim_ticket_atomic(USER_ID, AGENT_BASE + i))
+        self.assertBounded(results)
+        winners = [owner for (owner, won), _ in results if won]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual({owner for (owner, won), _ in results}, set(winners))
+        with mysql.db_cursor() as c:
+            c.execute("""SELECT u.claimed_by, t.claimed_by AS ticket_claimed_by
+                           FROM users u JOIN tickets t ON t.id = u.current_ticket_id
+                          WHERE u.userid=%s""", (USER_ID,))
+            row = c.fetchone()
+            c.execute("SELECT SUM(tickets_claimed) AS n FROM agents WHERE user_id >= %s AND user_id < %s",
+                      (AGENT_BASE, AGENT_BASE + CLAIMS))
+            claimed = c.fetchone()['n']
+        self.assertEqual((row['claimed_by'], row['ticket_claimed_by']), (winners[0], winners[0]))
+        self.assertEqual(claimed, 1)
+
+    def test_one_agent_many_tickets_capped(self):
+        results = fire(CLAIMS, lambda i: mysql.claim_ticket_atomic(USER_ID + i, AGENT_BASE, cap=1))
+        self.assertBounded(results)
+        self.assertEqual(sum(1 for (owner, won), _ in results if won), 1)
+        with mysql.db_cursor() as c:
+            c.execute("SELECT COUNT(*) AS n FROM tickets WHERE claimed_by=%s AND closed_at IS NULL", (AGENT_BASE,))
+            self.assertEqual(c.fetchone()['n'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# ------------------------------------------------- #
+# Plugin Name           : Telegram Support Bot      #
+# Author Name           : fabston (extended)        #
+# File Name             : test_query_plans.py       #
+# ------------------------------------------------- #
+# EXPLAINs every query in resources/query_catalogue.py against a seeded real
+# MySQL: none may read a whole table/index or filesort unless the catalogue
+# allows it. Needs a scratch database (the schema is migrated into it and the
+# seeded rows are removed afterwards):
+#
+#   SUPPORTBOT_TEST_MYSQL=mysql://user:pw@localhost/scratch python -m pytest tests
+
+import os
+import unittest
+from urllib.parse import urlparse
+
+import config
+
+DSN = os.environ.get('SUPPORTBOT_TEST_MYSQL')
+ROWS = int(os.environ.get('SUPPORTBOT_TEST_PLAN_ROWS', 20000))
+
+if DSN:
+    _dsn = urlparse(DSN)
+    config.mysql_host = _dsn.hostname
+    config.mysql_user = _dsn.username
+    config.mysql_pw = _dsn.password or ''
+    config.mysql_db = _dsn.path.lstrip('/')
+    from resources import migrations
+    from resources import mysql_handler as mysql
+    from resources import query_catalogue as catalogue
+
+
+@unittest.skipUnless(DSN, "set SUPPORTBOT_TEST_MYSQL to a scratch database")
+class QueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        migrations.run(wait=True)
+        catalogue.cleanup()
+        catalogue.seed(ROWS)
+
+    @classmethod
+    def tearDownClass(cls):
+        catalogue.cleanup()
+
+    def test_no_scans_or_filesorts(self):
+        with mysql.db_cursor() as c:
+            for name, sql, params, scan_ok in catalogue.QUERIES:
+                with self.subTest(query=name):
+                    plan = catalogue.explain(c, sql, params)
+                    self.assertEqual(catalogue.problems(plan, scan_ok, name in catalogue.SORT_OK), [], plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# ------------------------------------------------- #
+# Plugin Name           : Telegram Support Bot      #
+# Author Name           : fabston (extended)        #
+# File Name             : test_state_backend.py     #
+# ------------------------------------------------- #
+# The same checks against MemoryBackend and RedisBackend. The Redis one runs on
+# fakeredis (pip install fakeredis) so no server is needed; it is skipped
+# without it.
+
+import time
+import unittest
+
+from resources import state
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class BackendChecks:
+
+    def make(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make()
+
+    def test_get_set_pop(self):
+        self.assertIsNone(self.store.get('k'))
+        self.assertEqual(self.store.get('k', 'x'), 'x')
+        self.store.set('k', {'relate_ticket_id': 7})
+        self.assertEqual(self.store.get('k'), {'relate_ticket_id': 7})
+        self.assertEqual(self.store.pop('k'), {'relate_ticket_id': 7})
+        self.assertIsNone(self.store.pop('k'))
+        self.store.set('k', 1)
+        self.store.delete('k')
+        self.assertIsNone(self.store.get('k'))
+
+    def test_ttl(self):
+        self.store.set('k', 1, ttl=1)
+        self.store.set('keep', 2)
+        self.assertEqual(self.store.get('k'), 1)
+        time.sleep(1.1)
+        self.assertIsNone(self.store.get('k'))
+        self.assertEqual(self.store.get('keep'), 2)
+
+    def test_sets(self):
+        self.store.sadd('banned', 1, 2)
+        self.store.sadd('banned', 3)
+        self.store.srem('banned', 2)
+        self.assertTrue(self.store.sismember('banned', 1))
+        self.assertFalse(self.store.sismember('banned', 2))
+        self.assertEqual(self.store.scard('banned'), 2)
+        self.store.sreplace('banned', range(2500))
+        self.assertEqual(self.store.scard('banned'), 2500)
+        self.assertTrue(self.store.sismember('banned', 2499))
+        self.store.sreplace('banned', [])
+        self.assertEqual(self.store.scard('banned'), 0)
+        self.assertFalse(self.store.sismember('missing', 1))
+
+
+class MemoryBackendTest(BackendChecks, unittest.TestCase):
+
+    def make(self):
+        return state.MemoryBackend()
+
+
+@unittest.skipUnless(fakeredis, "pip install fakeredis")
+class RedisBackendTest(BackendChecks, unittest.TestCase):
+
+    def make(self):
+        return state.RedisBackend(client=fakeredis.FakeRedis(), prefix='test:')
+
+    def test_prefix(self):
+        self.store.set('k', 1)
+        self.store.sadd('banned', 5)
+        self.assertEqual(sorted(self.store.redis.keys('*')), [b'test:banned', b'test:k'])
+
+
+if __name__ == '__main__':
+    unittest.main()